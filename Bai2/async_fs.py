@@ -0,0 +1,126 @@
+import asyncio
+import contextlib
+import functools
+import weakref
+from concurrent.futures import Executor
+from typing import List, Optional
+from file_operations import *
+
+# API asyncio cho FileSystem, dùng khi nhúng MyFS vào một dịch vụ asyncio
+# - Mọi thao tác đọc/ghi volume, PBKDF2 và AES chạy trên executor (mặc định là thread pool của event loop),
+#   event loop không bị chặn trong lúc xử lý
+# - Mỗi đường dẫn có một khóa đọc/ghi: nhiều lượt đọc cùng một tập tin chạy song song, xóa/ghi đè chờ các lượt đọc xong
+# - Các thao tác cấp phát entry và data block (thêm, xóa, đổi mật khẩu, tạo thư mục) chạy lần lượt
+
+class AsyncReadWriteLock:
+    def __init__(self):
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0  # New readers wait for them, so writers are not starved
+        self._condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def read(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._writer and not self._waiting_writers)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def write(self):
+        async with self._condition:
+            self._waiting_writers += 1
+            try:
+                await self._condition.wait_for(lambda: not self._writer and self._readers == 0)
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+class AsyncFileSystem:
+    def __init__(self, fs: FileSystem, executor: Optional[Executor] = None):
+        self.fs = fs
+        self.executor = executor
+        self._entry_locks = weakref.WeakValueDictionary()  # path -> AsyncReadWriteLock, dropped when no task holds it
+        self._allocation_lock = asyncio.Lock()
+        self._tables_loaded = False
+
+    # Open (or create) a volume without blocking the event loop
+    @staticmethod
+    async def open_volume(file_path: str, metadata_path: str = "metadata.ivf", executor: Optional[Executor] = None, **kwargs) -> 'AsyncFileSystem':
+        loop = asyncio.get_running_loop()
+        fs = await loop.run_in_executor(executor, functools.partial(FileSystem, file_path, metadata_path, **kwargs))
+        return AsyncFileSystem(fs, executor)
+
+    async def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    # Entry tables of a lazily opened volume are loaded once, before worker threads share them
+    async def _load_tables(self):
+        if self._tables_loaded:
+            return
+        async with self._allocation_lock:
+            if not self._tables_loaded:
+                await self._run(lambda: (self.fs.main_entry_table, self.fs.backup_entry_table))
+                self._tables_loaded = True
+
+    def _entry_lock(self, path: str) -> AsyncReadWriteLock:
+        key = PATH_SEPARATOR.join(split_path(path))
+        lock = self._entry_locks.get(key)
+        if lock is None:
+            lock = AsyncReadWriteLock()
+            self._entry_locks[key] = lock
+        return lock
+
+    async def list_files(self) -> List[Entry]:
+        await self._load_tables()
+        return await self._run(self.fs.list_files)
+
+    async def list_directory(self, path: str = PATH_SEPARATOR) -> List[Entry]:
+        await self._load_tables()
+        return await self._run(self.fs.list_directory, path)
+
+    async def add_file(self, source_path: str, filename: str, password: Optional[str] = None, compression: str | None = None,
+                       dedup: bool = False, block_hashes: bool = False):
+        await self._load_tables()
+        async with self._entry_lock(filename).write(), self._allocation_lock:
+            await self._run(self.fs.add_file, source_path, filename, password, compression, dedup, block_hashes)
+
+    async def export_file(self, filename: str, export_path: str = None, password: Optional[str] = None):
+        await self._load_tables()
+        async with self._entry_lock(filename).read():
+            await self._run(self.fs.export_file, filename, export_path, password)
+
+    async def read_file(self, filename: str, password: Optional[str] = None) -> bytes:
+        await self._load_tables()
+        async with self._entry_lock(filename).read():
+            return await self._run(self.fs.read_file, filename, password)
+
+    async def delete_file(self, filename: str):
+        await self._load_tables()
+        async with self._entry_lock(filename).write(), self._allocation_lock:
+            await self._run(self.fs.delete_file, filename)
+
+    async def reset_password(self, filename: str, old_password: str, new_password: str):
+        await self._load_tables()
+        async with self._entry_lock(filename).write(), self._allocation_lock:
+            await self._run(self.fs.reset_password, filename, old_password, new_password)
+
+    async def make_directory(self, path: str):
+        await self._load_tables()
+        async with self._entry_lock(path).write(), self._allocation_lock:
+            await self._run(self.fs.make_directory, path)
+
+    def close(self):
+        self.fs.close()
@@ -0,0 +1,260 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+try:
+    import resource
+except ImportError:  # Windows: peak RSS is not reported
+    resource = None
+from file_operations import *
+
+# Đo hiệu năng FileSystem, kết quả lặp lại được với cùng --seed:
+#   python benchmark.py --files 40 --sizes lognormal:65536,1.0 --output result.json
+#   python benchmark.py --compare result.json   (so với lần đo trước, mã thoát 1 nếu chậm hơn --threshold)
+# Mỗi kịch bản tạo volume mới: 'fresh' là volume trống, 'aged' được thêm/xóa tập tin nhiều lượt trước khi đo
+# để vùng trống bị phân mảnh. Với mỗi thao tác đo số thao tác/giây, MB/s, số lần mở tập tin (audit hook 'open'),
+# số syscall read/write (/proc/self/io, chỉ có trên Linux), fs.stats() của thao tác đó, và RSS đỉnh của cả tiến trình
+# tính tới lúc thao tác kết thúc (không riêng thao tác đó: ru_maxrss không giảm)
+
+RESULT_VERSION = 2
+SCENARIOS = ('fresh', 'aged')
+OPERATIONS = ('add_file', 'list_files', 'export_file', 'reset_password', 'delete_file')
+MAX_GENERATED_SIZE = 64 * 1024 * 1024
+RESERVED_ENTRIES = 2  # Entries left for system entries such as the chunk index
+
+_counting = False
+_open_count = 0
+
+def _audit(event: str, args):
+    global _open_count
+    if _counting and event == 'open':
+        _open_count += 1
+
+sys.addaudithook(_audit)
+
+# Size distributions: 'fixed:SIZE', 'uniform:MIN-MAX', 'lognormal:MEDIAN,SIGMA'
+def size_generator(spec: str, rng: random.Random) -> Callable[[], int]:
+    kind, _, params = spec.partition(':')
+    try:
+        if kind == 'fixed':
+            size = int(params)
+            return lambda: size
+        if kind == 'uniform':
+            low, high = (int(value) for value in params.split('-'))
+            return lambda: rng.randint(low, high)
+        if kind == 'lognormal':
+            median, sigma = params.split(',')
+            mu, sigma = math.log(int(median)), float(sigma)
+            return lambda: max(1, min(MAX_GENERATED_SIZE, int(rng.lognormvariate(mu, sigma))))
+    except ValueError:
+        pass
+    raise ValueError(f"Phân bố kích thước không hợp lệ: '{spec}'")
+
+def read_proc_io() -> Optional[Dict[str, int]]:
+    try:
+        with open('/proc/self/io', 'r') as f:
+            return {key: int(value) for key, value in (line.split(': ') for line in f)}
+    except OSError:
+        return None
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def measure(fs: FileSystem, operations: List[Callable[[], None]], total_bytes: int) -> dict:
+    global _counting, _open_count
+    fs.metrics.reset()
+    io_before = read_proc_io()
+    _open_count = 0
+    _counting = True
+    start = time.perf_counter()
+    # FileSystem reports every operation on stdout
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for operation in operations:
+            operation()
+    elapsed = time.perf_counter() - start
+    _counting = False
+    io_after = read_proc_io()
+    result = {
+        'count': len(operations),
+        'seconds': elapsed,
+        'ops_per_sec': len(operations) / elapsed if elapsed else None,
+        'mb_per_sec': total_bytes / (1024 * 1024) / elapsed if elapsed and total_bytes else None,
+        'opens': _open_count,
+        'read_syscalls': None,
+        'write_syscalls': None,
+        'process_peak_rss_mb': peak_rss_mb(),
+        'stats': fs.stats(),
+    }
+    if io_before and io_after:
+        result['read_syscalls'] = io_after['syscr'] - io_before['syscr']
+        result['write_syscalls'] = io_after['syscw'] - io_before['syscw']
+    return result
+
+def write_source_files(directory: str, prefix: str, count: int, sizes: Callable[[], int], rng: random.Random) -> List[str]:
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"{prefix}{i}")
+        with open(path, 'wb') as f:
+            f.write(rng.randbytes(sizes()))
+        paths.append(path)
+    return paths
+
+# Number of contiguous runs of blocks in the chains of the files
+def fragmentation(fs: FileSystem) -> dict:
+    extents = []
+    for entry in fs.list_files():
+        blocks = fs.data_chain_blocks(entry.first_block)
+        if blocks:
+            extents.append(1 + sum(1 for a, b in zip(blocks, blocks[1:]) if b != a + 1))
+    return {
+        'files': len(extents),
+        'mean_extents': sum(extents) / len(extents) if extents else 0.0,
+        'max_extents': max(extents, default=0),
+        'data_blocks': fs.data_block_count(),
+    }
+
+# Fill the volume and replace half of its files at random, round after round, so free space ends up scattered
+def age_volume(fs: FileSystem, directory: str, args, sizes: Callable[[], int], rng: random.Random):
+    names = {}
+    for path in write_source_files(directory, 'age', args.age_files, sizes, rng):
+        names[os.path.basename(path)] = path
+        fs.add_file(path, os.path.basename(path), args.password, args.compression, args.dedup, args.block_hashes)
+    for round_number in range(args.age_rounds):
+        for name in rng.sample(sorted(names), len(names) // 2):
+            fs.delete_file(name)
+            os.remove(names.pop(name))
+        for path in write_source_files(directory, f"age{round_number}_", args.age_files - len(names), sizes, rng):
+            names[os.path.basename(path)] = path
+            fs.add_file(path, os.path.basename(path), args.password, args.compression, args.dedup, args.block_hashes)
+
+def run_scenario(scenario: str, workdir: str, args) -> dict:
+    rng = random.Random(f"{args.seed}:{scenario}")
+    sizes = size_generator(args.sizes, rng)
+    directory = os.path.join(workdir, scenario)
+    # A --workdir used before keeps the volume of the last run, each scenario starts from an empty directory
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    fs = FileSystem(os.path.join(directory, "MyFS.dat"), metadata_path=os.path.join(directory, "metadata.dat"),
+                    kdf_iterations=args.kdf_iterations, metrics=True)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            if scenario == 'aged':
+                age_volume(fs, os.path.join(directory, 'age'), args, sizes, rng)
+        sources = write_source_files(os.path.join(directory, 'source'), 'f', args.files, sizes, rng)
+        names = [os.path.basename(path) for path in sources]
+        total_bytes = sum(os.path.getsize(path) for path in sources)
+        export_dir = os.path.join(directory, 'export')
+        os.makedirs(export_dir)
+        new_password = args.password + "-new" if args.password else None
+
+        operations = {}
+        operations['add_file'] = measure(fs, [
+            lambda path=path, name=name: fs.add_file(path, name, args.password, args.compression, args.dedup, args.block_hashes)
+            for path, name in zip(sources, names)], total_bytes)
+        layout = fragmentation(fs)
+        operations['list_files'] = measure(fs, [fs.list_files] * args.list_repeats, 0)
+        operations['export_file'] = measure(fs, [
+            lambda name=name: fs.export_file(name, os.path.join(export_dir, name), args.password) for name in names], total_bytes)
+        operations['reset_password'] = measure(fs, [
+            lambda name=name: fs.reset_password(name, args.password, new_password) for name in names], 0)
+        operations['delete_file'] = measure(fs, [lambda name=name: fs.delete_file(name) for name in names], total_bytes)
+        return {'files': len(names), 'bytes': total_bytes, 'fragmentation': layout, 'operations': operations}
+    finally:
+        fs.close()
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+    regressions = []
+    for scenario, result in results['scenarios'].items():
+        for operation, measured in result['operations'].items():
+            before = baseline.get('scenarios', {}).get(scenario, {}).get('operations', {}).get(operation)
+            if not before or not before.get('ops_per_sec') or not measured.get('ops_per_sec'):
+                continue
+            change = measured['ops_per_sec'] / before['ops_per_sec'] - 1
+            print(f"{scenario:6} {operation:15} {before['ops_per_sec']:10.1f} -> {measured['ops_per_sec']:10.1f} ops/s ({change:+.1%})")
+            if change < -threshold:
+                regressions.append(f"{scenario}/{operation}: {change:+.1%}")
+    return regressions
+
+def print_results(results: dict):
+    for scenario, result in results['scenarios'].items():
+        layout = result['fragmentation']
+        print(f"[{scenario}] {result['files']} tập tin, {result['bytes'] / (1024 * 1024):.1f} MB, "
+              f"trung bình {layout['mean_extents']:.2f} đoạn/tập tin (tối đa {layout['max_extents']})")
+        for operation, measured in result['operations'].items():
+            mb_per_sec = f"{measured['mb_per_sec']:8.1f} MB/s" if measured['mb_per_sec'] else " " * 13
+            syscalls = "" if measured['read_syscalls'] is None else f", syscall r/w {measured['read_syscalls']}/{measured['write_syscalls']}"
+            rss = "" if measured['process_peak_rss_mb'] is None else f", RSS đỉnh tiến trình {measured['process_peak_rss_mb']:.1f} MB"
+            print(f"  {operation:15} {measured['ops_per_sec']:10.1f} ops/s {mb_per_sec}  open {measured['opens']}{syscalls}{rss}")
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='benchmark', description="Đo hiệu năng MyFS")
+    parser.add_argument('--files', type=int, default=40, help="Số tập tin đo mỗi kịch bản")
+    parser.add_argument('--sizes', default='lognormal:65536,1.0', help="fixed:SIZE, uniform:MIN-MAX hoặc lognormal:MEDIAN,SIGMA")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="Các kịch bản, cách nhau bởi dấu phẩy")
+    parser.add_argument('--age-files', type=int, default=40, help="Số tập tin giữ trên volume 'aged'")
+    parser.add_argument('--age-rounds', type=int, default=5, help="Số lượt thay một nửa số tập tin của volume 'aged'")
+    parser.add_argument('--list-repeats', type=int, default=100)
+    parser.add_argument('--password', default='benchmark', help="Mật khẩu tập tin, chuỗi rỗng để không mã hóa")
+    parser.add_argument('--kdf-iterations', type=int, default=DEFAULT_KDF_ITERATIONS)
+    parser.add_argument('--compression', choices=[name for name in COMPRESSION_METHODS if name])
+    parser.add_argument('--dedup', action='store_true')
+    parser.add_argument('--block-hashes', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help="Thư mục tạo volume, mặc định là thư mục tạm (bị xóa sau khi đo)")
+    parser.add_argument('--output', help="Lưu kết quả JSON")
+    parser.add_argument('--compare', help="Kết quả JSON của lần đo trước")
+    parser.add_argument('--threshold', type=float, default=0.10, help="Mức giảm ops/s bị coi là chậm đi")
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    args.password = args.password or None
+    scenarios = [scenario for scenario in args.scenarios.split(',') if scenario]
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            raise ValueError(f"Kịch bản không hợp lệ: '{scenario}'")
+    entries_needed = args.files + (args.age_files if 'aged' in scenarios else 0)
+    entry_count = len(TABLE_TYPES) * ENTRY_TABLE_SIZE  # The backup table takes the entries the main table has no room for
+    if entries_needed > entry_count - RESERVED_ENTRIES:
+        raise ValueError(f"Volume chỉ có {entry_count} entry, --files + --age-files phải nhỏ hơn {entry_count - RESERVED_ENTRIES + 1}.")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='myfs-benchmark-')
+    try:
+        results = {
+            'version': RESULT_VERSION,
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'workdir')},
+            'platform': {'python': platform.python_version(), 'system': platform.system(), 'machine': platform.machine()},
+            'scenarios': {scenario: run_scenario(scenario, workdir, args) for scenario in scenarios},
+        }
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    results['config']['password'] = bool(args.password)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("Chậm hơn lần đo trước: " + ", ".join(regressions))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -28,7 +28,9 @@ def cli():
         elif not os.path.exists(directory):
             print("Thư mục không tồn tại")
             return ERROR_CODE
-        fs = FileSystem(os.path.join(directory, "MyFS.dat"), metadata_path="metadata.dat")
+        if fs != None:
+            fs.close()
+        fs = FileSystem(os.path.join(directory, "MyFS.dat"), metadata_path="metadata.dat", lazy=True)
         return 1
     elif choice == '2':
         print("Mở volume MyFS.Dat")
@@ -38,7 +40,9 @@ def cli():
         elif not os.path.exists(directory):
             print("Volume không tồn tại")
             return ERROR_CODE
-        fs = FileSystem(os.path.join(directory, "MyFS.dat"), metadata_path="metadata.dat")
+        if fs != None:
+            fs.close()
+        fs = FileSystem(os.path.join(directory, "MyFS.dat"), metadata_path="metadata.dat", lazy=True)
 
         # Check volume's metadata and the current running machine to see if they match
         # If they don't match, the program will exit
@@ -66,9 +70,13 @@ def cli():
             print("Volume MyFS chưa được mở, vui lòng mở/tạo volume bằng chức năng 1 hoặc 2")
             return ERROR_CODE
         print("Liệt kê danh sách các tập tin trong MyFS")
-        files = fs.list_files()
+        directory = input("Nhập thư mục cần liệt kê, mặc định thư mục gốc: ")
+        files = fs.list_directory(directory or PATH_SEPARATOR)
         print("List of files:")
         for index, file in enumerate(files, start=1):
+            if file.flags & ENTRY_FLAG_DIRECTORY:
+                print(f"{index}. " + f"Thư mục: {file.filename}/")
+                continue
             print(f"{index}. " + f"Tên tập tin trong MyFS: {file.filename}," + f" Kích thước ban đầu: {file.original_size} bytes," + 
                   f" Kích thước đã mã hóa: {file.encrypted_size} bytes, Ngày tạo: {parse(file.creation_date).strftime('%Y-%m-%d %H:%M:%S')}"
                   + f", Ngày sửa gần nhất: {parse(file.modification_date).strftime('%Y-%m-%d %H:%M:%S')}")
@@ -77,13 +85,17 @@ def cli():
             print("Volume MyFS chưa được mở, vui lòng mở/tạo volume bằng chức năng 1 hoặc 2")
             return ERROR_CODE
         print("Thêm tập tin vào MyFS")
-        filename = input("Nhập đường dẫn tập tin cần thêm vào MyFS: ")
+        filename = input("Nhập đường dẫn tập tin hoặc thư mục cần thêm vào MyFS: ")
         if not os.path.exists(filename):
             print("Tập tin không tồn tại")
             return ERROR_CODE
-        filename_in_myfs = input("Nhập tên tập tin trong MyFS, tối đa 32 ký tự: ")
+        filename_in_myfs = input("Nhập đường dẫn trong MyFS (thư mục cách nhau bởi '/', mỗi tên tối đa 32 ký tự): ")
         file_password = input("Nhập mật khẩu truy xuất cho tập tin: ")
-        fs.add_file(filename, filename_in_myfs, file_password)
+        compression = input("Nén tập tin (zlib/lzma, để trống nếu không nén): ")
+        if os.path.isdir(filename):
+            fs.add_directory(filename, filename_in_myfs, file_password, compression or None)
+        else:
+            fs.add_file(filename, filename_in_myfs, file_password, compression or None)
     elif choice == '6':
         if fs == None:
             print("Volume MyFS chưa được mở, vui lòng mở/tạo volume bằng chức năng 1 hoặc 2")
@@ -102,7 +114,11 @@ def cli():
         filename_in_myfs = input("Nhập tên tập tin trong MyFS: ")
         filename = input("Nhập đường dẫn tập tin cần chép ra (mặc định là đường dẫn lúc chép vào MyFS): ")
         file_password = input("Nhập mật khẩu truy xuất cho tập tin: ")
-        fs.export_file(filename_in_myfs, filename, file_password)
+        entry_info = fs.find_entry(filename_in_myfs)
+        if entry_info and entry_info[2].flags & ENTRY_FLAG_DIRECTORY:
+            fs.export_directory(filename_in_myfs, filename, file_password)
+        else:
+            fs.export_file(filename_in_myfs, filename, file_password)
     elif choice == '8':
         if fs == None:
             print("Volume MyFS chưa được mở, vui lòng mở/tạo volume bằng chức năng 1 hoặc 2")
@@ -112,6 +128,8 @@ def cli():
         fs.delete_file(filename_in_myfs)
     elif choice == '9':
         print("Thoát")
+        if fs != None:
+            fs.close()
         return EXIT_CODE
     
 def main_program():
@@ -0,0 +1,57 @@
+import lzma
+import struct
+import zlib
+
+# Nén nội dung tập tin theo từng chunk trước khi mã hóa
+# Nội dung lưu trong MyFS là chuỗi các frame: header (FRAME_HEADER) + dữ liệu của chunk
+# Chunk nào nén không nhỏ hơn thì được lưu nguyên (flags = COMPRESSION_NONE)
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+COMPRESSION_METHODS = {None: COMPRESSION_NONE, 'zlib': COMPRESSION_ZLIB, 'lzma': COMPRESSION_LZMA}
+COMPRESSION_CHUNK_SIZE = 64 * 1024  # bytes of plaintext per frame
+FRAME_HEADER = struct.Struct('>BII')  # flags (codec of this chunk), original size, stored size
+
+def compression_method(name: str | None) -> int:
+    if name not in COMPRESSION_METHODS:
+        raise ValueError(f"Phương thức nén không hỗ trợ: '{name}'")
+    return COMPRESSION_METHODS[name]
+
+def compress_chunk(method: int, chunk: bytes) -> bytes:
+    if method == COMPRESSION_ZLIB:
+        packed = zlib.compress(chunk)
+    elif method == COMPRESSION_LZMA:
+        packed = lzma.compress(chunk)
+    else:
+        packed = chunk
+    # Skip compression for chunks that don't shrink
+    flags = method
+    if len(packed) >= len(chunk):
+        flags, packed = COMPRESSION_NONE, chunk
+    return FRAME_HEADER.pack(flags, len(chunk), len(packed)) + packed
+
+def decompress_chunk(flags: int, data: bytes) -> bytes:
+    if flags == COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    elif flags == COMPRESSION_LZMA:
+        return lzma.decompress(data)
+    elif flags == COMPRESSION_NONE:
+        return data
+    raise Exception("Frame nén không hợp lệ. Tập tin có thể bị hư hỏng.")
+
+def compress_data(method: int, data: bytes) -> bytes:
+    return b''.join(compress_chunk(method, data[i:i + COMPRESSION_CHUNK_SIZE]) for i in range(0, len(data), COMPRESSION_CHUNK_SIZE))
+
+def decompress_data(payload: bytes) -> bytes:
+    chunks = []
+    offset = 0
+    while offset < len(payload):
+        flags, original_size, stored_size = FRAME_HEADER.unpack_from(payload, offset)
+        offset += FRAME_HEADER.size
+        chunk = decompress_chunk(flags, payload[offset:offset + stored_size])
+        if len(chunk) != original_size:
+            raise Exception("Frame nén không hợp lệ. Tập tin có thể bị hư hỏng.")
+        chunks.append(chunk)
+        offset += stored_size
+    return b''.join(chunks)
@@ -1,9 +1,18 @@
 from Crypto.Cipher import AES
-from Crypto.Hash import SHA256, MD5
+from Crypto.Hash import HMAC, SHA1, SHA256, MD5
 from Crypto.Protocol.KDF import PBKDF2
 from Crypto.Random import get_random_bytes
+import threading
+import time
+from metrics import NULL_METRICS
 
 MAX_FILENAME_LENGTH = 32
+KDF_SALT_SIZE = 16
+DATA_KEY_SIZE = 32
+DEFAULT_KDF_ITERATIONS = 100000
+# Salt and iteration count used before they were stored per file, entries with 0 iterations still use them
+LEGACY_KDF_SALT = b'IVOLFILESYSTEM'
+LEGACY_KDF_ITERATIONS = 10
 
 def pad_filename(name: str) -> bytes:
     name_bytes = name.encode('ascii')[:MAX_FILENAME_LENGTH]
@@ -21,12 +30,95 @@ def hash_md5(data: bytes) -> bytes:
     hash_obj = MD5.new(data=data)
     return hash_obj.digest()
 
-def derive_aes_key(password_hash: bytes) -> bytes:
-    # Derive a 32-byte AES key from the SHA256 hash using PBKDF2
-    salt = b'IVOLFILESYSTEM'  # In a real system, use a unique salt per password and store it securely
-    key = PBKDF2(password_hash, salt, dkLen=32, count=10)
+def derive_aes_key(password_hash: bytes, salt: bytes = LEGACY_KDF_SALT, iterations: int = LEGACY_KDF_ITERATIONS) -> bytes:
+    # Derive a 32-byte AES key from the SHA256 hash using PBKDF2 (HMAC-SHA1, the default of the legacy format)
+    key = PBKDF2(password_hash, salt, dkLen=32, count=iterations, hmac_hash_module=SHA1)
     return key
 
+# Key of the entries with a per-file salt: PBKDF2 over the password itself, the entry only stores password_verifier()
+def derive_password_key(password: str, salt: bytes, iterations: int) -> bytes:
+    return PBKDF2(password.encode('utf-8'), salt, dkLen=32, count=iterations, hmac_hash_module=SHA256)
+
+# Stored in place of the password hash, tells whether a derived key is the right one without revealing it
+def password_verifier(key: bytes) -> bytes:
+    return HMAC.new(key, b'verify', digestmod=SHA256).digest()
+
+def new_kdf_salt() -> bytes:
+    return get_random_bytes(KDF_SALT_SIZE)
+
+# Cache of derived AES keys for one session, so PBKDF2 only runs once per (password, salt, iterations)
+# Keys expire after `ttl` seconds. The cache overwrites its own copy of a key with zeros when it drops it, the copies
+# returned by derive() are ordinary bytes objects owned by the callers and are not wiped
+# The cache is shared by the reader threads of a volume, the dictionary is only touched under `lock`; PBKDF2 runs
+# outside of it so threads deriving different keys don't wait for each other
+class KeyCache:
+    def __init__(self, ttl: float = 300.0, metrics=NULL_METRICS):
+        self.ttl = ttl
+        self.keys = {}  # lookup id -> (key, expiry time)
+        self.metrics = metrics
+        self.lock = threading.Lock()
+
+    # Key of a legacy entry, derived from the SHA256 of the password
+    def derive(self, password_hash: bytes, salt: bytes = LEGACY_KDF_SALT, iterations: int = LEGACY_KDF_ITERATIONS) -> bytes:
+        # The password hash itself is not kept as a dictionary key
+        lookup = hash_sha256_bytes(password_hash + salt + iterations.to_bytes(4, 'big'))
+        return self._derive(lookup, lambda: derive_aes_key(password_hash, salt, iterations))
+
+    # Key of an entry with a per-file salt, derived from the password itself
+    def derive_password(self, password: str, salt: bytes, iterations: int) -> bytes:
+        lookup = hash_sha256_bytes(b'password' + password.encode('utf-8') + salt + iterations.to_bytes(4, 'big'))
+        return self._derive(lookup, lambda: derive_password_key(password, salt, iterations))
+
+    def _derive(self, lookup: bytes, kdf) -> bytes:
+        now = time.monotonic()
+        with self.lock:
+            self._purge(now)
+            cached = self.keys.get(lookup)
+            if cached:
+                self.metrics.add('kdf_cache_hits')
+                return bytes(cached[0])
+        with self.metrics.timer('kdf'):
+            key = bytearray(kdf())
+        result = bytes(key)
+        with self.lock:
+            # Another thread may have derived the same key meanwhile, its copy is replaced
+            previous = self.keys.get(lookup)
+            self.keys[lookup] = (key, now + self.ttl)
+        if previous:
+            zeroize(previous[0])
+        return result
+
+    def purge(self, now: float | None = None):
+        with self.lock:
+            self._purge(time.monotonic() if now is None else now)
+
+    def _purge(self, now: float):
+        for lookup in [lookup for lookup, (_, expiry) in self.keys.items() if expiry <= now]:
+            zeroize(self.keys.pop(lookup)[0])
+
+    def clear(self):
+        with self.lock:
+            for key, _ in self.keys.values():
+                zeroize(key)
+            self.keys.clear()
+
+# Envelope encryption: file content is encrypted with a random data key, only the data key is
+# encrypted (wrapped) with the key derived from the password
+def new_data_key() -> bytes:
+    return get_random_bytes(DATA_KEY_SIZE)
+
+def wrap_key(key_encryption_key: bytes, data_key: bytes) -> bytes:
+    # The data key is a multiple of the AES block size, no padding is needed
+    cipher = AES.new(key_encryption_key, AES.MODE_ECB)
+    return cipher.encrypt(data_key)
+
+def unwrap_key(key_encryption_key: bytes, wrapped_key: bytes) -> bytes:
+    cipher = AES.new(key_encryption_key, AES.MODE_ECB)
+    return cipher.decrypt(wrapped_key)
+
+def zeroize(buffer: bytearray):
+    buffer[:] = b'\x00' * len(buffer)
+
 def encrypt_data(aes_key: bytes, data: bytes) -> bytes:
     # AES encryption in ECB mode
     cipher = AES.new(aes_key, AES.MODE_ECB)
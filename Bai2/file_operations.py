@@ -1,11 +1,26 @@
+import bisect
+import contextlib
+import functools
+import heapq
+import hmac
+import io
 import os
+import shutil
 import struct
+import tarfile
+import threading
+import time
+import zipfile
 import hashlib
 import datetime
 from dateutil.parser import parse as date_parse
-from schema import PlatformMetadata
+from schema import PlatformMetadata, metadata_digest
 from typing import Optional, List, Tuple
 from encryption import *
+from compression import *
+from integrity import *
+from locking import *
+from metrics import *
 from Crypto.Cipher import AES
 from Crypto.Hash import SHA256, MD5
 from Crypto.Protocol.KDF import PBKDF2
@@ -17,49 +32,170 @@ from Crypto.Random import get_random_bytes
 
 # Constants
 VOLUME_INFO_SIZE = 88  # bytes
-ENTRY_SIZE = 401        # bytes per entry
+# Layout of the volume, stored in the volume info. Version 0 is the original layout with 401-byte entries,
+# such volumes are migrated when they are opened (see FileSystem.migrate_volume)
+VOLUME_FORMAT_VERSION = 1
+# status, first block, filename, creation date, modification date, password hash, MD5, encrypted size, original size,
+# root dir, KDF salt, KDF iterations, wrapped data key, compression, flags, first block of the hash list, hash list root,
+# then 17 reserved bytes (zero) so later fields don't move the entry tables again
+ENTRY_LAYOUT = struct.Struct(f'>B8s32s20s20s32s16sQQ256s{KDF_SALT_SIZE}sI{DATA_KEY_SIZE}sBB8s{HASH_SIZE}s17x')
+ENTRY_SIZE = ENTRY_LAYOUT.size  # 512 bytes per entry
+LEGACY_ENTRY_SIZE = 401  # Entry of format version 0: the fields up to root dir
+LEGACY_BLOCK_CONTENT_SIZE = 4086  # Content bytes per block of the chains written by reset_password in format version 0
 ENTRY_TABLE_SIZE = 100  # entries per table
 MAIN_ENTRY_TABLE_OFFSET = VOLUME_INFO_SIZE
 BACKUP_ENTRY_TABLE_OFFSET = VOLUME_INFO_SIZE + ENTRY_SIZE * ENTRY_TABLE_SIZE
 DATA_TABLE_OFFSET = VOLUME_INFO_SIZE + 2 * ENTRY_SIZE * ENTRY_TABLE_SIZE
+LEGACY_DATA_TABLE_OFFSET = VOLUME_INFO_SIZE + 2 * LEGACY_ENTRY_SIZE * ENTRY_TABLE_SIZE
 DATA_BLOCK_SIZE = 4096   # bytes
+DATA_BLOCK_HEADER = struct.Struct('>B8s')  # status, next block address
+DATA_BLOCK_HEADER_SIZE = DATA_BLOCK_HEADER.size  # 9 bytes
+DATA_BLOCK_CONTENT_SIZE = DATA_BLOCK_SIZE - DATA_BLOCK_HEADER_SIZE  # 4087 bytes
 MAX_FILENAME_LENGTH = 32
+VOLUME_GROWTH_BLOCKS = 256  # Data blocks added each time the volume file grows (1 MiB)
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
+# Entry status of internal files (e.g. the chunk index), hidden from find_entry() and list_files()
+SYSTEM_ENTRY_STATUS = 0x03
+CHUNK_INDEX_FILENAME = '.chunks'
+
+# Entry flags
+ENTRY_FLAG_DEDUP = 0x01  # Content is a list of chunk records, the chunks are stored once in the volume and shared
+ENTRY_FLAG_BLOCK_HASHES = 0x02  # A SHA-256 hash (HMAC-SHA256 keyed by the content key if encrypted) of every content block is stored in a separate chain (hash_block)
+ENTRY_FLAG_DIRECTORY = 0x04  # Content is the children index of a directory (DIRECTORY_RECORD list)
+ENTRY_FLAG_NESTED = 0x08  # Entry is a child of a directory, not of the root (the flat namespace of older volumes)
+ENTRY_FLAG_LEGACY_LAYOUT = 0x10  # Migrated chain that fits both block layouts of format version 0, settled by the first read with the password
+
+# Directories: a path is split on PATH_SEPARATOR, the first component is looked up in the root and each following one
+# in the children index of its parent, so resolving a path reads one index per level instead of scanning the tables
+PATH_SEPARATOR = '/'
+TABLE_TYPES = ('main', 'backup')
+DIRECTORY_RECORD = struct.Struct('>BH32s')  # table of the child entry (index in TABLE_TYPES), entry index, name
+
+# Deduplicated content: plaintext chunks fit in one data block, each chunk is encrypted with a key
+# derived from its own content so identical chunks of any file give the same block
+DEDUP_CHUNK_SIZE = DATA_BLOCK_CONTENT_SIZE - DATA_BLOCK_CONTENT_SIZE % 16  # 4080 bytes
+DEDUP_RECORD = struct.Struct('>QH32s')  # block index, chunk size, chunk key
+CHUNK_INDEX_RECORD = struct.Struct('>32sQI')  # chunk id (hash of the chunk key), block index, reference count
+
+# Snapshots: a snapshot is a copy of both entry tables written to its own chain, listed in the SNAPSHOT_INDEX_FILENAME
+# system entry. The files share their chains with the live tables, a chain kept by a snapshot is never freed or
+# rewritten in place: the live file gets a new chain instead, and the snapshot keeps the chunk references of its records
+SNAPSHOT_INDEX_FILENAME = '.snapshots'
+SNAPSHOT_RECORD = struct.Struct('>32s20s8s')  # name, creation date, first block of the copied entry tables
+SNAPSHOT_TABLES_SIZE = 2 * ENTRY_SIZE * ENTRY_TABLE_SIZE
+
 # Special Addresses (Start data block address of an unused entry, and the next data block address of the last block of each entry)
 ALL_ONES_ADDRESS = b'\xFF' * 8
 ALL_ONES_ADDRESS_INT = 0xFFFFFFFFFFFFFFFF
 
+# Archive formats of export_archive() -> tarfile stream mode, or None for zip
+ARCHIVE_FORMATS = {'tar': 'w|', 'tar.gz': 'w|gz', 'zip': None}
+ARCHIVE_COPY_SIZE = 256 * 1024  # Bytes of plaintext copied at a time into the archive
+ZIP_MIN_DATE = (1980, 1, 1, 0, 0, 0)  # Earliest date a zip entry can hold
+
 # Helper Functions
 
 #Function to create ISO 8601 formatted date string
 def current_iso8601() -> str:
     return datetime.datetime.now(datetime.timezone.utc).strftime(DATE_FORMAT)
 
+def split_path(path: str) -> List[str]:
+    parts = [part for part in path.split(PATH_SEPARATOR) if part]
+    if any(part in ('.', '..') for part in parts):
+        raise ValueError(f"Đường dẫn không hợp lệ: '{path}'")
+    return parts
+
+# Size of the plaintext blocks covered by one hash of the block hash list, one hash per data block for
+# stored content, one per chunk for deduplicated content and one per frame for compressed content
+def integrity_block_size(compression: int, flags: int) -> int:
+    if flags & ENTRY_FLAG_DEDUP:
+        return DEDUP_CHUNK_SIZE
+    if compression:
+        return COMPRESSION_CHUNK_SIZE
+    return DATA_BLOCK_CONTENT_SIZE
+
 
 # Class storing and managing MyFS's volume information
 class VolumeInfo:
-    def __init__(self, signature: bytes = b'IVOLFILE', volume_size: int = 0, metadata_encryption_key: bytes = b'\x00' * 32, machine_info_hash: bytes = b'\x00' * 32):
+    def __init__(self, signature: bytes = b'IVOLFILE', volume_size: int = 0, metadata_encryption_key: bytes = b'\x00' * 32, machine_info_hash: bytes = b'\x00' * 32,
+                 format_version: int = VOLUME_FORMAT_VERSION):
         self.signature = signature.ljust(8, b'\x00')[:8]
-        self.volume_size = volume_size  # 16 bytes, but we'll store as two unsigned long longs
+        self.volume_size = volume_size
         self.encryption_key = metadata_encryption_key  # 32-byte key to encrypt metadata in volume Y
         self.machine_info_hash = machine_info_hash  # Hash of machine info
+        self.format_version = format_version
 
     def pack(self) -> bytes:
-        # Pack signature (8 bytes) + volume_size (16 bytes as two unsigned long longs)
-        return self.signature + struct.pack('>QQ', self.volume_size, 0) + self.encryption_key + self.machine_info_hash
+        # Pack signature (8 bytes) + volume_size (8 bytes) + format version (8 bytes)
+        # The original layout stored the size in 16 bytes with the high 8 bytes always zero, they now hold the version
+        return self.signature + struct.pack('>QQ', self.volume_size, self.format_version) + self.encryption_key + self.machine_info_hash
 
     @staticmethod
     def unpack(data: bytes):
         signature = data[:8]
-        volume_size1, volume_size2 = struct.unpack('>QQ', data[8:24])
-        volume_size = volume_size1 + (volume_size2 << 64)  # Combine two parts
+        volume_size, format_version = struct.unpack('>QQ', data[8:24])
         encryption_key = data[24:56]
         machine_info_hash = data[56:88]
-        return VolumeInfo(signature, volume_size, encryption_key, machine_info_hash)
+        return VolumeInfo(signature, volume_size, encryption_key, machine_info_hash, format_version)
+
+# Field of an entry, read from and written to the entry's bytes in place
+class EntryField:
+    __slots__ = ('offset', 'layout')
+
+    def __init__(self, offset: int, fmt: str):
+        self.offset = offset
+        self.layout = struct.Struct('>' + fmt)
+
+    def __get__(self, entry, owner=None):
+        if entry is None:
+            return self
+        return self.layout.unpack_from(entry._buffer, entry._offset + self.offset)[0]
+
+    def __set__(self, entry, value):
+        self.layout.pack_into(entry._buffer, entry._offset + self.offset, value)
+
+# ASCII text field padded with zeros, an empty root_dir reads as None
+class TextField(EntryField):
+    __slots__ = ('empty',)
+
+    def __init__(self, offset: int, size: int, empty: str | None = ""):
+        super().__init__(offset, f'{size}s')
+        self.empty = empty
+
+    def __get__(self, entry, owner=None):
+        if entry is None:
+            return self
+        value = super().__get__(entry).rstrip(b'\x00')
+        return value.decode('ascii') if value else self.empty
+
+    def __set__(self, entry, value):
+        super().__set__(entry, value.encode('ascii') if value else b'')
 
 # Class representing an entry in the Entry Table
+# An entry is a view over its ENTRY_SIZE bytes (its own buffer, or the buffer of the entry table it belongs to),
+# fields are decoded when read and encoded when assigned
 class Entry:
+    __slots__ = ('_buffer', '_offset')
+
+    status = EntryField(0, 'B')
+    first_block = EntryField(1, '8s')
+    filename = TextField(9, MAX_FILENAME_LENGTH)
+    creation_date = TextField(41, 20)
+    modification_date = TextField(61, 20)
+    password_hash = EntryField(81, '32s')
+    md5_hash = EntryField(113, '16s')
+    encrypted_size = EntryField(129, 'Q')
+    original_size = EntryField(137, 'Q')
+    root_dir = TextField(145, 256, empty=None)
+    kdf_salt = EntryField(401, f'{KDF_SALT_SIZE}s')  # Per-file PBKDF2 salt
+    kdf_iterations = EntryField(417, 'I')  # 0 means the entry was created with the legacy fixed salt
+    wrapped_key = EntryField(421, f'{DATA_KEY_SIZE}s')  # Data key encrypted with the password key, all zeros if the content uses the password key directly
+    compression = EntryField(453, 'B')  # Compression method of the content frames, COMPRESSION_NONE if stored as is
+    flags = EntryField(454, 'B')  # ENTRY_FLAG_* bits
+    hash_block = EntryField(455, '8s')  # First block of the block hash list
+    hash_root = EntryField(463, f'{HASH_SIZE}s')  # SHA-256 of the block hash list
+
     def __init__(self,
                  status: int = 0x00,
                  first_block: bytes = ALL_ONES_ADDRESS,
@@ -70,104 +206,724 @@ class Entry:
                  md5_hash: bytes = b'\x00' * 16,
                  encrypted_size: int = 0,
                  original_size: int = 0,
-                 root_dir: str | None = "" ):
-        self.status = status
-        self.first_block = first_block
-        self.filename = filename
-        self.creation_date = creation_date or current_iso8601()
-        self.modification_date = modification_date or current_iso8601()
-        self.password_hash = password_hash
-        self.md5_hash = md5_hash
-        self.encrypted_size = encrypted_size
-        self.original_size = original_size
-        self.root_dir = root_dir
+                 root_dir: str | None = "",
+                 kdf_salt: bytes = b'\x00' * KDF_SALT_SIZE,
+                 kdf_iterations: int = 0,
+                 wrapped_key: bytes = b'\x00' * DATA_KEY_SIZE,
+                 compression: int = COMPRESSION_NONE,
+                 flags: int = 0x00,
+                 hash_block: bytes = ALL_ONES_ADDRESS,
+                 hash_root: bytes = b'\x00' * HASH_SIZE):
+        self._buffer = bytearray(ENTRY_SIZE)
+        self._offset = 0
+        ENTRY_LAYOUT.pack_into(self._buffer, 0, status, first_block, pad_filename(filename),
+                               (creation_date or current_iso8601()).encode('ascii'),
+                               (modification_date or current_iso8601()).encode('ascii'),
+                               password_hash, md5_hash, encrypted_size, original_size,
+                               root_dir.encode('ascii') if root_dir else b'',
+                               kdf_salt, kdf_iterations, wrapped_key, compression, flags, hash_block, hash_root)
+
+    # Entry over ENTRY_SIZE bytes of an existing buffer, nothing is copied or decoded
+    @staticmethod
+    def view(buffer: bytearray, offset: int = 0) -> 'Entry':
+        entry = Entry.__new__(Entry)
+        entry._buffer = buffer
+        entry._offset = offset
+        return entry
+
+    # Salt and iteration count to derive the AES key of this entry
+    def kdf_params(self) -> Tuple[bytes, int]:
+        if self.kdf_iterations == 0:
+            return LEGACY_KDF_SALT, LEGACY_KDF_ITERATIONS
+        return self.kdf_salt, self.kdf_iterations
+
+    def integrity_block_size(self) -> int:
+        return integrity_block_size(self.compression, self.flags)
+
+    def has_wrapped_key(self) -> bool:
+        return self.wrapped_key.strip(b'\x00') != b''
 
     def pack(self) -> bytes:
-        packed = struct.pack('>B', self.status)
-        packed += self.first_block
-        packed += pad_filename(self.filename)
-        packed += self.creation_date.encode('ascii').ljust(20, b'\x00')
-        packed += self.modification_date.encode('ascii').ljust(20, b'\x00')
-        packed += self.password_hash
-        packed += self.md5_hash
-        packed += struct.pack('>Q', self.encrypted_size)
-        packed += struct.pack('>Q', self.original_size)
-        if self.root_dir:
-            packed += self.root_dir.encode('ascii').ljust(256, b'\x00')
-        else:
-            packed += b'\x00' * 256
-        return packed.ljust(401, b'\x00')  # Ensure fixed size
+        return bytes(self._buffer[self._offset:self._offset + ENTRY_SIZE])
 
     @staticmethod
     def unpack(data: bytes):
-        status = data[0]
-        first_block = data[1:9]
-        filename = data[9:41].rstrip(b'\x00').decode('ascii')
-        creation_date = data[41:61].decode('ascii').rstrip('\x00')
-        modification_date = data[61:81].decode('ascii').rstrip('\x00')
-        password_hash = data[81:113]
-        md5_hash = data[113:129]
-        encrypted_size = struct.unpack('>Q', data[129:137])[0]
-        original_size = struct.unpack('>Q', data[137:145])[0]
-        if data[145:401].strip(b'\x00'):
-            root_dir = data[145:401].decode('ascii').rstrip('\x00')  # 256 bytes
-        else:
-            root_dir = None
-        return Entry(
-            status=status,
-            first_block=first_block,
-            filename=filename,
-            creation_date=creation_date,
-            modification_date=modification_date,
-            password_hash=password_hash,
-            md5_hash=md5_hash,
-            encrypted_size=encrypted_size,
-            original_size=original_size,
-            root_dir=root_dir
-        )
+        return Entry.view(bytearray(data[:ENTRY_SIZE]))
 
+# The entries of a table share one buffer, loading and saving a table is a single copy
 class EntryTable:
-    def __init__(self, entries: Optional[List[Entry]] = None):
-        self.entries = entries or [Entry() for _ in range(ENTRY_TABLE_SIZE)]
+    __slots__ = ('data', 'entries')
+
+    def __init__(self, data: Optional[bytearray] = None):
+        self.data = data if data is not None else bytearray(Entry().pack() * ENTRY_TABLE_SIZE)
+        self.entries = [Entry.view(self.data, i * ENTRY_SIZE) for i in range(ENTRY_TABLE_SIZE)]
+
+    # Copy an entry into a slot, the entry then refers to the table so later changes to it are kept
+    def store(self, entry_idx: int, entry: Entry):
+        offset = entry_idx * ENTRY_SIZE
+        if entry._buffer is not self.data or entry._offset != offset:
+            self.data[offset:offset + ENTRY_SIZE] = entry.pack()
+            entry._buffer, entry._offset = self.data, offset
+        self.entries[entry_idx] = entry
 
     def pack(self) -> bytes:
-        return b''.join(entry.pack() for entry in self.entries)
+        return bytes(self.data)
+
+    # First block addresses of the chains (content and block hash list) of the files and directories
+    def chains(self) -> set:
+        chains = set()
+        for entry in self.entries:
+            if entry.status == 0x01:
+                chains.add(entry.first_block)
+                if entry.flags & ENTRY_FLAG_BLOCK_HASHES:
+                    chains.add(entry.hash_block)
+        chains.discard(ALL_ONES_ADDRESS)
+        return chains
 
     @staticmethod
     def unpack(data: bytes):
-        entries = []
-        for i in range(ENTRY_TABLE_SIZE):
-            entry_data = data[i * ENTRY_SIZE:(i + 1) * ENTRY_SIZE]
-            entries.append(Entry.unpack(entry_data))
-        return EntryTable(entries)
+        return EntryTable(bytearray(data))
+
+# Refcounted index of the deduplicated chunks, stored as the content of the CHUNK_INDEX_FILENAME system entry
+class ChunkIndex:
+    def __init__(self, chunks: Optional[dict] = None):
+        self.chunks = chunks or {}  # chunk id -> [block index, reference count]
+        self.blocks = {block_index: chunk_id for chunk_id, (block_index, _) in self.chunks.items()}
+
+    # Add a reference to a stored chunk, return its block index (None if the chunk is not stored yet)
+    def reference(self, chunk_id: bytes) -> Optional[int]:
+        if chunk_id not in self.chunks:
+            return None
+        self.chunks[chunk_id][1] += 1
+        return self.chunks[chunk_id][0]
+
+    def insert(self, chunk_id: bytes, block_index: int):
+        self.chunks[chunk_id] = [block_index, 1]
+        self.blocks[block_index] = chunk_id
+
+    # Drop a reference to the chunk stored in a block, return True if the block is not used anymore
+    def release(self, block_index: int) -> bool:
+        chunk_id = self.blocks.get(block_index)
+        if chunk_id is None:
+            return False
+        self.chunks[chunk_id][1] -= 1
+        if self.chunks[chunk_id][1] > 0:
+            return False
+        del self.chunks[chunk_id]
+        del self.blocks[block_index]
+        return True
+
+    # Add a reference to the chunk stored in a block
+    def retain(self, block_index: int):
+        self.chunks[self.blocks[block_index]][1] += 1
+
+    def pack(self) -> bytes:
+        return b''.join(CHUNK_INDEX_RECORD.pack(chunk_id, block_index, refcount) for chunk_id, (block_index, refcount) in self.chunks.items())
+
+    @staticmethod
+    def unpack(data: bytes):
+        chunks = {}
+        for chunk_id, block_index, refcount in CHUNK_INDEX_RECORD.iter_unpack(data):
+            chunks[chunk_id] = [block_index, refcount]
+        return ChunkIndex(chunks)
 
 class DataBlock:
+    __slots__ = ('status', 'next_block', 'content')
+
     def __init__(self, status: int = 0x00, next_block: bytes = ALL_ONES_ADDRESS, content: bytes = b'\x00' * 4087):
         self.status = status
         self.next_block = next_block
         self.content = content
 
     def pack(self) -> bytes:
-        return struct.pack('>B', self.status) + self.next_block + self.content
+        return DATA_BLOCK_HEADER.pack(self.status, self.next_block) + self.content
 
     @staticmethod
     def unpack(data: bytes):
-        status = data[0]
-        next_block = data[1:9]
-        content = data[9:4096]
-        return DataBlock(status, next_block, content)
+        status, next_block = DATA_BLOCK_HEADER.unpack_from(data)
+        return DataBlock(status, next_block, data[DATA_BLOCK_HEADER_SIZE:DATA_BLOCK_SIZE])
+
+# Read count consecutive data blocks with one vectored read, blocks past the end of the volume are left out
+def read_block_run(f, start: int, count: int) -> List[bytes]:
+    offset = DATA_TABLE_OFFSET + start * DATA_BLOCK_SIZE
+    if hasattr(os, 'preadv'):
+        buffers = [bytearray(DATA_BLOCK_SIZE) for _ in range(count)]
+        size = os.preadv(f.fileno(), buffers, offset)
+        return [bytes(buffer) for buffer in buffers[:size // DATA_BLOCK_SIZE]]
+    f.seek(offset)
+    data = f.read(count * DATA_BLOCK_SIZE)
+    return [data[i:i + DATA_BLOCK_SIZE] for i in range(0, len(data) - DATA_BLOCK_SIZE + 1, DATA_BLOCK_SIZE)]
+
+# Iterate the (block index, DataBlock) of a chain through one open volume file
+# Blocks are read in windows of consecutive blocks, so a contiguous run of the chain costs one read. The window
+# doubles while the chain stays contiguous and shrinks after a jump. When the chain leaves the window, the kernel
+# is asked to start reading the next hop in the background (posix_fadvise WILLNEED) while this window is decoded.
+# block_count (when known) bounds the read so nothing past the end of the chain is read
+class ChainReader:
+    MIN_WINDOW = 4    # blocks
+    MAX_WINDOW = 64   # blocks, 256 KiB per read
+
+    def __init__(self, fs: 'FileSystem', f, first_block: bytes, block_count: Optional[int] = None):
+        self.fs = fs
+        self.f = f
+        self.next_index = struct.unpack('>Q', first_block)[0]
+        self.remaining = block_count
+        # A chain can't have more blocks than the volume, one that does goes through a block twice: a cycle
+        self.limit = fs.data_block_count()
+        self.steps = 0
+        self.window_start = 0
+        self.window = []
+        self.used = 0  # Blocks of the current window the chain went through
+        self.window_size = self.MAX_WINDOW
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Tuple[int, DataBlock]:
+        block_index = self.next_index
+        if block_index == ALL_ONES_ADDRESS_INT or self.remaining == 0:
+            raise StopIteration
+        if self.steps >= self.limit:
+            raise Exception("Chuỗi data block của tập tin bị hỏng (vòng lặp).")
+        self.steps += 1
+        offset = block_index - self.window_start
+        if not 0 <= offset < len(self.window):
+            self._read_window(block_index)
+            offset = 0
+        self.used += 1
+        if self.remaining is not None:
+            self.remaining -= 1
+        if offset >= len(self.window):
+            # Past the end of the volume, same as read_data_block()
+            self.next_index = ALL_ONES_ADDRESS_INT
+            return block_index, DataBlock()
+        block = DataBlock.unpack(self.window[offset])
+        self.next_index = struct.unpack('>Q', block.next_block)[0]
+        return block_index, block
+
+    def _read_window(self, start: int):
+        if self.window:
+            # A chain that went through the whole window is contiguous, read further ahead next time
+            self.window_size = max(self.MIN_WINDOW, min(self.MAX_WINDOW, 2 * self.used))
+        count = self.window_size if self.remaining is None else min(self.window_size, self.remaining)
+        count = max(1, min(count, self.fs.data_block_count() - start))
+        with self.fs.metrics.timer('block_read', count * DATA_BLOCK_SIZE):
+            self.window = read_block_run(self.f, start, count)
+        self.window_start = start
+        self.used = 0
+        self.fs.metrics.add('readahead_windows')
+        self._prefetch_next_hop()
+
+    # Follow the chain inside the window, the first block outside of it is the next hop
+    def _prefetch_next_hop(self):
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        index = self.window_start
+        for _ in range(len(self.window)):
+            next_index = struct.unpack_from('>Q', self.window[index - self.window_start], 1)[0]
+            if next_index == ALL_ONES_ADDRESS_INT:
+                return
+            if not 0 <= next_index - self.window_start < len(self.window):
+                os.posix_fadvise(self.f.fileno(), DATA_TABLE_OFFSET + next_index * DATA_BLOCK_SIZE,
+                                 self.window_size * DATA_BLOCK_SIZE, os.POSIX_FADV_WILLNEED)
+                return
+            index = next_index
+
+# File-like handle over the data block chain of one entry, returned by FileSystem.open()
+# Mode 'rb': random access reads, decrypting only the AES blocks that cover the requested range
+# (for compressed entries, only the frame that covers it, for deduplicated entries, only the chunk)
+# Mode 'wb': sequential writes, compressed or deduplicated, encrypted and written block by block, the entry is saved on close()
+# (leaving a `with` block on an exception, or dropping the handle without closing it, discards the write instead)
+# A write handle holds the volume write lock from open to close, other threads wait for it; it can be closed (or
+# collected) on any thread, only the thread that opened it may use the volume while it is open
+class FileHandle(io.RawIOBase):
+    READ_WINDOW_SIZE = 16 * DATA_BLOCK_CONTENT_SIZE  # Bytes of content decoded per window refill
+
+    def __init__(self, fs: 'FileSystem', filename: str, mode: str = 'rb', password: Optional[str] = None,
+                 compression: str | None = None, dedup: bool = False, block_hashes: bool = False):
+        super().__init__()
+        if mode not in ('rb', 'wb'):
+            raise ValueError(f"Chế độ mở tập tin không hỗ trợ: '{mode}'")
+        self.fs = fs
+        self.name = filename
+        self.mode = mode
+        self._pos = 0
+
+        self._lock = contextlib.ExitStack()
+        try:
+            if mode == 'rb':
+                with fs.read_locked():
+                    self._open_read(filename, password)
+            else:
+                self._lock.enter_context(fs.write_locked())
+                self._open_write(filename, password, compression, dedup, block_hashes)
+        except BaseException:
+            self._lock.close()
+            super().close()  # Nothing to commit or release
+            raise
+
+    def _open_read(self, filename: str, password: Optional[str]):
+        fs = self.fs
+        entry_info = fs.find_entry(filename)
+        if not entry_info:
+            raise Exception("Tập tin không tồn tại.")
+        _, _, self.entry = entry_info
+        aes_key = fs.entry_aes_key(self.entry, password)
+        self._dedup = bool(self.entry.flags & ENTRY_FLAG_DEDUP)
+        # Records of deduplicated content are not encrypted as a whole, only their chunk keys
+        self._content_key = aes_key
+        self._cipher = AES.new(aes_key, AES.MODE_ECB) if aes_key and not self._dedup else None
+        self._volume = open(fs.file_path, 'rb')
+        # Block indices of the chain, discovered lazily while reading through a ChainReader (see _read_chain_content)
+        first_block = struct.unpack('>Q', self.entry.first_block)[0]
+        self._chain = [] if first_block == ALL_ONES_ADDRESS_INT else [first_block]
+        self._chain_length = -(-self.entry.encrypted_size // DATA_BLOCK_CONTENT_SIZE)
+        self._reader = ChainReader(fs, self._volume, self.entry.first_block, self._chain_length)
+        self._reader_position = 0  # Position in the chain of the next block of the reader
+        self._block_cache = {}  # position in the chain -> content, the blocks of the last reader windows
+        self._window_start = 0
+        self._window = b''
+        # Frames of a compressed entry: (original offset, stored offset, flags, original size, stored size)
+        self._frames = []
+        if self.entry.flags & ENTRY_FLAG_LEGACY_LAYOUT:
+            # Migrated chain of unknown layout, decoded as a whole (see FileSystem.read_legacy_layout)
+            self._window = fs.read_entry_content(self.entry, aes_key)
+            self._stored_size = len(self._window)
+        else:
+            self._stored_size = self._content_size()
+        self._hash_list = None  # Loaded on the first read of an entry with a block hash list
+        self._hash_key = block_hash_key(aes_key)
+
+    def _open_write(self, filename: str, password: Optional[str], compression: str | None, dedup: bool, block_hashes: bool):
+        fs = self.fs
+        existing = fs.find_entry(filename)
+        if existing and existing[2].flags & ENTRY_FLAG_DIRECTORY:
+            raise Exception(f"'{filename}' là thư mục.")
+        if not existing:
+            fs.check_new_path(filename)
+            if not fs.find_free_entry():
+                raise Exception("Không còn entry trống.")
+        self._compression = compression_method(compression)
+        if self._compression and dedup:
+            raise ValueError("Không thể vừa nén vừa khử trùng lặp nội dung tập tin.")
+        self._dedup = dedup
+        if password:
+            self._kdf_salt, self._kdf_iterations, self._content_key, self._wrapped_key, self._password_hash = fs.new_content_key(password)
+        else:
+            self._kdf_salt, self._kdf_iterations, self._wrapped_key = b'\x00' * KDF_SALT_SIZE, 0, b'\x00' * DATA_KEY_SIZE
+            self._content_key = None
+            self._password_hash = b'\x00' * 32
+        self._cipher = AES.new(self._content_key, AES.MODE_ECB) if self._content_key and not dedup else None
+        self._md5 = MD5.new()
+        self._chunk = bytearray()    # Plaintext waiting for a full compression chunk
+        self._pending = bytearray()  # Content waiting for a full 16-byte AES block
+        self._out = bytearray()      # Ciphertext waiting for a full data block
+        self._written_blocks = []
+        self._encrypted_size = 0
+        self._creation_date = current_iso8601()
+        self._block_hashes = block_hashes
+        self._hash_unit = integrity_block_size(self._compression, ENTRY_FLAG_DEDUP if dedup else 0x00)
+        self._hash_buffer = bytearray()  # Plaintext waiting for a full hashed block
+        self._hash_list = bytearray()
+        self._hash_key = block_hash_key(self._content_key)
+        self._records = bytearray()  # Chunk records of deduplicated content written so far, released on abort()
+
+    def readable(self) -> bool:
+        return self.mode == 'rb'
+
+    def writable(self) -> bool:
+        return self.mode == 'wb'
+
+    def seekable(self) -> bool:
+        return self.mode == 'rb'
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        if self.mode == 'wb':
+            # Only tell() is supported while writing
+            if offset == 0 and whence == io.SEEK_CUR:
+                return self._pos
+            raise io.UnsupportedOperation("seek")
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._pos + offset
+        elif whence == io.SEEK_END:
+            position = self.entry.original_size + offset
+        else:
+            raise ValueError(f"Giá trị whence không hợp lệ: {whence}")
+        if position < 0:
+            raise ValueError("Vị trí seek âm.")
+        self._pos = position
+        return self._pos
+
+    def tell(self) -> int:
+        return self.seek(0, io.SEEK_CUR)
+
+    def readinto(self, buffer) -> int:
+        if self.mode != 'rb':
+            raise io.UnsupportedOperation("read")
+        if self._pos >= self.entry.original_size or len(buffer) == 0:
+            return 0
+        window_offset = self._pos - self._window_start
+        if not 0 <= window_offset < len(self._window):
+            with self.fs.read_locked():
+                self._load_window(self._pos)
+            window_offset = self._pos - self._window_start
+        count = min(len(buffer), len(self._window) - window_offset)
+        buffer[:count] = self._window[window_offset:window_offset + count]
+        self._pos += count
+        return count
+
+    def write(self, data) -> int:
+        if self.mode != 'wb':
+            raise io.UnsupportedOperation("write")
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        data = bytes(data)
+        with self.fs.metrics.timer('hash', len(data)):
+            self._md5.update(data)
+        self._pos += len(data)
+        if self._block_hashes:
+            self._hash_buffer += data
+            aligned = len(self._hash_buffer) - len(self._hash_buffer) % self._hash_unit
+            if aligned:
+                with self.fs.metrics.timer('hash', aligned):
+                    self._hash_list += hash_blocks(bytes(self._hash_buffer[:aligned]), self._hash_unit, key=self._hash_key)
+                del self._hash_buffer[:aligned]
+        if self._compression or self._dedup:
+            self._chunk += data
+            chunk_size = DEDUP_CHUNK_SIZE if self._dedup else COMPRESSION_CHUNK_SIZE
+            while len(self._chunk) >= chunk_size:
+                self._write_chunk_data(bytes(self._chunk[:chunk_size]))
+                del self._chunk[:chunk_size]
+        else:
+            self._write_content(data)
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        with self._lock_owner():
+            try:
+                if self.mode == 'rb':
+                    self._volume.close()
+                else:
+                    self._finish_write()
+            finally:
+                self._lock.close()
+                super().close()
+
+    # Leaving a `with` block on an exception drops what was written, the entry is left unchanged
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None and self.mode == 'wb':
+            self.abort()
+            return False
+        return super().__exit__(exc_type, exc, traceback)
+
+    # A write handle that was never closed is dropped, not committed
+    def __del__(self):
+        if not self.closed and getattr(self, 'mode', None) == 'wb':
+            self.abort()
+        super().__del__()
+
+    # Free the blocks and the chunk references written by an unfinished write, the entry is left unchanged
+    def abort(self):
+        if self.closed:
+            return
+        with self._lock_owner():
+            try:
+                if self.mode == 'wb':
+                    if self._records:
+                        self.fs.release_chunks(bytes(self._records))
+                    for block_index in self._written_blocks:
+                        self.fs.free_data_block(block_index)
+                else:
+                    self._volume.close()
+            finally:
+                self._lock.close()
+                super().close()
+
+    # The write lock taken on open, used by the thread that closes the handle
+    def _lock_owner(self):
+        return self.fs.volume_lock.adopt_write() if self.mode == 'wb' else contextlib.nullcontext()
+
+    # Content of the k-th data block of the chain. Blocks come from a ChainReader, so reading on costs one vectored
+    # read per window of contiguous blocks; a seek back, or ahead of the reader, starts a new reader at the last
+    # known block before k
+    def _read_chain_content(self, k: int) -> bytes:
+        content = self._block_cache.get(k)
+        if content is not None:
+            return content
+        start = min(k, len(self._chain) - 1)
+        if self._reader_position > k or self._reader_position < start:
+            if start < 0:
+                raise Exception("Chuỗi data block của tập tin bị hỏng.")
+            self._reader = ChainReader(self.fs, self._volume, struct.pack('>Q', self._chain[start]), self._chain_length - start)
+            self._reader_position = start
+        while True:
+            try:
+                block_index, block = next(self._reader)
+            except StopIteration:
+                raise Exception("Chuỗi data block của tập tin bị hỏng.")
+            position = self._reader_position
+            self._reader_position += 1
+            if position == len(self._chain):
+                self._chain.append(block_index)
+            if len(self._block_cache) >= 2 * ChainReader.MAX_WINDOW:
+                self._block_cache.clear()
+            self._block_cache[position] = block.content
+            if position == k:
+                return block.content
+
+    # Decrypted content in [start, end), AES blocks are decrypted from their 16-byte boundary
+    def _read_content(self, start: int, end: int) -> bytes:
+        aligned_start = start - start % 16
+        aligned_end = min(end + (-end) % 16, self.entry.encrypted_size)
+        if aligned_start >= aligned_end:
+            return b''
+        ciphertext = bytearray()
+        for k in range(aligned_start // DATA_BLOCK_CONTENT_SIZE, (aligned_end - 1) // DATA_BLOCK_CONTENT_SIZE + 1):
+            block_start = k * DATA_BLOCK_CONTENT_SIZE
+            content = self._read_chain_content(k)
+            ciphertext += content[max(aligned_start - block_start, 0):aligned_end - block_start]
+        if self._cipher:
+            with self.fs.metrics.timer('cipher', len(ciphertext)):
+                content = self._cipher.decrypt(bytes(ciphertext))
+        else:
+            content = bytes(ciphertext)
+        return content[start - aligned_start:end - aligned_start]
+
+    # Size of the content without the PKCS7 padding, only the last AES block is decrypted
+    def _content_size(self) -> int:
+        if not self._cipher or self.entry.encrypted_size == 0:
+            return self.entry.encrypted_size
+        last_block = self._read_content(self.entry.encrypted_size - 16, self.entry.encrypted_size)
+        return self.entry.encrypted_size - last_block[-1]
+
+    # Decode the window that covers `position`, then check it against the block hash list
+    def _load_window(self, position: int):
+        self._decode_window(position)
+        if not self.entry.flags & ENTRY_FLAG_BLOCK_HASHES:
+            return
+        if self._hash_list is None:
+            self._hash_list = self.fs.load_hash_list(self.entry)
+        unit = self.entry.integrity_block_size()
+        first = self._window_start // unit
+        count = -(-len(self._window) // unit)
+        damaged = damaged_blocks(self._window, self._hash_list[first * HASH_SIZE:(first + count) * HASH_SIZE], unit, key=self._hash_key)
+        if damaged:
+            raise Exception(self.fs.damage_message(self.entry, [first + i for i in damaged]))
+
+    def _decode_window(self, position: int):
+        if self._dedup:
+            k = position // DEDUP_CHUNK_SIZE
+            self._window_start = k * DEDUP_CHUNK_SIZE
+            self._window = self.fs.read_chunk(self._read_content(k * DEDUP_RECORD.size, (k + 1) * DEDUP_RECORD.size), self._content_key)
+            return
+        if not self.entry.compression:
+            # Windows start on a data block boundary so each hashed block is checked as a whole
+            self._window_start = position - position % DATA_BLOCK_CONTENT_SIZE
+            self._window = self._read_content(self._window_start, min(self._window_start + self.READ_WINDOW_SIZE, self.entry.original_size))
+            return
+        # Walk the frame headers until the frame that covers `position` is known
+        index = bisect.bisect_right([frame[0] for frame in self._frames], position) - 1
+        while index == len(self._frames) - 1 and (index < 0 or position >= self._frames[index][0] + self._frames[index][3]):
+            if self._frames:
+                original_offset, stored_offset, _, original_size, stored_size = self._frames[-1]
+                original_offset, stored_offset = original_offset + original_size, stored_offset + FRAME_HEADER.size + stored_size
+            else:
+                original_offset, stored_offset = 0, 0
+            if stored_offset + FRAME_HEADER.size > self._stored_size:
+                raise Exception("Frame nén không hợp lệ. Tập tin có thể bị hư hỏng.")
+            flags, original_size, stored_size = FRAME_HEADER.unpack(self._read_content(stored_offset, stored_offset + FRAME_HEADER.size))
+            self._frames.append((original_offset, stored_offset, flags, original_size, stored_size))
+            index = len(self._frames) - 1
+        original_offset, stored_offset, flags, original_size, stored_size = self._frames[index]
+        data_offset = stored_offset + FRAME_HEADER.size
+        self._window_start = original_offset
+        self._window = decompress_chunk(flags, self._read_content(data_offset, data_offset + stored_size))
+
+    # Write one compression chunk as a frame, or one deduplication chunk as its record
+    def _write_chunk_data(self, chunk: bytes):
+        if self._dedup:
+            record = self.fs.store_chunk(chunk, self._content_key)
+            self._records += record
+            self._write_content(record)
+        else:
+            self._write_content(compress_chunk(self._compression, chunk))
+
+    # Encrypt content and write it out as soon as a full data block is available
+    def _write_content(self, data: bytes):
+        if self._cipher:
+            self._pending += data
+            aligned = len(self._pending) - len(self._pending) % 16
+            if aligned:
+                with self.fs.metrics.timer('cipher', aligned):
+                    self._out += self._cipher.encrypt(bytes(self._pending[:aligned]))
+                del self._pending[:aligned]
+        else:
+            self._out += data
+        while len(self._out) >= DATA_BLOCK_CONTENT_SIZE:
+            self._write_chunk(bytes(self._out[:DATA_BLOCK_CONTENT_SIZE]))
+            del self._out[:DATA_BLOCK_CONTENT_SIZE]
+
+    def _write_chunk(self, chunk: bytes):
+        block_index = self.fs.find_free_data_block()
+        self.fs.write_data_block(block_index, DataBlock(status=0x01, next_block=ALL_ONES_ADDRESS, content=chunk.ljust(DATA_BLOCK_CONTENT_SIZE, b'\x00')))
+        if self._written_blocks:
+            self.fs.link_data_block(self._written_blocks[-1], block_index)
+        self._written_blocks.append(block_index)
+        self._encrypted_size += len(chunk)
+
+    def _finish_write(self):
+        if self._chunk:
+            self._write_chunk_data(bytes(self._chunk))
+            self._chunk.clear()
+        if self._cipher:
+            # PKCS7 padding, same as encrypt_data()
+            pad_len = 16 - (len(self._pending) % 16)
+            with self.fs.metrics.timer('cipher', len(self._pending) + pad_len):
+                self._out += self._cipher.encrypt(bytes(self._pending) + bytes([pad_len] * pad_len))
+            self._pending.clear()
+        # The padding can push the tail past one data block
+        for i in range(0, len(self._out), DATA_BLOCK_CONTENT_SIZE):
+            self._write_chunk(bytes(self._out[i:i + DATA_BLOCK_CONTENT_SIZE]))
+        self._out.clear()
+        if self._hash_buffer:
+            with self.fs.metrics.timer('hash', len(self._hash_buffer)):
+                self._hash_list += block_hash(bytes(self._hash_buffer), self._hash_key)
+            self._hash_buffer.clear()
+
+        # Writing to an existing name replaces its content, the old chain is freed only after the new one is complete
+        entry_info = self.fs.find_entry(self.name) or self.fs.find_free_entry()
+        if not entry_info:
+            raise Exception("Không còn entry trống.")
+        table_type, entry_idx, entry = entry_info
+        if entry.status == 0x01:
+            self.fs.release_entry_data(entry)
+
+        entry.status = 0x01
+        entry.first_block = struct.pack('>Q', self._written_blocks[0]) if self._written_blocks else ALL_ONES_ADDRESS
+        entry.filename = self.fs.entry_name(self.name)
+        entry.creation_date = self._creation_date
+        entry.modification_date = current_iso8601()
+        entry.password_hash = self._password_hash
+        entry.kdf_salt = self._kdf_salt
+        entry.kdf_iterations = self._kdf_iterations
+        entry.wrapped_key = self._wrapped_key
+        entry.compression = self._compression
+        entry.flags = (ENTRY_FLAG_DEDUP if self._dedup else 0x00) | (ENTRY_FLAG_BLOCK_HASHES if self._block_hashes else 0x00)
+        entry.hash_block = self.fs.write_data_chain(bytes(self._hash_list)) if self._block_hashes else ALL_ONES_ADDRESS
+        entry.hash_root = hash_root(bytes(self._hash_list)) if self._block_hashes else b'\x00' * HASH_SIZE
+        entry.md5_hash = self._md5.digest()
+        entry.encrypted_size = self._encrypted_size
+        entry.original_size = self._pos
+        entry.root_dir = None
+        self.fs.store_entry(table_type, entry_idx, entry)
+        self.fs.link_entry(self.name, (table_type, entry_idx))
+        if self._dedup:
+            self.fs.save_chunk_index()
+        self.fs.save_entry_tables()
+
+# Reader that adds what is read to an MD5 object, tarfile copies the content of a member from it
+class MD5Reader:
+    def __init__(self, reader, md5):
+        self.reader = reader
+        self.md5 = md5
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.reader.read(size)
+        self.md5.update(data)
+        return data
 
 # Main File System Class
+# Public operations take the volume lock (see locking.py): many readers or one writer, across threads and processes
+# and are timed as operations when metrics are enabled (see metrics.py)
+def reading(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.operation(method.__name__), self.read_locked():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def writing(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.metrics.operation(method.__name__), self.write_locked():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+# With lazy=True only the volume info is read when the volume is opened, each entry table and the metadata
+# are read and decoded on first use (the backup table is only read when the main table can't answer)
+# The volume file grows by growth_blocks data blocks at a time, preallocated on disk with posix_fallocate,
+# or as a sparse hole with sparse=True (also used where posix_fallocate is not available)
+# metrics=True (or a Metrics object, to profile or trace operations) enables the counters returned by stats()
 class FileSystem:
-    def __init__(self, file_path: str, metadata_path: str = "metadata.ivf", access_password: str | None = None):
+    def __init__(self, file_path: str, metadata_path: str = "metadata.ivf", access_password: str | None = None,
+                 kdf_iterations: int = DEFAULT_KDF_ITERATIONS, key_cache_ttl: float = 300.0, lazy: bool = False,
+                 growth_blocks: int = VOLUME_GROWTH_BLOCKS, sparse: bool = False, metrics: bool | Metrics = False):
+        if growth_blocks < 1:
+            raise ValueError("growth_blocks phải lớn hơn 0.")
+        if kdf_iterations < 1:
+            raise ValueError("kdf_iterations phải lớn hơn 0.")
+        self.metrics = metrics if isinstance(metrics, Metrics) else Metrics() if metrics else NULL_METRICS
         self.file_path = file_path
+        self.growth_blocks = growth_blocks
+        self.sparse = sparse
         self.metadata_path = metadata_path
         self.access_password = access_password
+        self.kdf_iterations = kdf_iterations  # PBKDF2 iterations for newly encrypted files
+        self.key_cache = KeyCache(key_cache_ttl, self.metrics)
+        self.chunk_index = None  # Loaded on first use by load_chunk_index()
+        self._snapshot_chains = None  # Loaded on first use by snapshot_chains()
+        self.dentry_cache = {}  # path -> (table type, entry index) of the resolved paths
+        self.directory_index = {}  # (table type, entry index) of a directory -> {name: (table type, entry index)}
+        # Readers holding the shared volume lock fill both caches at the same time
+        self.cache_lock = threading.Lock()
+        self.legacy_layouts = {}  # first block -> layout found by read_legacy_layout(), written back by resolve_legacy_layouts()
+        self._main_entry_table = None
+        self._backup_entry_table = None
+        self._fs_metadata = None
         if not os.path.exists(file_path):
             self.initialize_filesystem()
-        self.load_volume_info()
-        self.load_entry_tables()
-        self.load_metadata()
+        self.volume_lock = volume_lock(file_path)
+        try:
+            self.seen_generation = self.volume_lock.generation()  # Write generation of the volume the loaded tables belong to
+            self.load_volume_info()
+            if self.volume_info.format_version > VOLUME_FORMAT_VERSION:
+                raise Exception(f"Volume có định dạng {self.volume_info.format_version}, phiên bản MyFS này chỉ đọc được tới định dạng {VOLUME_FORMAT_VERSION}.")
+            if self.volume_info.format_version < VOLUME_FORMAT_VERSION:
+                with self.write_locked():
+                    # Another process may have migrated it while this one waited for the lock
+                    self.load_volume_info()
+                    if self.volume_info.format_version < VOLUME_FORMAT_VERSION:
+                        self.migrate_volume()
+            if not lazy:
+                self.load_entry_tables()
+                self.load_metadata()
+        except BaseException:
+            self.close()
+            raise
+
+    @property
+    def main_entry_table(self) -> EntryTable:
+        if self._main_entry_table is None:
+            self._main_entry_table = self.load_entry_table(MAIN_ENTRY_TABLE_OFFSET)
+        return self._main_entry_table
+
+    @property
+    def backup_entry_table(self) -> EntryTable:
+        if self._backup_entry_table is None:
+            self._backup_entry_table = self.load_entry_table(BACKUP_ENTRY_TABLE_OFFSET)
+        return self._backup_entry_table
+
+    @property
+    def fs_metadata(self) -> PlatformMetadata:
+        if self._fs_metadata is None:
+            self.load_metadata()
+        return self._fs_metadata
 
 
     def initialize_filesystem(self):
@@ -178,7 +934,7 @@ class FileSystem:
             machine_info_hash = hash_sha256_bytes(machine_info.pack())
             
             # Initialize Volume Info
-            volume_info = VolumeInfo(metadata_encryption_key=metadata_encryption_key, machine_info_hash=machine_info_hash)
+            volume_info = VolumeInfo(volume_size=DATA_TABLE_OFFSET, metadata_encryption_key=metadata_encryption_key, machine_info_hash=machine_info_hash)
             f.write(volume_info.pack())
 
             # Write metadata to a separate file
@@ -197,25 +953,200 @@ class FileSystem:
             data = f.read(VOLUME_INFO_SIZE)
             self.volume_info = VolumeInfo.unpack(data)
 
-    def load_entry_tables(self):
+    @contextlib.contextmanager
+    def read_locked(self):
+        with self.volume_lock.read() as outermost:
+            if outermost:
+                self.refresh()
+            yield
+        # Readers can't write, the layouts found meanwhile are written once the thread holds no lock
+        if outermost and self.legacy_layouts:
+            self.resolve_legacy_layouts()
+
+    @contextlib.contextmanager
+    def write_locked(self):
+        with self.volume_lock.write() as outermost:
+            if outermost:
+                self.refresh()
+            try:
+                yield
+            finally:
+                if outermost:
+                    self.seen_generation = self.volume_lock.bump_generation()
+
+    # Drop what was read from the volume if another FileSystem object or process wrote to it since
+    def refresh(self):
+        generation = self.volume_lock.generation()
+        if generation != self.seen_generation:
+            self.reload()
+            self.seen_generation = generation
+
+    def reload(self):
+        self._main_entry_table = None
+        self._backup_entry_table = None
+        with self.cache_lock:
+            self.dentry_cache.clear()
+            self.directory_index.clear()
+        self.chunk_index = None
+        self._snapshot_chains = None
+        self.load_volume_info()
+
+    # Rewrite a volume of format version 0 in the current layout, through a temporary file that replaces the volume
+    # only once it is complete, so an interrupted migration leaves the old volume as it was
+    # Data blocks keep their indices. The new entry fields get the values of legacy entries: fixed KDF salt, no data
+    # key, no compression, no flags. reset_password of format version 0 wrote LEGACY_BLOCK_CONTENT_SIZE bytes per
+    # block, those chains are repacked to full blocks, or flagged when the layout can't be told without the password
+    # (see is_legacy_reset_chain)
+    def migrate_volume(self):
+        temp_path = self.file_path + '.migrate'
+        with open(self.file_path, 'rb') as source, open(temp_path, 'wb+') as target:
+            source.seek(VOLUME_INFO_SIZE)
+            legacy_tables = source.read(2 * LEGACY_ENTRY_SIZE * ENTRY_TABLE_SIZE)
+            tables = (EntryTable(), EntryTable())
+            for i in range(2 * ENTRY_TABLE_SIZE):
+                entry = Entry.unpack(legacy_tables[i * LEGACY_ENTRY_SIZE:(i + 1) * LEGACY_ENTRY_SIZE].ljust(ENTRY_SIZE, b'\x00'))
+                entry.hash_block = ALL_ONES_ADDRESS
+                tables[i // ENTRY_TABLE_SIZE].store(i % ENTRY_TABLE_SIZE, entry)
+
+            data_size = max(source.seek(0, os.SEEK_END) - LEGACY_DATA_TABLE_OFFSET, 0)
+            self.volume_info.format_version = VOLUME_FORMAT_VERSION
+            self.volume_info.volume_size = DATA_TABLE_OFFSET + data_size
+            target.write(self.volume_info.pack())
+            target.write(tables[0].pack())
+            target.write(tables[1].pack())
+            source.seek(LEGACY_DATA_TABLE_OFFSET)
+            shutil.copyfileobj(source, target, 1024 * 1024)
+
+            for table in tables:
+                for entry in table.entries:
+                    if entry.status == 0x01:
+                        self.repack_legacy_chain(target, entry)
+            # Entries of chains with an unknown layout were flagged
+            target.seek(MAIN_ENTRY_TABLE_OFFSET)
+            target.write(tables[0].pack())
+            target.write(tables[1].pack())
+            target.flush()
+            os.fsync(target.fileno())
+        os.replace(temp_path, self.file_path)
+        print(f"Đã chuyển volume '{self.file_path}' sang định dạng {VOLUME_FORMAT_VERSION}.")
+
+    # Chains of encrypted files that went through reset_password of format version 0 hold 4086 content bytes and a
+    # zero byte per block. The block count tells the two layouts apart, except when both need the same number of
+    # blocks: None then, a chain of full blocks of ciphertext may end its blocks with zero bytes too, only the MD5 of
+    # the decrypted content can tell (see read_legacy_layout)
+    @staticmethod
+    def is_legacy_reset_chain(entry: Entry, blocks: List[DataBlock]) -> Optional[bool]:
+        if not entry.password_hash.strip(b'\x00') or len(blocks) < 2:
+            return False
+        if len(blocks) != -(-entry.encrypted_size // LEGACY_BLOCK_CONTENT_SIZE):
+            return False
+        if len(blocks) != -(-entry.encrypted_size // DATA_BLOCK_CONTENT_SIZE):
+            return True
+        return None
+
+    # Rewrite a chain of the temporary migrated volume with full blocks if it has the old reset_password layout,
+    # the chain needs at most as many blocks as before, the ones left over are freed. A chain that fits both layouts
+    # is left as it is and its entry flagged with ENTRY_FLAG_LEGACY_LAYOUT
+    def repack_legacy_chain(self, f, entry: Entry):
+        block_indices = []
+        blocks = []
+        block_index = struct.unpack('>Q', entry.first_block)[0]
+        while block_index != ALL_ONES_ADDRESS_INT and len(blocks) <= -(-entry.encrypted_size // LEGACY_BLOCK_CONTENT_SIZE):
+            f.seek(DATA_TABLE_OFFSET + block_index * DATA_BLOCK_SIZE)
+            data = f.read(DATA_BLOCK_SIZE)
+            if len(data) < DATA_BLOCK_SIZE:
+                return  # Damaged chain, left for fsck
+            block_indices.append(block_index)
+            blocks.append(DataBlock.unpack(data))
+            block_index = struct.unpack('>Q', blocks[-1].next_block)[0]
+        legacy = self.is_legacy_reset_chain(entry, blocks)
+        if legacy is None:
+            entry.flags |= ENTRY_FLAG_LEGACY_LAYOUT
+            return
+        if not legacy:
+            return
+        content = b''.join(block.content[:LEGACY_BLOCK_CONTENT_SIZE] for block in blocks)[:entry.encrypted_size]
+        needed = -(-len(content) // DATA_BLOCK_CONTENT_SIZE)
+        for i, block_index in enumerate(block_indices):
+            if i < needed:
+                next_block = struct.pack('>Q', block_indices[i + 1]) if i + 1 < needed else ALL_ONES_ADDRESS
+                chunk = content[i * DATA_BLOCK_CONTENT_SIZE:(i + 1) * DATA_BLOCK_CONTENT_SIZE]
+                block = DataBlock(status=0x01, next_block=next_block, content=chunk.ljust(DATA_BLOCK_CONTENT_SIZE, b'\x00'))
+            else:
+                block = DataBlock(status=0x00)
+            f.seek(DATA_TABLE_OFFSET + block_index * DATA_BLOCK_SIZE)
+            f.write(block.pack())
+
+    def save_volume_info(self):
+        with open(self.file_path, 'rb+') as f:
+            f.seek(0)
+            f.write(self.volume_info.pack())
+
+    # Resize the volume file, new space is preallocated (or left as a hole if sparse), the size is kept in the volume info
+    def resize_volume(self, size: int):
+        with open(self.file_path, 'rb+') as f:
+            current_size = f.seek(0, os.SEEK_END)
+            if size > current_size and not self.sparse and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(f.fileno(), current_size, size - current_size)
+                except OSError:
+                    f.truncate(size)  # File system without fallocate support
+            else:
+                f.truncate(size)
+        self.volume_info.volume_size = size
+        self.save_volume_info()
+
+    # Make sure block_index is inside the volume file, growing it by whole growth steps
+    def ensure_data_block(self, block_index: int):
+        block_count = self.data_block_count()
+        if block_index < block_count:
+            return
+        growth = -(-(block_index + 1 - block_count) // self.growth_blocks) * self.growth_blocks
+        self.resize_volume(DATA_TABLE_OFFSET + (block_count + growth) * DATA_BLOCK_SIZE)
+
+    def last_used_data_block(self) -> int:
+        with open(self.file_path, 'rb') as f:
+            for block_index in range(self.data_block_count() - 1, -1, -1):
+                f.seek(DATA_TABLE_OFFSET + block_index * DATA_BLOCK_SIZE)
+                if f.read(1) not in (b'\x00', b'\x02'):
+                    return block_index
+        return -1
+
+    # Give the disk space of the free blocks after the last used block back to the host, in sparse mode the
+    # volume keeps its size and the tail becomes a hole, otherwise the preallocated tail is kept for later writes
+    def release_free_tail(self):
+        if not self.sparse:
+            return
+        size = self.data_block_count() * DATA_BLOCK_SIZE + DATA_TABLE_OFFSET
+        used_size = DATA_TABLE_OFFSET + (self.last_used_data_block() + 1) * DATA_BLOCK_SIZE
+        if used_size < size:
+            with open(self.file_path, 'rb+') as f:
+                f.truncate(used_size)
+                f.truncate(size)
+
+    def load_entry_table(self, offset: int) -> EntryTable:
         with open(self.file_path, 'rb') as f:
-            # Load Main Entry Table
-            f.seek(MAIN_ENTRY_TABLE_OFFSET)
-            main_table_data = f.read(ENTRY_SIZE * ENTRY_TABLE_SIZE)
-            self.main_entry_table = EntryTable.unpack(main_table_data)
-            # Load Backup Entry Table
-            f.seek(BACKUP_ENTRY_TABLE_OFFSET)
-            backup_table_data = f.read(ENTRY_SIZE * ENTRY_TABLE_SIZE)
-            self.backup_entry_table = EntryTable.unpack(backup_table_data)
+            f.seek(offset)
+            return EntryTable.unpack(f.read(ENTRY_SIZE * ENTRY_TABLE_SIZE))
 
+    def load_entry_tables(self):
+        self._main_entry_table = self.load_entry_table(MAIN_ENTRY_TABLE_OFFSET)
+        self._backup_entry_table = self.load_entry_table(BACKUP_ENTRY_TABLE_OFFSET)
+        with self.cache_lock:
+            self.dentry_cache.clear()
+            self.directory_index.clear()
+
+    # Tables that were never loaded are unchanged on disk and are not written back
     def save_entry_tables(self):
-        with open(self.file_path, 'rb+') as f:
+        with self.metrics.timer('entry_table_save'), open(self.file_path, 'rb+') as f:
             # Save Main Entry Table
-            f.seek(MAIN_ENTRY_TABLE_OFFSET)
-            f.write(self.main_entry_table.pack())
+            if self._main_entry_table is not None:
+                f.seek(MAIN_ENTRY_TABLE_OFFSET)
+                f.write(self._main_entry_table.pack())
             # Save Backup Entry Table
-            f.seek(BACKUP_ENTRY_TABLE_OFFSET)
-            f.write(self.backup_entry_table.pack())
+            if self._backup_entry_table is not None:
+                f.seek(BACKUP_ENTRY_TABLE_OFFSET)
+                f.write(self._backup_entry_table.pack())
 
     # Nạp thông tin metadata chứa thông tin máy tạo MyFS và mật khẩu truy cập
     def load_metadata(self):
@@ -226,13 +1157,25 @@ class FileSystem:
             encrypted_metadata = f.read()
         metadata_key = self.volume_info.encryption_key
         decrypted_metadata_bytes = decrypt_data(metadata_key, encrypted_metadata)
-        self.fs_metadata = PlatformMetadata.unpack(decrypted_metadata_bytes)
-        self.fs_metadata.metadata_path = self.metadata_path
+        self._fs_metadata = PlatformMetadata.unpack(decrypted_metadata_bytes)
+        self._fs_metadata.metadata_path = self.metadata_path
+
+    # Drop the cached AES keys of this session (the cache's own copies are overwritten with zeros) and give back the
+    # volume lock, its lock file is closed with the last FileSystem of the volume in this process
+    def close(self):
+        self.key_cache.clear()
+        if self.volume_lock is not None:
+            release_volume_lock(self.volume_lock)
+            self.volume_lock = None
+
+    # Counters and latency histograms of the hot paths, empty unless the volume was opened with metrics
+    def stats(self) -> dict:
+        return self.metrics.snapshot()
 
     def compare_metadata(self) -> bool:
-        metadata_hash = hash_sha256_bytes(self.fs_metadata.pack())
-        file_system_metadata_hash = self.volume_info.machine_info_hash
-        return self.fs_metadata == PlatformMetadata(metadata_path=self.metadata_path) and metadata_hash == file_system_metadata_hash
+        if not self.fs_metadata.is_current_platform():
+            return False
+        return metadata_digest(self.fs_metadata.pack()) == self.volume_info.machine_info_hash
     
     def is_password_match(self, password: str) -> bool:
         password_hash = hash_sha256(password)
@@ -243,6 +1186,7 @@ class FileSystem:
         else:
             return False
 
+    @writing
     def change_access_password(self, old_password: str | None, new_password: str | None):
         if old_password:
             old_password_hash = hash_sha256(old_password)
@@ -272,28 +1216,177 @@ class FileSystem:
         
         print("Thay đổi mật khẩu truy cập thành công.")
 
+    # Resolve a path, a name without separator is a file of the root
+    @reading
     def find_entry(self, filename: str) -> Optional[Tuple[str, int, Entry]]:
-        # Search in Main Entry Table
-        for idx, entry in enumerate(self.main_entry_table.entries):
-            if entry.status == 0x01 and entry.filename == filename:
-                return ('main', idx, entry)
-        # Search in Backup Entry Table
-        for idx, entry in enumerate(self.backup_entry_table.entries):
-            if entry.status == 0x01 and entry.filename == filename:
-                return ('backup', idx, entry)
+        parts = split_path(filename)
+        if not parts:
+            return None
+        slot = None
+        for depth, name in enumerate(parts):
+            if slot is not None and not self.entry_at(slot).flags & ENTRY_FLAG_DIRECTORY:
+                return None
+            path = PATH_SEPARATOR.join(parts[:depth + 1])
+            with self.cache_lock:
+                cached = self.dentry_cache.get(path)
+            if cached is not None and self.is_child_entry(cached, name, nested=depth > 0):
+                slot = cached
+                continue
+            slot = self.lookup_child(slot, name)
+            if slot is None:
+                return None
+            with self.cache_lock:
+                self.dentry_cache[path] = slot
+        return (*slot, self.entry_at(slot))
+
+    def entry_at(self, slot: Tuple[str, int]) -> Entry:
+        table_type, entry_idx = slot
+        return self.entry_table(table_type).entries[entry_idx]
+
+    def entry_table(self, table_type: str) -> EntryTable:
+        return self.main_entry_table if table_type == 'main' else self.backup_entry_table
+
+    def is_child_entry(self, slot: Tuple[str, int], name: str, nested: bool) -> bool:
+        entry = self.entry_at(slot)
+        return entry.status == 0x01 and entry.filename == name and bool(entry.flags & ENTRY_FLAG_NESTED) == nested
+
+    # Slot of the child `name` of a directory (None for the root)
+    def lookup_child(self, parent: Optional[Tuple[str, int]], name: str) -> Optional[Tuple[str, int]]:
+        if parent is not None:
+            slot = self.directory_children(parent).get(name)
+            return slot if slot is not None and self.is_child_entry(slot, name, nested=True) else None
+        # The root has no index, its files are the entries that are not nested, main table first
+        for table_type in TABLE_TYPES:
+            for idx, entry in enumerate(self.entry_table(table_type).entries):
+                if entry.status == 0x01 and entry.filename == name and not entry.flags & ENTRY_FLAG_NESTED:
+                    return (table_type, idx)
         return None
 
+    def directory_children(self, slot: Tuple[str, int]) -> dict:
+        with self.cache_lock:
+            children = self.directory_index.get(slot)
+        if children is None:
+            entry = self.entry_at(slot)
+            data = self.read_data_chain(entry.first_block, entry.encrypted_size)
+            children = {name.rstrip(b'\x00').decode('ascii'): (TABLE_TYPES[table], entry_idx)
+                        for table, entry_idx, name in DIRECTORY_RECORD.iter_unpack(data)}
+            # Another reader may have loaded the same directory meanwhile, all of them share the first index
+            with self.cache_lock:
+                children = self.directory_index.setdefault(slot, children)
+        return children
+
+    # Write the children index of a directory to a new chain, then free the old one
+    def save_directory(self, slot: Tuple[str, int]):
+        entry = self.entry_at(slot)
+        data = b''.join(DIRECTORY_RECORD.pack(TABLE_TYPES.index(table_type), entry_idx, name.encode('ascii'))
+                        for name, (table_type, entry_idx) in self.directory_children(slot).items())
+        old_first_block = entry.first_block
+        entry.first_block = self.write_data_chain(data)
+        entry.encrypted_size = entry.original_size = len(data)
+        entry.md5_hash = hash_md5(data)
+        entry.modification_date = current_iso8601()
+        self.free_data_chain(old_first_block)
+
+    # Slot of the parent directory of a path (None for the root)
+    def parent_directory(self, path: str) -> Optional[Tuple[str, int]]:
+        parts = split_path(path)
+        if len(parts) <= 1:
+            return None
+        parent_path = PATH_SEPARATOR.join(parts[:-1])
+        entry_info = self.find_entry(parent_path)
+        if not entry_info or not entry_info[2].flags & ENTRY_FLAG_DIRECTORY:
+            raise Exception(f"Thư mục '{parent_path}' không tồn tại.")
+        return entry_info[:2]
+
+    # Name stored in the entry of a path
+    def entry_name(self, path: str) -> str:
+        parts = split_path(path)
+        if not parts:
+            raise ValueError("Đường dẫn rỗng.")
+        if len(parts[-1].encode('ascii')) > MAX_FILENAME_LENGTH:
+            raise ValueError(f"Tên '{parts[-1]}' dài quá {MAX_FILENAME_LENGTH} ký tự.")
+        return parts[-1]
+
+    # Check that a new entry can be created at a path, return its name
+    def check_new_path(self, path: str) -> str:
+        name = self.entry_name(path)
+        parent = self.parent_directory(path)
+        if parent is None:
+            exists = self.lookup_child(None, name) is not None
+        else:
+            exists = name in self.directory_children(parent)
+        if exists:
+            raise Exception(f"'{path}' đã tồn tại.")
+        return name
+
+    # Add a stored entry to the children index of its parent directory
+    def link_entry(self, path: str, slot: Tuple[str, int]):
+        parent = self.parent_directory(path)
+        with self.cache_lock:
+            self.dentry_cache[PATH_SEPARATOR.join(split_path(path))] = slot
+        if parent is None:
+            return
+        entry = self.entry_at(slot)
+        entry.flags |= ENTRY_FLAG_NESTED
+        children = self.directory_children(parent)
+        if children.get(entry.filename) != slot:
+            children[entry.filename] = slot
+            self.save_directory(parent)
+
+    def unlink_entry(self, path: str, slot: Tuple[str, int]):
+        parts = split_path(path)
+        prefix = PATH_SEPARATOR.join(parts)
+        with self.cache_lock:
+            for cached_path in [p for p in self.dentry_cache if p == prefix or p.startswith(prefix + PATH_SEPARATOR)]:
+                del self.dentry_cache[cached_path]
+            self.directory_index.pop(slot, None)
+        parent = self.parent_directory(path)
+        if parent is not None and self.directory_children(parent).pop(parts[-1], None) is not None:
+            self.save_directory(parent)
+
+    def find_system_entry(self, filename: str) -> Optional[Tuple[str, int, Entry]]:
+        for table_type, table in (('main', self.main_entry_table), ('backup', self.backup_entry_table)):
+            for idx, entry in enumerate(table.entries):
+                if entry.status == SYSTEM_ENTRY_STATUS and entry.filename == filename:
+                    return (table_type, idx, entry)
+        return None
+
+    # Files and directories of the root
+    @reading
     def list_files(self) -> List[Entry]:
         files = []
         for entry in self.main_entry_table.entries:
-            if entry.status == 0x01:
+            if entry.status == 0x01 and not entry.flags & ENTRY_FLAG_NESTED:
                 files.append(entry)
         if not files:
             for entry in self.backup_entry_table.entries:
-                if entry.status == 0x01:
+                if entry.status == 0x01 and not entry.flags & ENTRY_FLAG_NESTED:
                     files.append(entry)
         return files
 
+    @reading
+    def list_directory(self, path: str = PATH_SEPARATOR) -> List[Entry]:
+        if not split_path(path):
+            return self.list_files()
+        entry_info = self.find_entry(path)
+        if not entry_info or not entry_info[2].flags & ENTRY_FLAG_DIRECTORY:
+            raise Exception(f"Thư mục '{path}' không tồn tại.")
+        return [self.entry_at(slot) for slot in self.directory_children(entry_info[:2]).values()]
+
+    @writing
+    def make_directory(self, path: str):
+        if self.find_entry(path):
+            raise Exception(f"'{path}' đã tồn tại.")
+        name = self.check_new_path(path)
+        free_entry = self.find_free_entry()
+        if not free_entry:
+            raise Exception("Không còn entry trống.")
+        table_type, entry_idx, _ = free_entry
+        self.store_entry(table_type, entry_idx, Entry(status=0x01, filename=name, md5_hash=hash_md5(b''), root_dir=None, flags=ENTRY_FLAG_DIRECTORY))
+        self.link_entry(path, (table_type, entry_idx))
+        self.save_entry_tables()
+        print(f"Thư mục '{path}' đã được tạo.")
+
     def find_free_entry(self) -> Optional[Tuple[str, int, Entry]]:
         # Search in Main Entry Table
         for idx, entry in enumerate(self.main_entry_table.entries):
@@ -306,7 +1399,7 @@ class FileSystem:
         return None
 
     def find_free_data_block(self) -> Optional[int]:
-        with open(self.file_path, 'rb') as f:
+        with self.metrics.timer('allocation_scan'), open(self.file_path, 'rb') as f:
             f.seek(DATA_TABLE_OFFSET)
             block_index = 0
             while True:
@@ -315,12 +1408,33 @@ class FileSystem:
                     break
                 block = DataBlock.unpack(data)
                 if block.status in (0x00, 0x02):
-                    return block_index
+                    break
                 block_index += 1
-            return block_index  # Next available block index
+            self.metrics.add('allocation_scanned_blocks', block_index + 1)
+            return block_index  # Free block, or the next available block index
+
+    # First block of a run of count free blocks, the run may go on past the end of the volume (ensure_data_block()
+    # grows it). One pass over the blocks for the whole run, where find_free_data_block() scans again for every block
+    def find_free_data_run(self, count: int) -> int:
+        block_count = self.data_block_count()
+        run_start = block_index = 0
+        with self.metrics.timer('allocation_scan'), open(self.file_path, 'rb') as f:
+            while block_index < block_count:
+                window = read_block_run(f, block_index, min(ChainReader.MAX_WINDOW, block_count - block_index))
+                if not window:
+                    break
+                for data in window:
+                    block_index += 1
+                    if data[0] not in (0x00, 0x02):
+                        run_start = block_index
+                    elif block_index - run_start >= count:
+                        self.metrics.add('allocation_scanned_blocks', block_index)
+                        return run_start
+            self.metrics.add('allocation_scanned_blocks', block_index)
+        return run_start
 
     def read_data_block(self, block_index: int) -> DataBlock:
-        with open(self.file_path, 'rb') as f:
+        with self.metrics.timer('block_read', DATA_BLOCK_SIZE), open(self.file_path, 'rb') as f:
             f.seek(DATA_TABLE_OFFSET + block_index * DATA_BLOCK_SIZE)
             data = f.read(DATA_BLOCK_SIZE)
             if len(data) < DATA_BLOCK_SIZE:
@@ -329,119 +1443,546 @@ class FileSystem:
             return DataBlock.unpack(data)
 
     def write_data_block(self, block_index: int, block: DataBlock):
-        with open(self.file_path, 'rb+') as f:
+        self.ensure_data_block(block_index)
+        with self.metrics.timer('block_write', DATA_BLOCK_SIZE), open(self.file_path, 'rb+') as f:
             f.seek(DATA_TABLE_OFFSET + block_index * DATA_BLOCK_SIZE)
             f.write(block.pack())
 
-    def add_file(self, source_path: str, filename: str, password: Optional[str] = None):
+    def set_data_block_status(self, block_index: int, status: int):
+        with open(self.file_path, 'rb+') as f:
+            f.seek(DATA_TABLE_OFFSET + block_index * DATA_BLOCK_SIZE)
+            f.write(struct.pack('>B', status))
+
+    def free_data_block(self, block_index: int):
+        self.set_data_block_status(block_index, 0x00)  # Mark as deleted
+
+    # Only rewrite the next block address of a block, used when a chain grows block by block
+    def link_data_block(self, block_index: int, next_block_index: int):
+        with open(self.file_path, 'rb+') as f:
+            f.seek(DATA_TABLE_OFFSET + block_index * DATA_BLOCK_SIZE + 1)
+            f.write(struct.pack('>Q', next_block_index))
+
+    # Read the content of a chain, the last block is zero padded so the result is cut to `size` bytes
+    def read_data_chain(self, first_block: bytes, size: int) -> bytes:
+        data = bytearray()
+        with open(self.file_path, 'rb') as f:
+            for _, block in ChainReader(self, f, first_block, -(-size // DATA_BLOCK_CONTENT_SIZE)):
+                data += block.content
+        return bytes(data[:size])
+
+    # Write data to newly allocated blocks of up to 4087 bytes, return the address of the first block
+    # The chain takes one run of free blocks, written with one write; if that fails the run is freed again
+    def write_data_chain(self, data: bytes) -> bytes:
+        count = -(-len(data) // DATA_BLOCK_CONTENT_SIZE)
+        if count == 0:
+            return ALL_ONES_ADDRESS
+        start = self.find_free_data_run(count)
+        blocks = bytearray()
+        for i in range(count):
+            next_block = struct.pack('>Q', start + i + 1) if i + 1 < count else ALL_ONES_ADDRESS
+            block_content = data[i * DATA_BLOCK_CONTENT_SIZE:(i + 1) * DATA_BLOCK_CONTENT_SIZE].ljust(DATA_BLOCK_CONTENT_SIZE, b'\x00')
+            blocks += DataBlock(status=0x01, next_block=next_block, content=block_content).pack()
+        try:
+            self.ensure_data_block(start + count - 1)
+            with self.metrics.timer('block_write', len(blocks)), open(self.file_path, 'rb+') as f:
+                f.seek(DATA_TABLE_OFFSET + start * DATA_BLOCK_SIZE)
+                f.write(blocks)
+        except BaseException:
+            self.free_data_run(start, count)
+            raise
+        return struct.pack('>Q', start)
+
+    # Mark a run of blocks as deleted, the blocks of a chain that could not be written completely
+    def free_data_run(self, start: int, count: int):
+        with open(self.file_path, 'rb+') as f:
+            for block_index in range(start, min(start + count, self.data_block_count())):
+                f.seek(DATA_TABLE_OFFSET + block_index * DATA_BLOCK_SIZE)
+                f.write(b'\x00')
+
+    # Re-encrypt the content of a chain from one AES key to another into a new chain, return its first block
+    # The old chain is read once, sequentially, and left as it is: the caller frees it once the entry points to the
+    # new chain, so an interrupted re-key leaves the entry with its old key and content
+    # AES-ECB keeps the length, the new chain takes one run of free blocks, linked in advance
+    def rekey_data_chain(self, first_block: bytes, size: int, old_aes_key: bytes, new_aes_key: bytes) -> bytes:
+        old_cipher = AES.new(old_aes_key, AES.MODE_ECB)
+        new_cipher = AES.new(new_aes_key, AES.MODE_ECB)
+        carry = b''              # Old ciphertext not yet aligned to 16 bytes
+        converted = bytearray()  # New ciphertext not yet written
+        count = -(-size // DATA_BLOCK_CONTENT_SIZE)
+        if count == 0:
+            return ALL_ONES_ADDRESS
+        start = self.find_free_data_run(count)
+        written = 0
+        remaining = size
+        try:
+            self.ensure_data_block(start + count - 1)
+            with open(self.file_path, 'rb') as f:
+                for _, block in ChainReader(self, f, first_block, -(-size // DATA_BLOCK_CONTENT_SIZE)):
+                    length = min(remaining, DATA_BLOCK_CONTENT_SIZE)
+                    remaining -= length
+                    carry += block.content[:length]
+                    aligned = len(carry) - len(carry) % 16
+                    with self.metrics.timer('cipher', 2 * aligned):
+                        converted += new_cipher.encrypt(old_cipher.decrypt(carry[:aligned]))
+                    carry = carry[aligned:]
+                    while len(converted) >= DATA_BLOCK_CONTENT_SIZE or (converted and not remaining):
+                        content = bytes(converted[:DATA_BLOCK_CONTENT_SIZE]).ljust(DATA_BLOCK_CONTENT_SIZE, b'\x00')
+                        next_block = struct.pack('>Q', start + written + 1) if written + 1 < count else ALL_ONES_ADDRESS
+                        self.write_data_block(start + written, DataBlock(status=0x01, next_block=next_block, content=content))
+                        written += 1
+                        del converted[:DATA_BLOCK_CONTENT_SIZE]
+                    if not remaining:
+                        break
+            if remaining or carry:
+                raise Exception("Chuỗi data block của tập tin bị hỏng.")
+        except BaseException:
+            self.free_data_run(start, min(written + 1, count))  # The block being written may be marked as used already
+            raise
+        return struct.pack('>Q', start)
+
+    # Mark every data block of a chain as deleted, a chain kept by a snapshot stays as it is
+    def free_data_chain(self, first_block: bytes):
+        if first_block in self.snapshot_chains():
+            return
+        block_count = self.data_block_count()
+        visited = set()
+        with open(self.file_path, 'rb+') as f:
+            # Only the status byte of each block changes, the chain is read ahead and the bytes written in place
+            # A damaged chain that loops back (see fsck) ends at the first block seen twice
+            for block_index, _ in ChainReader(self, f, first_block):
+                if block_index >= block_count or block_index in visited:
+                    break
+                visited.add(block_index)
+                f.seek(DATA_TABLE_OFFSET + block_index * DATA_BLOCK_SIZE)
+                f.write(b'\x00')  # Mark as deleted
+
+    # Block indices of a chain
+    def data_chain_blocks(self, first_block: bytes) -> List[int]:
+        blocks = []
+        block_count = self.data_block_count()
+        with open(self.file_path, 'rb') as f:
+            for block_index, _ in ChainReader(self, f, first_block):
+                if block_index >= block_count:
+                    raise Exception("Chuỗi data block của tập tin bị hỏng.")
+                blocks.append(block_index)
+        return blocks
+
+    def data_block_count(self) -> int:
+        return max(os.path.getsize(self.file_path) - DATA_TABLE_OFFSET, 0) // DATA_BLOCK_SIZE
+
+    def store_entry(self, table_type: str, entry_idx: int, entry: Entry):
+        self.entry_table(table_type).store(entry_idx, entry)
+
+    def load_chunk_index(self) -> ChunkIndex:
+        if self.chunk_index is None:
+            entry_info = self.find_system_entry(CHUNK_INDEX_FILENAME)
+            if entry_info:
+                entry = entry_info[2]
+                self.chunk_index = ChunkIndex.unpack(self.read_data_chain(entry.first_block, entry.original_size))
+            else:
+                self.chunk_index = ChunkIndex()
+        return self.chunk_index
+
+    # Rewrite the chunk index system entry, the caller saves the entry tables
+    def save_chunk_index(self):
+        entry_info = self.find_system_entry(CHUNK_INDEX_FILENAME) or self.find_free_entry()
+        if not entry_info:
+            raise Exception("Không còn entry trống.")
+        table_type, entry_idx, entry = entry_info
+        old_chain = entry.first_block if entry.status == SYSTEM_ENTRY_STATUS else None
+        data = self.chunk_index.pack()
+        first_block = self.write_data_chain(data)  # The old index stays in place if this fails
+        entry.status = SYSTEM_ENTRY_STATUS
+        entry.filename = CHUNK_INDEX_FILENAME
+        entry.first_block = first_block
+        entry.encrypted_size = entry.original_size = len(data)
+        entry.modification_date = current_iso8601()
+        self.store_entry(table_type, entry_idx, entry)
+        if old_chain is not None:
+            self.free_data_chain(old_chain)
+
+    # Store one plaintext chunk (at most DEDUP_CHUNK_SIZE bytes) once in the volume, return its record for the file content
+    # The chunk key in the record is wrapped with the content key of the file if it has a password
+    def store_chunk(self, chunk: bytes, aes_key: Optional[bytes] = None) -> bytes:
+        chunk_key = hash_sha256_bytes(chunk)
+        chunk_id = hash_sha256_bytes(chunk_key)
+        chunk_index = self.load_chunk_index()
+        block_index = chunk_index.reference(chunk_id)
+        if block_index is None:
+            cipher = AES.new(chunk_key, AES.MODE_ECB)
+            with self.metrics.timer('cipher', len(chunk)):
+                content = cipher.encrypt(chunk.ljust(len(chunk) + (-len(chunk)) % 16, b'\x00'))
+            block_index = self.find_free_data_block()
+            self.write_data_block(block_index, DataBlock(status=0x01, next_block=ALL_ONES_ADDRESS, content=content.ljust(DATA_BLOCK_CONTENT_SIZE, b'\x00')))
+            chunk_index.insert(chunk_id, block_index)
+        return DEDUP_RECORD.pack(block_index, len(chunk), wrap_key(aes_key, chunk_key) if aes_key else chunk_key)
+
+    def read_chunk(self, record: bytes, aes_key: Optional[bytes] = None) -> bytes:
+        block_index, chunk_size, chunk_key = DEDUP_RECORD.unpack(record)
+        if aes_key:
+            chunk_key = unwrap_key(aes_key, chunk_key)
+        block = self.read_data_block(block_index)
+        cipher = AES.new(chunk_key, AES.MODE_ECB)
+        with self.metrics.timer('cipher', chunk_size):
+            return cipher.decrypt(block.content[:chunk_size + (-chunk_size) % 16])[:chunk_size]
+
+    # Re-wrap the chunk keys of deduplicated content when the content key changes
+    def rewrap_chunk_records(self, records: bytes, old_aes_key: Optional[bytes], new_aes_key: Optional[bytes]) -> bytes:
+        rewrapped = []
+        for block_index, chunk_size, chunk_key in DEDUP_RECORD.iter_unpack(records):
+            if old_aes_key:
+                chunk_key = unwrap_key(old_aes_key, chunk_key)
+            if new_aes_key:
+                chunk_key = wrap_key(new_aes_key, chunk_key)
+            rewrapped.append(DEDUP_RECORD.pack(block_index, chunk_size, chunk_key))
+        return b''.join(rewrapped)
+
+    # Drop one reference to each chunk of a deduplicated content, chunks nobody uses anymore are freed
+    def release_chunks(self, records: bytes):
+        chunk_index = self.load_chunk_index()
+        for block_index, _, _ in DEDUP_RECORD.iter_unpack(records):
+            if chunk_index.release(block_index):
+                block = self.read_data_block(block_index)
+                block.status = 0x00  # Mark as deleted
+                self.write_data_block(block_index, block)
+
+    # Add one reference to each chunk of a deduplicated content
+    def retain_chunks(self, records: bytes):
+        chunk_index = self.load_chunk_index()
+        for block_index, _, _ in DEDUP_RECORD.iter_unpack(records):
+            chunk_index.retain(block_index)
+
+    # Free the data of an entry, for deduplicated entries the chunk references are released first
+    # (unless a snapshot keeps the records, the references are then the snapshot's)
+    def release_entry_data(self, entry: Entry):
+        if entry.flags & ENTRY_FLAG_DEDUP and entry.first_block not in self.snapshot_chains():
+            self.release_chunks(self.read_data_chain(entry.first_block, entry.encrypted_size))
+            self.save_chunk_index()
+        self.free_data_chain(entry.first_block)
+        self.free_data_chain(entry.hash_block)
+
+    # (name, creation date, first block of the copied entry tables) of every snapshot, oldest first
+    def snapshot_records(self) -> List[Tuple[str, str, bytes]]:
+        entry_info = self.find_system_entry(SNAPSHOT_INDEX_FILENAME)
+        if not entry_info:
+            return []
+        entry = entry_info[2]
+        return [(name.rstrip(b'\x00').decode('ascii'), creation_date.decode('ascii'), tables_block)
+                for name, creation_date, tables_block in SNAPSHOT_RECORD.iter_unpack(self.read_data_chain(entry.first_block, entry.original_size))]
+
+    def find_snapshot(self, name: str) -> Optional[Tuple[str, str, bytes]]:
+        for record in self.snapshot_records():
+            if record[0] == name:
+                return record
+        return None
+
+    # Rewrite the snapshot list system entry (freed when the list is empty), the caller saves the entry tables
+    def save_snapshot_records(self, records: List[Tuple[str, str, bytes]]):
+        entry_info = self.find_system_entry(SNAPSHOT_INDEX_FILENAME) or self.find_free_entry()
+        if not entry_info:
+            raise Exception("Không còn entry trống.")
+        table_type, entry_idx, entry = entry_info
+        if entry.status == SYSTEM_ENTRY_STATUS:
+            self.free_data_chain(entry.first_block)
+        data = b''.join(SNAPSHOT_RECORD.pack(name.encode('ascii'), creation_date.encode('ascii'), tables_block)
+                        for name, creation_date, tables_block in records)
+        entry.status = SYSTEM_ENTRY_STATUS if records else 0x00
+        entry.filename = SNAPSHOT_INDEX_FILENAME
+        entry.first_block = self.write_data_chain(data)
+        entry.encrypted_size = entry.original_size = len(data)
+        entry.modification_date = current_iso8601()
+        self.store_entry(table_type, entry_idx, entry)
+
+    # Main and backup entry tables copied by a snapshot
+    def snapshot_tables(self, tables_block: bytes) -> Tuple[EntryTable, EntryTable]:
+        data = self.read_data_chain(tables_block, SNAPSHOT_TABLES_SIZE)
+        return EntryTable.unpack(data[:SNAPSHOT_TABLES_SIZE // 2]), EntryTable.unpack(data[SNAPSHOT_TABLES_SIZE // 2:])
+
+    # First block addresses of the chains kept by at least one snapshot
+    def snapshot_chains(self) -> set:
+        if self._snapshot_chains is None:
+            chains = set()
+            for _, _, tables_block in self.snapshot_records():
+                for table in self.snapshot_tables(tables_block):
+                    chains |= table.chains()
+            self._snapshot_chains = chains
+        return self._snapshot_chains
+
+    # Blocks of the chains kept by snapshots and of their copied entry tables
+    def snapshot_blocks(self) -> set:
+        blocks = set()
+        for first_block in self.snapshot_chains() | {tables_block for _, _, tables_block in self.snapshot_records()}:
+            blocks.update(self.data_chain_blocks(first_block))
+        return blocks
+
+    # Whole plaintext of an entry: the chain is read, then decrypted, decompressed or rebuilt from its chunks
+    def read_entry_content(self, entry: Entry, aes_key: Optional[bytes] = None) -> bytes:
+        if entry.flags & ENTRY_FLAG_LEGACY_LAYOUT:
+            return self.read_legacy_layout(entry, aes_key)
+        encrypted_data = self.read_data_chain(entry.first_block, entry.encrypted_size)
+        if entry.flags & ENTRY_FLAG_DEDUP:
+            records = [encrypted_data[i:i + DEDUP_RECORD.size] for i in range(0, len(encrypted_data), DEDUP_RECORD.size)]
+            decrypted_data = b''.join(self.read_chunk(record, aes_key) for record in records)
+        elif aes_key:
+            with self.metrics.timer('cipher', len(encrypted_data)):
+                decrypted_data = decrypt_data(aes_key, encrypted_data)
+        else:
+            decrypted_data = encrypted_data
+
+        if entry.compression:
+            decrypted_data = decompress_data(decrypted_data)
+        return decrypted_data
+
+    # Content of a chain flagged with ENTRY_FLAG_LEGACY_LAYOUT, which holds DATA_BLOCK_CONTENT_SIZE or
+    # LEGACY_BLOCK_CONTENT_SIZE bytes of ciphertext per block: the layout whose content matches the MD5 of the entry
+    # is the right one, it is kept for resolve_legacy_layouts(). If none does the chain is damaged, the content of full
+    # blocks is returned for the MD5 check of the caller to report
+    def read_legacy_layout(self, entry: Entry, aes_key: bytes) -> bytes:
+        block_count = -(-entry.encrypted_size // DATA_BLOCK_CONTENT_SIZE)
+        with open(self.file_path, 'rb') as f:
+            contents = [block.content for _, block in ChainReader(self, f, entry.first_block, block_count)]
+        candidates = []
+        for per_block in (DATA_BLOCK_CONTENT_SIZE, LEGACY_BLOCK_CONTENT_SIZE):
+            encrypted_data = b''.join(content[:per_block] for content in contents)[:entry.encrypted_size]
+            with self.metrics.timer('cipher', len(encrypted_data)):
+                decrypted_data = decrypt_data(aes_key, encrypted_data)
+            if hash_md5(decrypted_data) == entry.md5_hash:
+                self.record_legacy_layout(entry.first_block, encrypted_data if per_block == LEGACY_BLOCK_CONTENT_SIZE else None)
+                return decrypted_data
+            candidates.append(decrypted_data)
+        return candidates[0]
+
+    # Layout found for a flagged chain: the ciphertext to write again with full blocks, or None if it has them already
+    def record_legacy_layout(self, first_block: bytes, encrypted_data: Optional[bytes]):
+        with self.cache_lock:
+            self.legacy_layouts[first_block] = encrypted_data
+
+    # Write back the layouts found by read_legacy_layout(): the content of an old-layout chain is copied to a new chain
+    # of full blocks, then the flag of the entry is cleared. A chain moved or rewritten since is skipped, and a failed
+    # write leaves the entry flagged, the next read tries again
+    def resolve_legacy_layouts(self):
+        with self.cache_lock:
+            layouts, self.legacy_layouts = self.legacy_layouts, {}
+        with self.write_locked():
+            old_chains = []
+            for table_type in TABLE_TYPES:
+                for entry in self.entry_table(table_type).entries:
+                    if entry.status != 0x01 or not entry.flags & ENTRY_FLAG_LEGACY_LAYOUT or entry.first_block not in layouts:
+                        continue
+                    encrypted_data = layouts[entry.first_block]
+                    if encrypted_data is not None:
+                        try:
+                            first_block = self.write_data_chain(encrypted_data)
+                        except OSError:
+                            continue
+                        old_chains.append(entry.first_block)
+                        entry.first_block = first_block
+                    entry.flags &= ~ENTRY_FLAG_LEGACY_LAYOUT
+            self.save_entry_tables()
+            for chain in old_chains:
+                self.free_data_chain(chain)
+
+    # Block hash list of an entry, checked against the root hash stored in the entry
+    def load_hash_list(self, entry: Entry) -> bytes:
+        count = -(-entry.original_size // entry.integrity_block_size())
+        hash_list = self.read_data_chain(entry.hash_block, count * HASH_SIZE)
+        if hash_root(hash_list) != entry.hash_root:
+            raise Exception("Danh sách giá trị băm của tập tin bị hư hỏng.")
+        return hash_list
+
+    # Data blocks holding the damaged hashed blocks (None if the content is compressed and has no direct mapping)
+    def locate_damaged_blocks(self, entry: Entry, damaged: List[int]) -> List[Optional[int]]:
+        if entry.flags & ENTRY_FLAG_DEDUP:
+            records = self.read_data_chain(entry.first_block, entry.encrypted_size)
+            return [DEDUP_RECORD.unpack_from(records, i * DEDUP_RECORD.size)[0] for i in damaged]
+        if entry.compression:
+            return [None for _ in damaged]
+        chain = self.data_chain_blocks(entry.first_block)
+        return [chain[i] if i < len(chain) else None for i in damaged]
+
+    def damage_message(self, entry: Entry, damaged: List[int]) -> str:
+        unit = entry.integrity_block_size()
+        parts = []
+        for index, block_index in zip(damaged, self.locate_damaged_blocks(entry, damaged)):
+            location = f"byte {index * unit}-{min((index + 1) * unit, entry.original_size) - 1}"
+            if block_index is not None:
+                location += f" (data block {block_index})"
+            parts.append(location)
+        return f"Tập tin '{entry.filename}' bị hư hỏng tại: " + ", ".join(parts)
+
+    # Check the password of an entry and return the AES key of its content (None if the entry has no password)
+    def entry_aes_key(self, entry: Entry, password: Optional[str]) -> Optional[bytes]:
+        if entry.password_hash.strip(b'\x00') == b'':
+            return None
+        if not password:
+            raise Exception("Cần mật khẩu để xuất file này.")
+        key = self.password_key(entry, password)
+        if key is None:
+            raise Exception("Mật khẩu không đúng.")
+        if entry.has_wrapped_key():
+            return unwrap_key(key, entry.wrapped_key)
+        return key
+
+    # Key derived from the password of an entry (None if the password is wrong), it wraps the data key, or encrypts
+    # the content of legacy entries. Legacy entries (0 iterations) store the SHA256 of the password and derive the key
+    # from it; the others derive the key from the password itself and store a verifier computed from the key, so the
+    # volume alone gives neither the key nor a cheap way to test passwords
+    def password_key(self, entry: Entry, password: str) -> Optional[bytes]:
+        if entry.kdf_iterations == 0:
+            password_hash = hash_sha256(password)
+            if password_hash != entry.password_hash:
+                return None
+            return self.key_cache.derive(password_hash, *entry.kdf_params())
+        key = self.key_cache.derive_password(password, *entry.kdf_params())
+        if not hmac.compare_digest(password_verifier(key), entry.password_hash):
+            return None
+        return key
+
+    # New KDF salt and key for a password, returns (salt, iterations, key, verifier)
+    def new_password_key(self, password: str) -> Tuple[bytes, int, bytes, bytes]:
+        salt, iterations = new_kdf_salt(), self.kdf_iterations
+        key = self.key_cache.derive_password(password, salt, iterations)
+        return salt, iterations, key, password_verifier(key)
+
+    # New KDF salt and random data key for a password, returns (salt, iterations, data key, wrapped data key, verifier)
+    def new_content_key(self, password: str) -> Tuple[bytes, int, bytes, bytes, bytes]:
+        salt, iterations, key_encryption_key, verifier = self.new_password_key(password)
+        data_key = new_data_key()
+        return salt, iterations, data_key, wrap_key(key_encryption_key, data_key), verifier
+
+    # Open a file in MyFS as a file-like object ('rb' or 'wb'), without going through a file on the host
+    def open(self, filename: str, mode: str = 'rb', password: Optional[str] = None, compression: str | None = None,
+             dedup: bool = False, block_hashes: bool = False) -> FileHandle:
+        return FileHandle(self, filename, mode, password, compression, dedup, block_hashes)
+
+    @writing
+    def add_file(self, source_path: str, filename: str, password: Optional[str] = None, compression: str | None = None,
+                 dedup: bool = False, block_hashes: bool = False):
+        compression_type = compression_method(compression)
+        if compression_type and dedup:
+            raise ValueError("Không thể vừa nén vừa khử trùng lặp nội dung tập tin.")
+        name = self.check_new_path(filename)
+
         # Step 1: Find a free entry
         free_entry = self.find_free_entry()
         if not free_entry:
             raise Exception("Không còn entry trống.")
         table_type, entry_idx, entry = free_entry
 
-        # Step 2: Hash the password and file
-        if password:
-            password_hashed = hash_sha256(password)
-        else:
-            password_hashed = b'\x00' * 32
-
+        # Step 2: Hash the file
         with open(source_path, 'rb') as f:
             file_data = f.read()
+        with self.metrics.timer('hash', len(file_data)):
             md5_hashed = hash_md5(file_data)
-            original_size = len(file_data)
+        original_size = len(file_data)
 
         if password and password != "":
-            aes_key = derive_aes_key(password_hashed)
-            encrypted_data = encrypt_data(aes_key, file_data)
+            kdf_salt, kdf_iterations, aes_key, wrapped_key, password_hashed = self.new_content_key(password)
+        else:
+            kdf_salt, kdf_iterations, wrapped_key = b'\x00' * KDF_SALT_SIZE, 0, b'\x00' * DATA_KEY_SIZE
+            aes_key = None
+            password_hashed = b'\x00' * 32
+
+        flags = (ENTRY_FLAG_DEDUP if dedup else 0x00) | (ENTRY_FLAG_BLOCK_HASHES if block_hashes else 0x00)
+        if block_hashes:
+            with self.metrics.timer('hash', len(file_data)):
+                hash_list = hash_blocks(file_data, integrity_block_size(compression_type, flags), key=block_hash_key(aes_key))
+
+        # Step 3: Compress each chunk before encryption (optional)
+        if compression_type:
+            file_data = compress_data(compression_type, file_data)
+
+        if dedup:
+            # Chunks already in the volume are only referenced, the content is the list of chunk records
+            encrypted_data = b''.join(self.store_chunk(file_data[i:i + DEDUP_CHUNK_SIZE], aes_key) for i in range(0, len(file_data), DEDUP_CHUNK_SIZE))
+        elif aes_key:
+            with self.metrics.timer('cipher', len(file_data)):
+                encrypted_data = encrypt_data(aes_key, file_data)
         else:
             encrypted_data = file_data
 
         encrypted_size = len(encrypted_data)
 
-        # Step 4: Divide encrypted data into blocks of up to 4087 bytes
-        block_size = 4087
-        data_chunks = [encrypted_data[i:i + block_size] for i in range(0, len(encrypted_data), block_size)]
-
-        # Step 5: Find or create data blocks
-        block_indices = []
-        for chunk in data_chunks:
-            free_block = self.find_free_data_block()
-            block_indices.append(free_block)
-            block_content = chunk.ljust(block_size, b'\x00')  # Pad to 4087 bytes
-            data_block = DataBlock(status=0x01, next_block=ALL_ONES_ADDRESS, content=block_content)
-            self.write_data_block(free_block, data_block)
-
-        # Link the data blocks
-        for i in range(len(block_indices) - 1):
-            current_block = self.read_data_block(block_indices[i])
-            next_block_address = struct.pack('>Q', block_indices[i + 1])
-            current_block.next_block = next_block_address
-            self.write_data_block(block_indices[i], current_block)
-
-        # Last block points to all ones
-        last_block = self.read_data_block(block_indices[-1])
-        last_block.next_block = ALL_ONES_ADDRESS
-        self.write_data_block(block_indices[-1], last_block)
+        # Step 4 & 5: Divide encrypted data into blocks of up to 4087 bytes and write the chain
+        first_block = self.write_data_chain(encrypted_data)
 
         # Step 5 Continued: Update Entry
         entry.status = 0x01
-        entry.first_block = struct.pack('>Q', block_indices[0])
-        entry.filename = filename
+        entry.first_block = first_block
+        entry.filename = name
         entry.creation_date = current_iso8601()
         entry.modification_date = current_iso8601()
         entry.password_hash = password_hashed
+        entry.kdf_salt = kdf_salt
+        entry.kdf_iterations = kdf_iterations
+        entry.wrapped_key = wrapped_key
+        entry.compression = compression_type
+        entry.flags = flags
+        entry.hash_block = self.write_data_chain(hash_list) if block_hashes else ALL_ONES_ADDRESS
+        entry.hash_root = hash_root(hash_list) if block_hashes else b'\x00' * HASH_SIZE
         entry.md5_hash = md5_hashed
         entry.encrypted_size = encrypted_size
         entry.original_size = original_size
         entry.root_dir = str(os.path.abspath(source_path))
 
         # Save the updated entry
-        if table_type == 'main':
-            self.main_entry_table.entries[entry_idx] = entry
-        else:
-            self.backup_entry_table.entries[entry_idx] = entry
+        self.store_entry(table_type, entry_idx, entry)
+        self.link_entry(filename, (table_type, entry_idx))
 
+        if dedup:
+            self.save_chunk_index()
         self.save_entry_tables()
         print(f"Tập tin '{filename}' thêm vào thành công.")
 
-    def export_file(self, filename: str, export_path: str = None, password: Optional[str] = None):
+    # Add a host directory with all its files and subdirectories under `path`
+    @writing
+    def add_directory(self, source_dir: str, path: str, password: Optional[str] = None, compression: str | None = None,
+                      dedup: bool = False, block_hashes: bool = False):
+        if not os.path.isdir(source_dir):
+            raise Exception("Thư mục không tồn tại.")
+        if not self.find_entry(path):
+            self.make_directory(path)
+        for dirpath, dirnames, filenames in os.walk(source_dir):
+            dirnames.sort()
+            relative = os.path.relpath(dirpath, source_dir)
+            target = path if relative == os.curdir else path + PATH_SEPARATOR + relative.replace(os.sep, PATH_SEPARATOR)
+            for name in dirnames:
+                self.make_directory(target + PATH_SEPARATOR + name)
+            for name in sorted(filenames):
+                self.add_file(os.path.join(dirpath, name), target + PATH_SEPARATOR + name, password, compression, dedup, block_hashes)
+
+    # Decrypted content of a file, checked against its block hashes and its MD5
+    @reading
+    def read_file(self, filename: str, password: Optional[str] = None) -> bytes:
         entry_info = self.find_entry(filename)
         if not entry_info:
             raise Exception("Tập tin không tồn tại.")
         table_type, entry_idx, entry = entry_info
+        if entry.flags & ENTRY_FLAG_DIRECTORY:
+            raise Exception(f"'{filename}' là thư mục, dùng export_directory() để xuất.")
 
-        if entry.password_hash != b'':
-            if not password:
-                raise Exception("Cần mật khẩu để xuất file này.")
-            password_hashed = hash_sha256(password)
-            if password_hashed != entry.password_hash:
-                raise Exception("Mật khẩu không đúng.")
-            aes_key = derive_aes_key(password_hashed)
-        else:
-            aes_key = None
+        aes_key = self.entry_aes_key(entry, password)
 
         # Traverse data blocks to collect data
-        encrypted_data = b''
-        current_block_index = struct.unpack('>Q', entry.first_block)[0]
-        while current_block_index != ALL_ONES_ADDRESS_INT:
-            block = self.read_data_block(current_block_index)
-            encrypted_data += block.content.rstrip(b'\x00')
-            next_block = struct.unpack('>Q', block.next_block)[0]
-            if next_block == ALL_ONES_ADDRESS_INT:
-                break
-            current_block_index = next_block
-
-        encrypted_data = encrypted_data[:entry.encrypted_size]
+        decrypted_data = self.read_entry_content(entry, aes_key)
 
-        if aes_key:
-            decrypted_data = decrypt_data(aes_key, encrypted_data)
-        else:
-            decrypted_data = encrypted_data
+        if entry.flags & ENTRY_FLAG_BLOCK_HASHES:
+            hash_list = self.load_hash_list(entry)
+            with self.metrics.timer('hash', len(decrypted_data)):
+                damaged = damaged_blocks(decrypted_data, hash_list, entry.integrity_block_size(), key=block_hash_key(aes_key))
+            if damaged:
+                raise Exception(self.damage_message(entry, damaged))
 
-        decrypt_data_hashed = hash_md5(decrypted_data)
+        with self.metrics.timer('hash', len(decrypted_data)):
+            decrypt_data_hashed = hash_md5(decrypted_data)
         if decrypt_data_hashed != entry.md5_hash:
             raise Exception("Kiểm tra toàn vẹn gặp lỗi hoặc giá trị không đúng. Tập tin có thể bị hư hỏng.")
+        return decrypted_data
+
+    @reading
+    def export_file(self, filename: str, export_path: str = None, password: Optional[str] = None):
+        decrypted_data = self.read_file(filename, password)
+        entry = self.find_entry(filename)[2]
 
         if not export_path and not entry.root_dir:
             raise Exception("Không có đường dẫn xuất tập tin và đường dẫn tới tệp gốc không được đặt. Xuất tập tin bị hủy bỏ.")
@@ -457,124 +1998,399 @@ class FileSystem:
 
         print(f"Tập tin '{filename}' xuất thành công vào '{export_path}'.")
 
+    # Export a directory of MyFS with all its files and subdirectories into a host directory
+    @reading
+    def export_directory(self, path: str, export_dir: str, password: Optional[str] = None):
+        entry_info = self.find_entry(path)
+        if not entry_info or not entry_info[2].flags & ENTRY_FLAG_DIRECTORY:
+            raise Exception(f"Thư mục '{path}' không tồn tại.")
+        os.makedirs(export_dir, exist_ok=True)
+        for name, slot in sorted(self.directory_children(entry_info[:2]).items()):
+            child_path = path.rstrip(PATH_SEPARATOR) + PATH_SEPARATOR + name
+            if self.entry_at(slot).flags & ENTRY_FLAG_DIRECTORY:
+                self.export_directory(child_path, os.path.join(export_dir, name), password)
+            else:
+                self.export_file(child_path, os.path.join(export_dir, name), password)
+
+    # Directories and files to put in an archive: (path, entry) of each name and of everything under the directories,
+    # every file and directory of the volume when names is None: the root entries of both tables are walked, the
+    # backup table holds the entries added once the main table is full
+    def archive_members(self, names: Optional[List[str]] = None) -> List[Tuple[str, Entry]]:
+        members = {}
+
+        def walk(path: str, slot: Tuple[str, int], entry: Entry):
+            members[path] = entry
+            if entry.flags & ENTRY_FLAG_DIRECTORY:
+                for name, child_slot in sorted(self.directory_children(slot).items()):
+                    walk(path + PATH_SEPARATOR + name, child_slot, self.entry_at(child_slot))
+
+        if names is None:
+            for table_type in TABLE_TYPES:
+                for idx, entry in enumerate(self.entry_table(table_type).entries):
+                    if entry.status == 0x01 and not entry.flags & ENTRY_FLAG_NESTED:
+                        walk(entry.filename, (table_type, idx), entry)
+            return list(members.items())
+        for name in names:
+            entry_info = self.find_entry(name)
+            if not entry_info:
+                raise Exception(f"Tập tin '{name}' không tồn tại.")
+            walk(PATH_SEPARATOR.join(split_path(name)), entry_info[:2], entry_info[2])
+        return list(members.items())
+
+    # Write files of MyFS into one tar ('tar', 'tar.gz') or zip archive on out_stream, a file or a pipe: the archive
+    # is written sequentially, without temporary files. Files are read in the order of their first data block so the
+    # volume is read mostly forward, each one is decrypted as a stream and checked against its MD5 as it is copied.
+    # password is one password for every file or a dict {path: password}. Return the number of files written
+    @reading
+    def export_archive(self, names: Optional[List[str]], out_stream, fmt: str = 'tar', password: str | dict | None = None) -> int:
+        if fmt not in ARCHIVE_FORMATS:
+            raise ValueError(f"Định dạng lưu trữ không hợp lệ: '{fmt}'")
+        members = self.archive_members(names)
+        directories = [(path, entry) for path, entry in members if entry.flags & ENTRY_FLAG_DIRECTORY]
+        files = sorted(((path, entry) for path, entry in members if not entry.flags & ENTRY_FLAG_DIRECTORY),
+                       key=lambda member: struct.unpack('>Q', member[1].first_block)[0])
+        if fmt == 'zip':
+            archive = zipfile.ZipFile(out_stream, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            archive = tarfile.open(fileobj=out_stream, mode=ARCHIVE_FORMATS[fmt])
+        with archive:
+            for path, entry in directories:
+                self.archive_directory(archive, path, entry)
+            for path, entry in files:
+                self.archive_file(archive, path, entry, password.get(path) if isinstance(password, dict) else password)
+        return len(files)
+
+    def archive_directory(self, archive, path: str, entry: Entry):
+        mtime = date_parse(entry.modification_date).timestamp()
+        if isinstance(archive, zipfile.ZipFile):
+            info = zipfile.ZipInfo(path + PATH_SEPARATOR, max(time.localtime(mtime)[:6], ZIP_MIN_DATE))
+            info.external_attr = (0o40755 << 16) | 0x10  # Unix directory mode, MS-DOS directory flag
+            archive.writestr(info, b'')
+        else:
+            info = tarfile.TarInfo(path)
+            info.type, info.mode, info.mtime = tarfile.DIRTYPE, 0o755, mtime
+            archive.addfile(info)
+
+    def archive_file(self, archive, path: str, entry: Entry, password: Optional[str]):
+        mtime = date_parse(entry.modification_date).timestamp()
+        md5 = MD5.new()
+        with FileHandle(self, path, 'rb', password) as handle:
+            # FileHandle returns at most one decoded window per read, BufferedReader fills whole reads for tarfile
+            reader = io.BufferedReader(handle, ARCHIVE_COPY_SIZE)
+            if isinstance(archive, zipfile.ZipFile):
+                info = zipfile.ZipInfo(path, max(time.localtime(mtime)[:6], ZIP_MIN_DATE))
+                info.external_attr = 0o644 << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.file_size = entry.original_size
+                with archive.open(info, 'w', force_zip64=entry.original_size > zipfile.ZIP64_LIMIT) as out:
+                    for data in iter(lambda: reader.read(ARCHIVE_COPY_SIZE), b''):
+                        md5.update(data)
+                        out.write(data)
+            else:
+                info = tarfile.TarInfo(path)
+                info.size, info.mode, info.mtime = entry.original_size, 0o644, mtime
+                archive.addfile(info, MD5Reader(reader, md5))
+        if md5.digest() != entry.md5_hash:
+            raise Exception(f"Tập tin '{path}': MD5 không khớp, nội dung bị hư hỏng.")
+
+    @writing
     def delete_file(self, filename: str):
         entry_info = self.find_entry(filename)
         if not entry_info:
             raise Exception("File not found.")
         table_type, entry_idx, entry = entry_info
+        if entry.flags & ENTRY_FLAG_DIRECTORY and self.directory_children((table_type, entry_idx)):
+            raise Exception(f"Thư mục '{filename}' không rỗng.")
 
         # Traverse and mark data blocks as deleted
-        current_block_index = struct.unpack('>Q', entry.first_block)[0]
-        while current_block_index != ALL_ONES_ADDRESS_INT:
-            block = self.read_data_block(current_block_index)
-            block.status = 0x00  # Mark as deleted
-            self.write_data_block(current_block_index, block)
-            next_block = struct.unpack('>Q', block.next_block)[0]
-            if next_block == ALL_ONES_ADDRESS_INT:
-                break
-            current_block_index = next_block
+        self.release_entry_data(entry)
 
         # Update entry status to deleted
+        self.unlink_entry(filename, (table_type, entry_idx))
         entry.status = 0x00
-        if table_type == 'main':
-            self.main_entry_table.entries[entry_idx] = entry
-        else:
-            self.backup_entry_table.entries[entry_idx] = entry
+        self.store_entry(table_type, entry_idx, entry)
 
         self.save_entry_tables()
+        self.release_free_tail()
         print(f"Tập tin '{filename}' đã xóa thành công khỏi MyFS.")
 
+    @writing
     def reset_password(self, filename: str, old_password: str, new_password: str):
         entry_info = self.find_entry(filename)
         if not entry_info:
             raise Exception("File not found.")
         table_type, entry_idx, entry = entry_info
+        if entry.flags & ENTRY_FLAG_DIRECTORY:
+            raise Exception(f"'{filename}' là thư mục, thư mục không có mật khẩu.")
+
+        # Verify old password (files added without a password have no old password)
+        if entry.password_hash.strip(b'\x00'):
+            old_password_key = self.password_key(entry, old_password) if old_password else None
+            if old_password_key is None:
+                raise Exception("Mật khẩu cũ không đúng.")
+            # Old key that encrypts the content, either the data key or the password key of legacy entries
+            old_aes_key = unwrap_key(old_password_key, entry.wrapped_key) if entry.has_wrapped_key() else old_password_key
+        else:
+            old_aes_key = None
 
-        # Verify old password
-        old_password_hashed = hash_sha256(old_password)
-        if old_password_hashed != entry.password_hash:
-            raise Exception("Mật khẩu cũ không đúng.")
-
-        # Derive old AES key
-        old_aes_key = derive_aes_key(old_password_hashed)
-
-        # Derive new AES key
-        new_password_hashed = hash_sha256(new_password)
-        new_aes_key = derive_aes_key(new_password_hashed)
-
-        # Traverse data blocks to collect encrypted data
-        encrypted_data = b''
-        current_block_index = struct.unpack('>Q', entry.first_block)[0]
-        while current_block_index != ALL_ONES_ADDRESS_INT:
-            block = self.read_data_block(current_block_index)
-            encrypted_data += block.content.rstrip(b'\x00')
-            next_block = struct.unpack('>Q', block.next_block)[0]
-            if next_block == ALL_ONES_ADDRESS_INT:
-                break
-            current_block_index = next_block
-
-        encrypted_data = encrypted_data[:entry.encrypted_size]
-
-        # Decrypt with old key
-        decrypted_data = decrypt_data(old_aes_key, encrypted_data)
-
-        # Encrypt with new key
-        new_encrypted_data = encrypt_data(new_aes_key, decrypted_data)
-        new_encrypted_size = len(new_encrypted_data)
+        if new_password:
+            if entry.has_wrapped_key():
+                # Envelope encryption: only the 32-byte data key is re-wrapped, the content is untouched
+                new_salt, new_iterations, new_password_key, new_password_hashed = self.new_password_key(new_password)
+                new_wrapped_key = wrap_key(new_password_key, old_aes_key)
+                new_aes_key = old_aes_key
+            else:
+                new_salt, new_iterations, new_aes_key, new_wrapped_key, new_password_hashed = self.new_content_key(new_password)
+        else:
+            new_password_hashed = b'\x00' * 32
+            new_salt, new_iterations, new_wrapped_key = b'\x00' * KDF_SALT_SIZE, 0, b'\x00' * DATA_KEY_SIZE
+            new_aes_key = None
+
+        # The new chains are written first and the entry only changes once all of them are: on a failure they are
+        # freed and the entry keeps its chains and key
+        hash_block, new_hash_root = entry.hash_block, entry.hash_root
+        first_block, encrypted_size = entry.first_block, entry.encrypted_size
+        new_chains = []
+        retained = None  # Records of the new chain that took their own chunk references
+        try:
+            if entry.flags & ENTRY_FLAG_BLOCK_HASHES and old_aes_key != new_aes_key:
+                # The block hashes are keyed with the content key: checked with the old key, computed again with the new one
+                content = self.read_entry_content(entry, old_aes_key)
+                unit = entry.integrity_block_size()
+                with self.metrics.timer('hash', 2 * len(content)):
+                    damaged = damaged_blocks(content, self.load_hash_list(entry), unit, key=block_hash_key(old_aes_key))
+                    hash_list = hash_blocks(content, unit, key=block_hash_key(new_aes_key))
+                if damaged:
+                    raise Exception(self.damage_message(entry, damaged))
+                hash_block = self.write_data_chain(hash_list)
+                new_chains.append(hash_block)
+                new_hash_root = hash_root(hash_list)
+
+            if entry.flags & ENTRY_FLAG_DEDUP:
+                # Deduplicated content: only the chunk keys in the records are wrapped with the content key
+                if old_aes_key != new_aes_key:
+                    records = self.read_data_chain(entry.first_block, entry.encrypted_size)
+                    records = self.rewrap_chunk_records(records, old_aes_key, new_aes_key)
+                    first_block = self.write_data_chain(records)
+                    new_chains.append(first_block)
+                    if entry.first_block in self.snapshot_chains():
+                        # The snapshot keeps the old records with their chunk references, the new records take their own
+                        self.retain_chunks(records)
+                        retained = records
+            elif old_aes_key and new_aes_key and old_aes_key != new_aes_key and not entry.flags & ENTRY_FLAG_LEGACY_LAYOUT:
+                # Legacy entry without data key: AES-ECB keeps the ciphertext length, the chain is re-encrypted
+                # with the new key block by block into a new chain
+                first_block = self.rekey_data_chain(entry.first_block, entry.encrypted_size, old_aes_key, new_aes_key)
+                new_chains.append(first_block)
+            elif old_aes_key != new_aes_key:
+                # Adding or removing the password changes the content length, the chain is rewritten (so are migrated
+                # chains of unknown layout, decoded as a whole)
+                if entry.flags & ENTRY_FLAG_LEGACY_LAYOUT:
+                    data = self.read_legacy_layout(entry, old_aes_key)
+                else:
+                    data = self.read_data_chain(entry.first_block, entry.encrypted_size)
+                    if old_aes_key:
+                        with self.metrics.timer('cipher', len(data)):
+                            data = decrypt_data(old_aes_key, data)
+                if new_aes_key:
+                    with self.metrics.timer('cipher', len(data)):
+                        data = encrypt_data(new_aes_key, data)
+                first_block = self.write_data_chain(data)
+                new_chains.append(first_block)
+                encrypted_size = len(data)
+            if retained:
+                self.save_chunk_index()
+        except BaseException:
+            if retained:
+                self.release_chunks(retained)
+            for chain in new_chains:
+                self.free_data_chain(chain)
+            raise
+
+        old_chains = [chain for chain, new in ((entry.hash_block, hash_block), (entry.first_block, first_block)) if chain != new]
+        if first_block != entry.first_block:
+            entry.flags &= ~ENTRY_FLAG_LEGACY_LAYOUT
+        entry.hash_block = hash_block
+        entry.hash_root = new_hash_root
+        entry.first_block = first_block
+        entry.encrypted_size = encrypted_size
 
-        # Update entry with new password hash and encrypted size
+        # Update entry with new password hash and key parameters
         entry.password_hash = new_password_hashed
-        entry.encrypted_size = new_encrypted_size
+        entry.kdf_salt = new_salt
+        entry.kdf_iterations = new_iterations
+        entry.wrapped_key = new_wrapped_key
         entry.modification_date = current_iso8601()
 
-        # Mark existing data blocks as deleted
-        current_block_index = struct.unpack('>Q', entry.first_block)[0]
-        while current_block_index != ALL_ONES_ADDRESS_INT:
-            block = self.read_data_block(current_block_index)
-            block.status = 0x00  # Mark as deleted
-            self.write_data_block(current_block_index, block)
-            next_block = struct.unpack('>Q', block.next_block)[0]
-            if next_block == ALL_ONES_ADDRESS_INT:
-                break
-            current_block_index = next_block
-
-        # Re-add the encrypted data with the new password
-        # This process reuses the same entry but allocates new data blocks
-        block_size = 4086
-        data_chunks = [new_encrypted_data[i:i + block_size] for i in range(0, len(new_encrypted_data), block_size)]
-
-        new_block_indices = []
-        for chunk in data_chunks:
-            free_block = self.find_free_data_block()
-            new_block_indices.append(free_block)
-            block_content = chunk.ljust(4087, b'\x00')
-            data_block = DataBlock(status=0x01, next_block=ALL_ONES_ADDRESS, content=block_content)
-            self.write_data_block(free_block, data_block)
-
-        # Link the new data blocks
-        for i in range(len(new_block_indices) - 1):
-            current_block = self.read_data_block(new_block_indices[i])
-            next_block_address = struct.pack('>Q', new_block_indices[i + 1])
-            current_block.next_block = next_block_address
-            self.write_data_block(new_block_indices[i], current_block)
-
-        # Last block points to all ones
-        last_block = self.read_data_block(new_block_indices[-1])
-        last_block.next_block = ALL_ONES_ADDRESS
-        self.write_data_block(new_block_indices[-1], last_block)
-
-        # Update entry with new first block address
-        entry.first_block = struct.pack('>Q', new_block_indices[0])
-
-        # Save the updated entry
-        if table_type == 'main':
-            self.main_entry_table.entries[entry_idx] = entry
-        else:
-            self.backup_entry_table.entries[entry_idx] = entry
-
+        # Save the updated entry, the old chains are freed only once the entry points to the new ones
+        self.store_entry(table_type, entry_idx, entry)
         self.save_entry_tables()
+        for chain in old_chains:
+            self.free_data_chain(chain)
         print(f"Mật khẩu cho tập tin '{filename}' đã được đổi thành công.")
 
+    # Move the chains of all entries into contiguous runs at the start of the data region, in entry order,
+    # then cut the free blocks at the end of the volume file
+    # Every step copies one block, updates the pointer to it and only then frees the old block, so an
+    # interrupted compaction leaves a valid volume and calling compact() again continues where it stopped
+    # Deduplicated chunks are shared by many records and stay where they are, like the chains kept by snapshots
+    # since the copied entry tables can't be updated
+    @writing
+    def compact(self, progress=None) -> int:
+        held = self.snapshot_chains()
+        chains = []  # [table type, entry index, entry, block indices, entry field holding the first block]
+        for table_type, table in (('main', self.main_entry_table), ('backup', self.backup_entry_table)):
+            for idx, entry in enumerate(table.entries):
+                if entry.status in (0x01, SYSTEM_ENTRY_STATUS):
+                    if entry.first_block not in held:
+                        chains.append([table_type, idx, entry, self.data_chain_blocks(entry.first_block), 'first_block'])
+                    if entry.flags & ENTRY_FLAG_BLOCK_HASHES and entry.hash_block not in held:
+                        chains.append([table_type, idx, entry, self.data_chain_blocks(entry.hash_block), 'hash_block'])
+        pinned = set(self.load_chunk_index().blocks) | self.snapshot_blocks()
+        owners = {}  # block index -> (chain number, position in chain)
+        for chain_no, chain in enumerate(chains):
+            for position, block_index in enumerate(chain[3]):
+                owners[block_index] = (chain_no, position)
+        block_count = self.data_block_count()
+        free_blocks = [i for i in range(block_count) if i not in owners and i not in pinned]
+        heapq.heapify(free_blocks)
+
+        def move(block_index: int, target: int):
+            chain_no, position = owners.pop(block_index)
+            table_type, entry_idx, entry, blocks, field = chains[chain_no]
+            self.write_data_block(target, self.read_data_block(block_index))
+            if position == 0:
+                setattr(entry, field, struct.pack('>Q', target))
+                self.store_entry(table_type, entry_idx, entry)
+                self.save_entry_tables()
+            else:
+                self.link_data_block(blocks[position - 1], target)
+            self.free_data_block(block_index)
+            blocks[position] = target
+            owners[target] = (chain_no, position)
+            heapq.heappush(free_blocks, block_index)
+
+        def take_free_block(minimum: int) -> int:
+            while free_blocks and (free_blocks[0] < minimum or free_blocks[0] in owners):
+                heapq.heappop(free_blocks)
+            return heapq.heappop(free_blocks) if free_blocks else max(block_count, max(owners, default=-1) + 1)
+
+        total = sum(len(chain[3]) for chain in chains)
+        done = moved = 0
+        cursor = 0
+        for chain_no, chain in enumerate(chains):
+            for position in range(len(chain[3])):
+                while cursor in pinned:
+                    cursor += 1
+                block_index = chain[3][position]
+                if block_index != cursor:
+                    if cursor in owners:
+                        # Make room: the block at the target belongs to a chain that comes later
+                        move(cursor, take_free_block(cursor + 1))
+                    move(block_index, cursor)
+                    moved += 1
+                cursor += 1
+                done += 1
+                if progress:
+                    progress(done, total)
+
+        # Cut the free space after the last used block
+        last_used = max(list(owners) + list(pinned), default=-1)
+        self.resize_volume(DATA_TABLE_OFFSET + (last_used + 1) * DATA_BLOCK_SIZE)
+        print(f"Đã dồn {moved} data block, volume còn {last_used + 1} data block.")
+        return moved
+
+    # Keep the current state of the volume under a name, only the entry tables are copied
+    @writing
+    def snapshot(self, name: str):
+        if not name or len(name.encode('ascii')) > MAX_FILENAME_LENGTH or '\x00' in name:
+            raise ValueError(f"Tên snapshot phải có từ 1 đến {MAX_FILENAME_LENGTH} ký tự ASCII.")
+        if self.find_snapshot(name):
+            raise Exception(f"Snapshot '{name}' đã tồn tại.")
+        if not self.find_system_entry(SNAPSHOT_INDEX_FILENAME) and not self.find_free_entry():
+            raise Exception("Không còn entry trống.")
+        tables_block = self.write_data_chain(self.main_entry_table.pack() + self.backup_entry_table.pack())
+        self.save_snapshot_records(self.snapshot_records() + [(name, current_iso8601(), tables_block)])
+        self.save_entry_tables()
+        self._snapshot_chains = None
+        print(f"Đã tạo snapshot '{name}'.")
+
+    # (name, creation date) of every snapshot, oldest first
+    @reading
+    def list_snapshots(self) -> List[Tuple[str, str]]:
+        return [(name, creation_date) for name, creation_date, _ in self.snapshot_records()]
+
+    # Read-only FileSystem over the entry tables of a snapshot
+    @reading
+    def open_snapshot(self, name: str) -> 'SnapshotFileSystem':
+        if not self.find_snapshot(name):
+            raise Exception(f"Snapshot '{name}' không tồn tại.")
+        return SnapshotFileSystem(self, name)
+
+    # Drop a snapshot, the chains that neither the live tables nor another snapshot keep are freed
+    @writing
+    def delete_snapshot(self, name: str):
+        record = self.find_snapshot(name)
+        if not record:
+            raise Exception(f"Snapshot '{name}' không tồn tại.")
+        tables = self.snapshot_tables(record[2])
+        self.save_snapshot_records([other for other in self.snapshot_records() if other[0] != name])
+        self._snapshot_chains = None
+        kept = self.snapshot_chains() | self.main_entry_table.chains() | self.backup_entry_table.chains()
+        chunks_released = False
+        for table in tables:
+            for entry in table.entries:
+                if entry.status != 0x01:
+                    continue
+                if entry.first_block not in kept:
+                    if entry.flags & ENTRY_FLAG_DEDUP:
+                        self.release_chunks(self.read_data_chain(entry.first_block, entry.encrypted_size))
+                        chunks_released = True
+                    self.free_data_chain(entry.first_block)
+                    kept.add(entry.first_block)
+                if entry.flags & ENTRY_FLAG_BLOCK_HASHES and entry.hash_block not in kept:
+                    self.free_data_chain(entry.hash_block)
+                    kept.add(entry.hash_block)
+        self.free_data_chain(record[2])
+        if chunks_released:
+            self.save_chunk_index()
+        self.save_entry_tables()
+        self.release_free_tail()
+        print(f"Đã xóa snapshot '{name}'.")
+
+# The volume as it was when a snapshot was taken: the read operations of FileSystem work on the copied entry tables,
+# the write operations raise. The snapshot is looked up again whenever the volume was written since the last read
+class SnapshotFileSystem(FileSystem):
+    def __init__(self, volume: FileSystem, name: str):
+        self.volume = volume
+        self.snapshot_name = name
+        super().__init__(volume.file_path, volume.metadata_path, kdf_iterations=volume.kdf_iterations, lazy=True,
+                         growth_blocks=volume.growth_blocks, sparse=volume.sparse,
+                         metrics=volume.metrics if volume.metrics.enabled else False)
+        try:
+            with self.read_locked():
+                self.reload()
+        except BaseException:
+            self.close()
+            raise
+
+    def reload(self):
+        super().reload()
+        self.volume.refresh()
+        record = self.volume.find_snapshot(self.snapshot_name)
+        if not record:
+            raise Exception(f"Snapshot '{self.snapshot_name}' không tồn tại.")
+        self._main_entry_table, self._backup_entry_table = self.snapshot_tables(record[2])
+
+    @contextlib.contextmanager
+    def write_locked(self):
+        raise Exception(f"Snapshot '{self.snapshot_name}' chỉ đọc.")
+        yield
+
+    # Chains of unknown layout in a snapshot are decoded again on every read
+    def record_legacy_layout(self, first_block: bytes, encrypted_data: Optional[bytes]):
+        pass
+
 '''
 if __name__ == "__main__":
     fs = FileSystem("my_volume.ivf", metadata_path="meta.ivf")
@@ -0,0 +1,420 @@
+import argparse
+import os
+import struct
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from file_operations import *
+
+# Kiểm tra toàn vẹn cả volume MyFS trong một lượt:
+# - Đọc tuần tự vùng data theo từng đoạn lớn để lấy header (status, next block) của mọi block
+# - Dựng lại các chuỗi block từ bảng entry (trong bộ nhớ), tìm block mồ côi, vòng lặp, chuỗi dùng chung block,
+#   con trỏ sai, bất đồng giữa bảng entry chính và dự phòng, số tham chiếu sai của các chunk khử trùng lặp,
+#   mục thư mục trỏ tới entry không còn và entry con không thuộc thư mục nào
+# - Chuỗi block của các snapshot (bảng entry đã chép và các chuỗi chỉ snapshot còn giữ) cũng được kiểm tra cấu trúc
+#   và tính vào số tham chiếu chunk, nhưng không được sửa và không kiểm tra MD5
+# - Kiểm tra MD5 nội dung các tập tin song song trên nhiều luồng, tập tin có danh sách băm theo block
+#   thì chỉ ra các block bị hỏng
+# - Tùy chọn sửa lỗi (repair=True). Chuỗi bị lỗi cấu trúc được cắt trước liên kết hỏng, nội dung sau đó bị mất
+#   nên tập tin được ghi vào danh sách truncated; chuỗi sai độ dài (size_mismatches) chỉ được báo, không sửa
+
+FSCK_READ_BLOCKS = 256  # Data blocks per sequential read (1 MiB)
+BLOCK_HEADER = struct.Struct('>BQ')  # status, next block address
+
+class FsckReport:
+    def __init__(self):
+        self.block_count = 0
+        self.file_count = 0
+        self.directory_count = 0
+        self.orphaned_blocks = []     # Used blocks that no entry or chunk refers to
+        self.unallocated_blocks = []  # Blocks in a chain but marked as free
+        self.bad_pointers = []        # (filename, block index, next block address out of the volume)
+        self.cycles = []              # (filename, block index where the chain loops)
+        self.cross_links = []         # (block index, filename, filename of the other chain)
+        self.size_mismatches = []     # (filename, blocks in chain, blocks expected from the entry size), reported only
+        self.table_conflicts = []     # Filenames live in both the main and the backup entry table
+        self.refcount_errors = []     # (block index, stored reference count, counted references)
+        self.directory_errors = []    # (directory name, child name) records of a directory index with no live child entry
+        self.unlinked_entries = []    # Filenames of nested entries that no directory refers to
+        self.checksum_errors = []     # Filenames whose content does not match the MD5 in the entry
+        self.damaged_blocks = []      # (filename, description of the damaged blocks) from the block hash list
+        self.unverified = []          # Filenames whose content could not be checked (missing or wrong password)
+        self.truncated = []           # Filenames whose chain the repair cut before a bad link, their content is lost
+        self.renamed = []             # (old name, new name) of unlinked entries moved to the root under a free name
+        self.repaired = 0
+
+    def is_clean(self) -> bool:
+        return not (self.orphaned_blocks or self.unallocated_blocks or self.bad_pointers or self.cycles
+                    or self.cross_links or self.size_mismatches or self.table_conflicts
+                    or self.refcount_errors or self.directory_errors or self.unlinked_entries or self.checksum_errors
+                    or self.truncated)
+
+    def summary(self) -> str:
+        lines = [f"Đã kiểm tra {self.file_count} tập tin, {self.directory_count} thư mục, {self.block_count} data block."]
+        for filename, block_index, next_block in self.bad_pointers:
+            lines.append(f"Tập tin '{filename}': block {block_index} trỏ tới block {next_block} nằm ngoài volume.")
+        for filename, block_index in self.cycles:
+            lines.append(f"Tập tin '{filename}': chuỗi block bị lặp tại block {block_index}.")
+        for block_index, filename, other in self.cross_links:
+            lines.append(f"Block {block_index} dùng chung bởi '{filename}' và '{other}'.")
+        for filename, blocks, expected in self.size_mismatches:
+            lines.append(f"Tập tin '{filename}': chuỗi có {blocks} block, cần {expected} block.")
+        for filename in self.table_conflicts:
+            lines.append(f"Tập tin '{filename}' có trong cả bảng entry chính và dự phòng với nội dung khác nhau.")
+        for block_index, stored, counted in self.refcount_errors:
+            lines.append(f"Chunk tại block {block_index}: số tham chiếu lưu {stored}, thực tế {counted}.")
+        for directory, name in self.directory_errors:
+            lines.append(f"Thư mục '{directory}': mục '{name}' không trỏ tới entry nào.")
+        for filename in self.unlinked_entries:
+            lines.append(f"Tập tin '{filename}' không thuộc thư mục nào.")
+        for filename in self.checksum_errors:
+            lines.append(f"Tập tin '{filename}': MD5 không khớp, nội dung bị hư hỏng.")
+        for filename, description in self.damaged_blocks:
+            lines.append(description)
+        for filename in self.truncated:
+            lines.append(f"Tập tin '{filename}': chuỗi block đã bị cắt khi sửa, nội dung bị mất một phần.")
+        if self.orphaned_blocks:
+            lines.append(f"{len(self.orphaned_blocks)} block mồ côi (đang dùng nhưng không thuộc tập tin nào).")
+        if self.unallocated_blocks:
+            lines.append(f"{len(self.unallocated_blocks)} block thuộc tập tin nhưng bị đánh dấu trống.")
+        if self.unverified:
+            lines.append(f"Không kiểm tra được MD5 của {len(self.unverified)} tập tin (thiếu mật khẩu): {', '.join(self.unverified)}")
+        for filename, new_name in self.renamed:
+            lines.append(f"Tập tin '{filename}' được chuyển về thư mục gốc với tên '{new_name}' vì tên cũ đã có.")
+        if self.repaired:
+            lines.append(f"Đã sửa {self.repaired} lỗi.")
+        if self.is_clean():
+            lines.append("Volume không có lỗi.")
+        return "\n".join(lines)
+
+# Status and next block address of every data block, read sequentially in large chunks
+def read_block_headers(fs: FileSystem) -> Tuple[bytearray, List[int]]:
+    statuses = bytearray()
+    next_blocks = []
+    with open(fs.file_path, 'rb') as f:
+        f.seek(DATA_TABLE_OFFSET)
+        while True:
+            data = f.read(FSCK_READ_BLOCKS * DATA_BLOCK_SIZE)
+            if len(data) < DATA_BLOCK_SIZE:
+                break
+            for offset in range(0, len(data) - DATA_BLOCK_SIZE + 1, DATA_BLOCK_SIZE):
+                status, next_block = BLOCK_HEADER.unpack_from(data, offset)
+                statuses.append(status)
+                next_blocks.append(next_block)
+    return statuses, next_blocks
+
+# Name for an entry moved to the root: its own name if free, otherwise the name with a '~n' suffix
+def free_root_name(name: str, taken: set) -> str:
+    n = 0
+    candidate = name
+    while candidate in taken:
+        n += 1
+        suffix = f"~{n}"
+        candidate = name[:MAX_FILENAME_LENGTH - len(suffix)] + suffix
+    return candidate
+
+def expected_chain_length(entry: Entry) -> int:
+    return -(-entry.encrypted_size // DATA_BLOCK_CONTENT_SIZE)
+
+def expected_hash_chain_length(entry: Entry) -> int:
+    hash_count = -(-entry.original_size // entry.integrity_block_size())
+    return -(-hash_count * HASH_SIZE // DATA_BLOCK_CONTENT_SIZE)
+
+# The whole check runs under the volume lock, the write lock if errors are repaired
+# passwords maps the full path of a file (e.g. 'd/e/f') to its password
+def check_volume(fs: FileSystem, passwords: Optional[dict] = None, repair: bool = False, workers: Optional[int] = None) -> FsckReport:
+    with fs.write_locked() if repair else fs.read_locked():
+        return scan_volume(fs, passwords, repair, workers)
+
+def scan_volume(fs: FileSystem, passwords: Optional[dict], repair: bool, workers: Optional[int]) -> FsckReport:
+    passwords = passwords or {}
+    report = FsckReport()
+    statuses, next_blocks = read_block_headers(fs)
+    report.block_count = len(statuses)
+
+    # Entries reachable through find_entry(), a backup entry of the root with the same name as a main entry is shadowed by it
+    main_names = {entry.filename: entry for entry in fs.main_entry_table.entries if entry.status == 0x01 and not entry.flags & ENTRY_FLAG_NESTED}
+    entries = []
+    tables_changed = False
+    for table_type, table in (('main', fs.main_entry_table), ('backup', fs.backup_entry_table)):
+        for idx, entry in enumerate(table.entries):
+            if entry.status not in (0x01, SYSTEM_ENTRY_STATUS):
+                continue
+            if table_type == 'backup' and entry.status == 0x01 and not entry.flags & ENTRY_FLAG_NESTED and entry.filename in main_names:
+                shadowing = main_names[entry.filename]
+                if entry.pack() != shadowing.pack():
+                    report.table_conflicts.append(entry.filename)
+                    if repair:
+                        entry.status = 0x00
+                        tables_changed = True
+                        report.repaired += 1
+                continue
+            entries.append((table_type, idx, entry))
+
+    # Deduplicated chunks belong to the chunk index
+    chunk_index = fs.load_chunk_index()
+    owners = {block_index: CHUNK_INDEX_FILENAME for block_index in chunk_index.blocks if block_index < report.block_count}
+
+    # Rebuild the chains from the block headers, without further reads
+    # table_type is None for the entries of a snapshot, their chains are only reported
+    def walk(table_type: Optional[str], idx: int, entry: Entry, field: str, expected: int, label: Optional[str] = None) -> Optional[List[int]]:
+        nonlocal tables_changed
+        label = label or entry.filename
+        blocks = []
+        visited = set()
+        broken = False
+        current_block_index = struct.unpack('>Q', getattr(entry, field))[0]
+        while current_block_index != ALL_ONES_ADDRESS_INT:
+            previous = blocks[-1] if blocks else None
+            if current_block_index >= report.block_count:
+                report.bad_pointers.append((label, previous, current_block_index))
+                broken = True
+            elif current_block_index in visited:
+                report.cycles.append((label, current_block_index))
+                broken = True
+            elif current_block_index in owners:
+                report.cross_links.append((current_block_index, label, owners[current_block_index]))
+                broken = True
+            if broken:
+                if repair and table_type is not None:
+                    # Cut the chain before the bad link, the blocks after it are lost: the chain is left out of the
+                    # MD5 pass below and the file is reported as truncated instead
+                    report.truncated.append(label)
+                    if previous is None:
+                        setattr(entry, field, ALL_ONES_ADDRESS)
+                        fs.store_entry(table_type, idx, entry)
+                        tables_changed = True
+                    else:
+                        fs.link_data_block(previous, ALL_ONES_ADDRESS_INT)
+                    report.repaired += 1
+                break
+            blocks.append(current_block_index)
+            visited.add(current_block_index)
+            owners[current_block_index] = label
+            current_block_index = next_blocks[current_block_index]
+        if broken:
+            return None
+        if len(blocks) != expected:
+            # Not repaired: whether the entry size or the chain is wrong can't be told from the structure alone
+            report.size_mismatches.append((label, len(blocks), expected))
+            return None
+        return blocks
+
+    chains = []  # (entry, blocks) of the content chains without structural errors
+    for table_type, idx, entry in entries:
+        blocks = walk(table_type, idx, entry, 'first_block', expected_chain_length(entry))
+        if entry.flags & ENTRY_FLAG_BLOCK_HASHES:
+            walk(table_type, idx, entry, 'hash_block', expected_hash_chain_length(entry))
+        if blocks is not None:
+            chains.append((entry, blocks))
+
+    # Snapshots: the copied entry tables, then the chains that only snapshots keep
+    walked = set()
+    for _, _, entry in entries:
+        if entry.status == 0x01:
+            walked.add(entry.first_block)
+            if entry.flags & ENTRY_FLAG_BLOCK_HASHES:
+                walked.add(entry.hash_block)
+    frozen_chains = []  # (entry, blocks) of the deduplicated records that only snapshots keep
+    for name, _, tables_block in fs.snapshot_records():
+        tables_entry = Entry(first_block=tables_block, encrypted_size=SNAPSHOT_TABLES_SIZE)
+        if walk(None, 0, tables_entry, 'first_block', expected_chain_length(tables_entry), f"{name}:") is None:
+            continue
+        for table in fs.snapshot_tables(tables_block):
+            for entry in table.entries:
+                if entry.status != 0x01:
+                    continue
+                label = f"{name}:{entry.filename}"
+                if entry.first_block not in walked:
+                    walked.add(entry.first_block)
+                    blocks = walk(None, 0, entry, 'first_block', expected_chain_length(entry), label)
+                    if blocks is not None and entry.flags & ENTRY_FLAG_DEDUP:
+                        frozen_chains.append((entry, blocks))
+                if entry.flags & ENTRY_FLAG_BLOCK_HASHES and entry.hash_block not in walked:
+                    walked.add(entry.hash_block)
+                    walk(None, 0, entry, 'hash_block', expected_hash_chain_length(entry), label)
+
+    # Count the chunk references in the records of every deduplicated entry
+    counted = Counter()
+    for entry, blocks in chains + frozen_chains:
+        if entry.status == 0x01 and entry.flags & ENTRY_FLAG_DEDUP:
+            for block_index, _, _ in DEDUP_RECORD.iter_unpack(fs.read_data_chain(entry.first_block, entry.encrypted_size)):
+                counted[block_index] += 1
+    index_changed = False
+    for chunk_id, (block_index, refcount) in list(chunk_index.chunks.items()):
+        if counted[block_index] != refcount:
+            report.refcount_errors.append((block_index, refcount, counted[block_index]))
+            if repair:
+                chunk_index.chunks[chunk_id][1] = counted[block_index]
+                if counted[block_index] == 0:
+                    chunk_index.release(block_index)
+                    owners.pop(block_index, None)
+                    if block_index < report.block_count:
+                        fs.free_data_block(block_index)
+                        statuses[block_index] = 0x00
+                index_changed = True
+                report.repaired += 1
+    for block_index in counted:
+        if block_index not in chunk_index.blocks:
+            report.refcount_errors.append((block_index, 0, counted[block_index]))
+
+    # Block status against ownership
+    for block_index, status in enumerate(statuses):
+        if status == 0x01 and block_index not in owners:
+            report.orphaned_blocks.append(block_index)
+            if repair:
+                fs.free_data_block(block_index)
+                report.repaired += 1
+        elif status != 0x01 and block_index in owners:
+            report.unallocated_blocks.append(block_index)
+            if repair:
+                fs.set_data_block_status(block_index, 0x01)
+                report.repaired += 1
+
+    # Directory indexes against the entries they refer to, after the block checks since repairs rewrite the indexes
+    valid_chains = {id(entry) for entry, _ in chains}
+    referenced = Counter()
+    for table_type, idx, entry in entries:
+        if entry.status != 0x01 or not entry.flags & ENTRY_FLAG_DIRECTORY or id(entry) not in valid_chains:
+            continue
+        children = fs.directory_children((table_type, idx))
+        dangling = [name for name, slot in children.items() if not fs.is_child_entry(slot, name, nested=True)]
+        for name, slot in children.items():
+            if name not in dangling:
+                referenced[slot] += 1
+        for name in dangling:
+            report.directory_errors.append((entry.filename, name))
+            if repair:
+                del children[name]
+                report.repaired += 1
+        if dangling and repair:
+            fs.save_directory((table_type, idx))
+            tables_changed = True
+    root_names = {entry.filename for _, _, entry in entries if entry.status == 0x01 and not entry.flags & ENTRY_FLAG_NESTED}
+    for table_type, idx, entry in entries:
+        if entry.status == 0x01 and entry.flags & ENTRY_FLAG_NESTED and not referenced[(table_type, idx)]:
+            report.unlinked_entries.append(entry.filename)
+            if repair:
+                # Move the entry to the root so it can be reached again, renamed if the root has a file of that name
+                name = free_root_name(entry.filename, root_names)
+                if name != entry.filename:
+                    report.renamed.append((entry.filename, name))
+                    entry.filename = name
+                root_names.add(name)
+                entry.flags &= ~ENTRY_FLAG_NESTED
+                tables_changed = True
+                report.repaired += 1
+
+    if index_changed:
+        fs.save_chunk_index()
+        tables_changed = True
+    if tables_changed:
+        fs.save_entry_tables()
+
+    # Full path of every entry reachable from the root, through the directories whose chain is valid
+    slots = {id(entry): (table_type, idx) for table_type, idx, entry in entries}
+    valid_slots = {slots[id(entry)] for entry, _ in chains}
+    paths = {}
+
+    def name_paths(path: str, slot: Tuple[str, int]):
+        paths[slot] = path
+        if fs.entry_at(slot).flags & ENTRY_FLAG_DIRECTORY and slot in valid_slots:
+            for name, child_slot in fs.directory_children(slot).items():
+                if child_slot not in paths:
+                    name_paths(path + PATH_SEPARATOR + name, child_slot)
+
+    for table_type, idx, entry in entries:
+        if entry.status == 0x01 and not entry.flags & ENTRY_FLAG_NESTED:
+            name_paths(entry.filename, (table_type, idx))
+
+    # MD5 of the content, keys are derived here so the worker threads only read, decrypt and hash
+    # An entry no directory refers to (not repaired) is looked up by its name
+    jobs = []
+    for entry, blocks in chains:
+        if entry.status != 0x01:
+            continue
+        if entry.flags & ENTRY_FLAG_DIRECTORY:
+            report.directory_count += 1
+        else:
+            report.file_count += 1
+        path = paths.get(slots[id(entry)], entry.filename)
+        try:
+            jobs.append((entry, fs.entry_aes_key(entry, passwords.get(path))))
+        except Exception:
+            report.unverified.append(path)
+
+    # None if the content is valid, otherwise the description of the damaged blocks (empty if unknown)
+    def verify(job) -> Optional[str]:
+        entry, aes_key = job
+        try:
+            content = fs.read_entry_content(entry, aes_key)
+        except Exception:
+            return ""
+        if hash_md5(content) == entry.md5_hash:
+            return None
+        if entry.flags & ENTRY_FLAG_BLOCK_HASHES:
+            try:
+                damaged = damaged_blocks(content, fs.load_hash_list(entry), entry.integrity_block_size(), key=block_hash_key(aes_key))
+                if damaged:
+                    return fs.damage_message(entry, damaged)
+            except Exception as e:
+                return str(e)
+        return ""
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for (entry, _), damage in zip(jobs, pool.map(verify, jobs)):
+            if damage is not None:
+                report.checksum_errors.append(entry.filename)
+                if damage:
+                    report.damaged_blocks.append((entry.filename, damage))
+    return report
+
+# Passwords of --password PATH=PASSWORD, --password-env PATH=NAME (environment variable NAME) and
+# --password-fd PATH=FD (file descriptor opened by the caller, read up to EOF without the final newline)
+def read_passwords(args) -> dict:
+    passwords = {}
+    for option, items in (('--password', args.password), ('--password-env', args.password_env), ('--password-fd', args.password_fd)):
+        for item in items:
+            path, separator, value = item.partition('=')
+            if not separator or not path:
+                raise Exception(f"Giá trị {option} không hợp lệ: '{item}', cần dạng ĐƯỜNG_DẪN=GIÁ_TRỊ.")
+            if option == '--password-env':
+                if value not in os.environ:
+                    raise Exception(f"Biến môi trường '{value}' không tồn tại.")
+                value = os.environ[value]
+            elif option == '--password-fd':
+                try:
+                    with open(int(value), 'r') as stream:
+                        value = stream.read().removesuffix('\n')
+                except (OSError, ValueError) as e:
+                    raise Exception(f"Không đọc được mật khẩu từ file descriptor {value}: {e}")
+            passwords[PATH_SEPARATOR.join(split_path(path))] = value
+    return passwords
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Kiểm tra toàn vẹn volume MyFS")
+    parser.add_argument('volume', help="Đường dẫn volume MyFS.dat")
+    parser.add_argument('--metadata', default="metadata.dat", help="Đường dẫn file metadata")
+    parser.add_argument('--repair', action='store_true', help="Sửa các lỗi tìm thấy")
+    parser.add_argument('--workers', type=int, default=None, help="Số luồng kiểm tra MD5")
+    parser.add_argument('--password', action='append', default=[], metavar='ĐƯỜNG_DẪN=MẬT_KHẨU', help="Mật khẩu của tập tin để kiểm tra MD5")
+    parser.add_argument('--password-env', action='append', default=[], metavar='ĐƯỜNG_DẪN=NAME', help="Đọc mật khẩu của tập tin từ biến môi trường NAME")
+    parser.add_argument('--password-fd', action='append', default=[], metavar='ĐƯỜNG_DẪN=FD', help="Đọc mật khẩu của tập tin từ file descriptor FD")
+    args = parser.parse_args(argv)
+
+    try:
+        passwords = read_passwords(args)
+    except Exception as e:
+        print(e)
+        return 1
+    if not os.path.exists(args.volume):
+        print("Volume không tồn tại")
+        return 1
+    fs = FileSystem(args.volume, metadata_path=args.metadata)
+    report = check_volume(fs, passwords, repair=args.repair, workers=args.workers)
+    fs.close()
+    print(report.summary())
+    return 0 if report.is_clean() or args.repair else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,47 @@
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+# Danh sách giá trị băm SHA-256 theo từng block nội dung của tập tin (block hash list)
+# Giá trị gốc (root) là SHA-256 của cả danh sách và được lưu trong entry, nên danh sách lưu ở data block
+# vẫn được kiểm tra trước khi dùng. Nhờ đó có thể kiểm tra từng đoạn khi đọc một phần tập tin,
+# băm song song trên nhiều lõi và chỉ ra chính xác block nào bị hỏng.
+# Tập tin có mật khẩu dùng HMAC-SHA256 với khóa suy ra từ khóa nội dung thay cho SHA-256: danh sách băm
+# không được mã hóa, băm không khóa của từng block sẽ cho phép đoán thử nội dung mà không cần mật khẩu.
+
+HASH_SIZE = 32
+PARALLEL_HASH_THRESHOLD = 4 * 1024 * 1024  # Smaller contents are hashed in the calling thread
+PARALLEL_HASH_BATCH = 256  # Blocks hashed per task
+
+# Key of the block hashes of an encrypted content (None for content without password), kept apart from the AES key
+def block_hash_key(content_key: Optional[bytes]) -> Optional[bytes]:
+    return hmac.new(content_key, b'MyFS block hashes', hashlib.sha256).digest() if content_key else None
+
+def block_hash(block: bytes, key: Optional[bytes] = None) -> bytes:
+    if key:
+        return hmac.new(key, block, hashlib.sha256).digest()
+    return hashlib.sha256(block).digest()
+
+def hash_block_range(data: bytes, block_size: int, first: int, last: int, key: Optional[bytes] = None) -> bytes:
+    return b''.join(block_hash(data[i * block_size:(i + 1) * block_size], key) for i in range(first, last))
+
+# Concatenated hashes of every block_size bytes of data; hashlib releases the GIL, so large contents are hashed on a thread pool
+def hash_blocks(data: bytes, block_size: int, workers: Optional[int] = None, key: Optional[bytes] = None) -> bytes:
+    count = -(-len(data) // block_size)
+    if len(data) < PARALLEL_HASH_THRESHOLD:
+        return hash_block_range(data, block_size, 0, count, key)
+    ranges = [(first, min(first + PARALLEL_HASH_BATCH, count)) for first in range(0, count, PARALLEL_HASH_BATCH)]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        return b''.join(pool.map(lambda r: hash_block_range(data, block_size, *r, key), ranges))
+
+def hash_root(hash_list: bytes) -> bytes:
+    return hashlib.sha256(hash_list).digest()
+
+# Indices of the blocks of data that don't match their hash
+def damaged_blocks(data: bytes, hash_list: bytes, block_size: int, workers: Optional[int] = None,
+                   key: Optional[bytes] = None) -> List[int]:
+    computed = hash_blocks(data, block_size, workers, key)
+    count = max(len(computed), len(hash_list)) // HASH_SIZE
+    return [i for i in range(count) if computed[i * HASH_SIZE:(i + 1) * HASH_SIZE] != hash_list[i * HASH_SIZE:(i + 1) * HASH_SIZE]]
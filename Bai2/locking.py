@@ -0,0 +1,189 @@
+import contextlib
+import os
+import struct
+import threading
+try:
+    import fcntl
+except ImportError:  # Windows: only the in-process lock
+    fcntl = None
+
+# Khóa volume cho nhiều luồng và nhiều tiến trình: nhiều lượt đọc cùng lúc, một lượt ghi (cấp phát block, sửa bảng entry)
+# - Trong một tiến trình: ReadWriteLock, mỗi luồng có thể lấy lại khóa đang giữ (lời gọi lồng nhau). Khóa ghi không
+#   gắn với luồng khi nhả: FileHandle 'wb' giữ khóa ghi tới khi đóng, và có thể được đóng ở luồng khác hoặc bởi GC
+# - Giữa các tiến trình: khóa vùng fcntl trên file khóa cạnh volume (<volume>.lock). Khóa POSIX bị nhả khi tiến trình
+#   đóng bất kỳ file descriptor nào của file bị khóa, FileSystem mở/đóng volume liên tục nên khóa nằm ở file riêng
+# - File khóa lưu số thế hệ, tăng sau mỗi lượt ghi, để các tiến trình khác biết phải nạp lại bảng entry
+
+LOCK_FILE_SUFFIX = '.lock'
+GENERATION = struct.Struct('>Q')
+VOLUME_REGION = (GENERATION.size, 1)  # (start, length) of the byte range locked for the whole volume
+
+class ReadWriteLock:
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0  # New readers wait for them, so writers are not starved
+        self._owner = None  # Thread that took the write lock, its nested acquisitions (read or write) are counted below
+        self._write_depth = 0  # Not per thread: the last release may come from another thread
+        self._local = threading.local()  # depth of the read lock held by the current thread
+
+    # Return True if the lock was taken, False if the current thread already held it
+    def acquire_read(self) -> bool:
+        if getattr(self._local, 'depth', 0):
+            self._local.depth += 1
+            return False
+        with self._condition:
+            if self._owner == threading.get_ident():
+                self._write_depth += 1
+                return False
+            self._condition.wait_for(lambda: not self._writer and not self._waiting_writers)
+            self._readers += 1
+        self._local.depth = 1
+        return True
+
+    def acquire_write(self) -> bool:
+        if getattr(self._local, 'depth', 0):
+            raise RuntimeError("Không thể nâng khóa đọc thành khóa ghi.")
+        with self._condition:
+            if self._owner == threading.get_ident():
+                self._write_depth += 1
+                return False
+            self._waiting_writers += 1
+            try:
+                self._condition.wait_for(lambda: not self._writer and self._readers == 0)
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+            self._owner = threading.get_ident()
+            self._write_depth = 1
+        return True
+
+    # Release the read lock of the current thread if it holds one, otherwise one acquisition of the write lock,
+    # whichever thread took it
+    def release(self):
+        if getattr(self._local, 'depth', 0):
+            self._local.depth -= 1
+            if self._local.depth:
+                return
+            with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+            return
+        with self._condition:
+            if not self._writer:
+                raise RuntimeError("Khóa không được giữ.")
+            self._write_depth -= 1
+            if self._write_depth == 0:
+                self._writer = False
+                self._owner = None
+                self._condition.notify_all()
+
+    # Let the current thread use the write lock held for another one, a FileHandle closed on another thread
+    # commits with the write lock it took on open
+    @contextlib.contextmanager
+    def adopt_write(self):
+        me = threading.get_ident()
+        with self._condition:
+            if not self._writer:
+                raise RuntimeError("Khóa ghi không được giữ.")
+            previous, self._owner = self._owner, me
+        try:
+            yield
+        finally:
+            with self._condition:
+                if self._writer and self._owner == me:
+                    self._owner = previous
+
+class VolumeLock:
+    def __init__(self, volume_path: str):
+        self.volume_path = volume_path
+        self.lock_path = volume_path + LOCK_FILE_SUFFIX
+        self.users = 0  # FileSystem objects using the lock, counted by volume_lock() and release_volume_lock()
+        self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._rw_lock = ReadWriteLock()
+        self._mutex = threading.Lock()  # Guards the shared region lock count and the generation reads/writes
+        self._shared_holders = 0
+
+    def _lock_region(self, mode):
+        if fcntl:
+            start, length = VOLUME_REGION
+            fcntl.lockf(self._fd, mode, length, start)
+
+    # The context value is True for the outermost acquisition of the current thread
+    @contextlib.contextmanager
+    def read(self):
+        outermost = self._rw_lock.acquire_read()
+        try:
+            if outermost:
+                # Threads of this process share one region lock, taken by the first reader and released by the last
+                with self._mutex:
+                    if self._shared_holders == 0:
+                        self._lock_region(fcntl.LOCK_SH if fcntl else None)
+                    self._shared_holders += 1
+            try:
+                yield outermost
+            finally:
+                if outermost:
+                    with self._mutex:
+                        self._shared_holders -= 1
+                        if self._shared_holders == 0:
+                            self._lock_region(fcntl.LOCK_UN if fcntl else None)
+        finally:
+            self._rw_lock.release()
+
+    @contextlib.contextmanager
+    def write(self):
+        outermost = self._rw_lock.acquire_write()
+        try:
+            if outermost:
+                self._lock_region(fcntl.LOCK_EX if fcntl else None)
+            try:
+                yield outermost
+            finally:
+                if outermost:
+                    self._lock_region(fcntl.LOCK_UN if fcntl else None)
+        finally:
+            self._rw_lock.release()
+
+    def adopt_write(self):
+        return self._rw_lock.adopt_write()
+
+    def generation(self) -> int:
+        with self._mutex:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            data = os.read(self._fd, GENERATION.size)
+        return GENERATION.unpack(data)[0] if len(data) == GENERATION.size else 0
+
+    # Called by a writer while it holds the write lock, return the new generation
+    def bump_generation(self) -> int:
+        generation = self.generation() + 1
+        with self._mutex:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            os.write(self._fd, GENERATION.pack(generation))
+        return generation
+
+    def close(self):
+        os.close(self._fd)
+
+# All FileSystem objects of a process that open the same volume share one VolumeLock, POSIX region locks
+# don't exclude each other inside one process so the in-process lock must be common to them
+# Each volume_lock() call is matched by one release_volume_lock(), the lock file is closed by the last one
+_volume_locks = {}
+_volume_locks_mutex = threading.Lock()
+
+def volume_lock(volume_path: str) -> VolumeLock:
+    key = os.path.realpath(volume_path)
+    with _volume_locks_mutex:
+        if key not in _volume_locks:
+            _volume_locks[key] = VolumeLock(key)
+        lock = _volume_locks[key]
+        lock.users += 1
+        return lock
+
+def release_volume_lock(lock: VolumeLock):
+    with _volume_locks_mutex:
+        lock.users -= 1
+        if lock.users == 0:
+            del _volume_locks[lock.volume_path]
+            lock.close()
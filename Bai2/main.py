@@ -1,5 +1,9 @@
+import hashlib
+import json
 import os
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import shutil
 import sys
@@ -7,30 +11,106 @@ import subprocess
 import zipfile
 import time
 from Crypto.Hash import SHA256
+from replace_helper import ZIP_MANIFEST_MEMBER, format_manifest
 from cli import main_program
 
+# Per-file hashes are cached in a manifest keyed by (size, mtime_ns, inode, ctime_ns), so only changed files
+# are read again at startup. ctime can't be set back by the user like mtime, an edited file always looks changed
+SOURCE_MANIFEST_FILE = "source_manifest.json"
+HASH_READ_SIZE = 1024 * 1024  # Bytes read per call while hashing
+
 def hash_file(file_path):
     """Calculate the SHA-256 hash of a file."""
-    sha256_hash = SHA256.new()
+    # hashlib releases the GIL on large buffers, files are hashed in parallel on a thread pool
+    sha256_hash = hashlib.sha256()
     with open(file_path, "rb") as f:
-        # Read and update hash string value in blocks of 4K
-        for byte_block in iter(lambda: f.read(4096), b""):
+        for byte_block in iter(lambda: f.read(HASH_READ_SIZE), b""):
             sha256_hash.update(byte_block)
     return sha256_hash.hexdigest()
 
-def hash_all_python_source_files(directory = os.path.abspath(os.path.dirname(__file__))):
-    """Hash all .py files in the specified directory and its subdirectories."""
-    hash_values = []
+def file_signature(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_ctime_ns]
+
+def load_manifest(manifest_path = SOURCE_MANIFEST_FILE):
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        return manifest if isinstance(manifest, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(manifest, manifest_path = SOURCE_MANIFEST_FILE):
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, manifest_path)
+
+def python_source_files(directory):
+    """List all .py files in the specified directory and its subdirectories, in walk order."""
+    source_files = []
     for root, _, files in os.walk(directory):
         for file in files:
             # Get all .py files except files with parents in the .venv directory
             if file.endswith(".py") and ".venv" not in Path(root).parts:
-                file_path = os.path.join(root, file)
-                hash_value = hash_file(file_path)
-                hash_values.append(hash_value)
-    concatenated_hashes = "".join(hash_values)
+                source_files.append(os.path.join(root, file))
+    return source_files
+
+def hash_all_python_source_files(directory = os.path.abspath(os.path.dirname(__file__)), manifest = None):
+    """Hash all .py files in the specified directory and its subdirectories."""
+    source_files = python_source_files(directory)
+    # Records of the directory: path -> signature + [hash], files that no longer exist are dropped
+    cached = {} if manifest is None else manifest.setdefault("files", {}).setdefault(os.path.abspath(directory), {})
+    hash_values = {}
+    stale = []
+    for file_path in source_files:
+        signature = file_signature(file_path)
+        record = cached.get(file_path)
+        if record and record[:-1] == signature:
+            hash_values[file_path] = record[-1]
+        else:
+            stale.append((file_path, signature))
+    if stale:
+        with ThreadPoolExecutor(max_workers=min(len(stale), os.cpu_count() or 1)) as pool:
+            for (file_path, signature), hash_value in zip(stale, pool.map(hash_file, [path for path, _ in stale])):
+                hash_values[file_path] = hash_value
+                cached[file_path] = signature + [hash_value]
+    for file_path in list(cached):
+        if file_path not in hash_values:
+            del cached[file_path]
+    concatenated_hashes = "".join(hash_values[file_path] for file_path in source_files)
+    sha256_hash = SHA256.new()
+    sha256_hash.update(concatenated_hashes.encode())
+    return sha256_hash.hexdigest()
+
+def hash_zip_member(zipf, info):
+    sha256_hash = hashlib.sha256()
+    # ZipExtFile checks the CRC stored in the archive when the member is read to the end
+    with zipf.open(info) as f:
+        for byte_block in iter(lambda: f.read(HASH_READ_SIZE), b""):
+            sha256_hash.update(byte_block)
+    return sha256_hash.hexdigest()
+
+def hash_source_zip(zip_path, manifest = None):
+    """Hash every member of the source copy zip file, None if a member fails its CRC check or the zip is damaged."""
+    signature = file_signature(zip_path)
+    cached = {} if manifest is None else manifest.setdefault("zips", {})
+    record = cached.get(os.path.abspath(zip_path))
+    if record and record[:-1] == signature:
+        return record[-1]
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as zipf:
+            members = [info for info in zipf.infolist() if not info.is_dir()]
+            with ThreadPoolExecutor(max_workers=min(len(members), os.cpu_count() or 1) or 1) as pool:
+                hash_values = list(pool.map(lambda info: hash_zip_member(zipf, info), members))
+    except (zipfile.BadZipFile, zlib.error, OSError, EOFError):
+        cached.pop(os.path.abspath(zip_path), None)
+        return None
+    # Member names are part of the hash, renaming or moving a file in the zip is a change
+    concatenated_hashes = "".join(f"{info.filename}:{hash_value}\n" for info, hash_value in zip(members, hash_values))
     sha256_hash = SHA256.new()
     sha256_hash.update(concatenated_hashes.encode())
+    cached[os.path.abspath(zip_path)] = signature + [sha256_hash.hexdigest()]
     return sha256_hash.hexdigest()
 
 def create_zip_with_py_files(zip_name):
@@ -40,6 +120,7 @@ def create_zip_with_py_files(zip_name):
     zip_path = parent_dir / zip_name  # Path for the ZIP file
 
     try:
+        hashes = {}
         with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
             # Add all .py files from the parent directory and subdirectories
             for root, _, files in os.walk(parent_dir):
@@ -50,6 +131,9 @@ def create_zip_with_py_files(zip_name):
                         # Add the file to the ZIP archive
                         # Use relative path to maintain directory structure
                         zipf.write(file_path, file_path.relative_to(parent_dir))
+                        hashes[file_path.relative_to(parent_dir).as_posix()] = hash_file(file_path)
+            # The helper compares installed files against these hashes and only extracts the ones that differ
+            zipf.writestr(ZIP_MANIFEST_MEMBER, format_manifest(hashes))
     except Exception as e:
         print(f"An error occurred: {e}")
 
@@ -66,7 +150,8 @@ def start_helper(source_zip, target_directory):
         sys.exit(1)
     
     # Construct the command to run the helper script
-    command = ['python', helper_script, source_zip, target_directory]
+    # The helper waits for this process to exit before replacing files
+    command = ['python', helper_script, source_zip, target_directory, str(os.getpid())]
 
     
     # Start the helper script as a separate process
@@ -119,20 +204,20 @@ def init_and_check_integrity():
     source_hash_exists = os.path.exists(source_hash_file)
     source_copy_hash_exists = os.path.exists(source_copy_hash_file)
 
+    manifest = load_manifest()
+    current_source_hash = hash_all_python_source_files(manifest=manifest)
+    current_source_copy_hash = hash_source_zip(source_copy_zip_file, manifest)
+    save_manifest(manifest)
+
     #Create hash files for source code and source copy zip files if not exists
     if not source_hash_exists:
-        source_hash = hash_all_python_source_files()
         with open(source_hash_file, 'w') as f:
-            f.write(source_hash)
+            f.write(current_source_hash)
     
     if not source_copy_hash_exists:
-        source_copy_hash = hash_all_python_source_files(source_copy_zip_file)
+        # A damaged zip gets an empty hash, it is rebuilt from the source code below
         with open(source_copy_hash_file, 'w') as f:
-            f.write(source_copy_hash)
-
-
-    current_source_hash = hash_all_python_source_files()
-    current_source_copy_hash = hash_all_python_source_files(source_copy_zip_file)
+            f.write(current_source_copy_hash or "")
 
     with open(source_hash_file, 'r') as f:
         source_hash = f.read()
@@ -158,9 +243,15 @@ def init_and_check_integrity():
         os.remove(source_copy_hash_file)
         os.remove(source_copy_zip_file)
         create_zip_with_py_files(source_copy_zip_file)
-        source_copy_hash = hash_file(source_copy_zip_file)
-        with open('source_copy_hash.sha256', 'w') as f:
-            f.write()
+        source_copy_hash = hash_source_zip(source_copy_zip_file, manifest)
+        save_manifest(manifest)
+        if source_copy_hash is None:
+            # The rebuilt zip can't be read back either (disk full, I/O error): no hash file is written,
+            # so the copy is rebuilt again on the next start
+            print("Source copy is damaged and could not be rebuilt.")
+            return
+        with open(source_copy_hash_file, 'w') as f:
+            f.write(source_copy_hash)
         return
 
 if __name__ == "__main__":
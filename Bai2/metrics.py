@@ -0,0 +1,200 @@
+import cProfile
+import pstats
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Optional
+
+# Số liệu đo trên các đường nóng của FileSystem (bật bằng FileSystem(..., metrics=True), đọc bằng fs.stats()):
+# - Bộ đếm: số lần gọi và số byte (đọc/ghi block, số block duyệt khi tìm block trống, mã hóa AES, băm...)
+# - Histogram độ trễ theo bậc lũy thừa 2 micro giây cho mỗi loại thao tác, ước lượng p50/p90/p99
+# - Tùy chọn chạy cProfile cho từng thao tác công khai (add_file, export_file...), thống kê cộng dồn theo tên
+#   thao tác, và hàm trace(tên thao tác, số giây) được gọi sau mỗi thao tác
+# Khi không bật, FileSystem dùng NULL_METRICS, các lời gọi đo không làm gì
+
+HISTOGRAM_BUCKETS = 32  # Bucket i counts latencies below 2**i microseconds, the last one everything above
+
+class Histogram:
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        microseconds = int(seconds * 1_000_000)
+        self.buckets[min(microseconds.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # Upper bound (seconds) of the bucket that holds the q-th quantile
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min((1 << i) / 1_000_000, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            'count': self.count,
+            'total_seconds': self.total,
+            'mean_seconds': self.total / self.count if self.count else 0.0,
+            'p50_seconds': self.quantile(0.5),
+            'p90_seconds': self.quantile(0.9),
+            'p99_seconds': self.quantile(0.99),
+            'max_seconds': self.max,
+        }
+
+class Timer:
+    __slots__ = ('metrics', 'name', 'nbytes', 'start')
+
+    def __init__(self, metrics: 'Metrics', name: str, nbytes: int):
+        self.metrics = metrics
+        self.name = name
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        if self.nbytes:
+            self.metrics.add(self.name + '_bytes', self.nbytes)
+        return False
+
+class Operation:
+    __slots__ = ('metrics', 'name', 'start', 'outermost', 'profiler')
+
+    def __init__(self, metrics: 'Metrics', name: str):
+        self.metrics = metrics
+        self.name = name
+        self.profiler = None
+
+    def __enter__(self):
+        local = self.metrics._local
+        depth = getattr(local, 'depth', 0)
+        local.depth = depth + 1
+        # Operations called by another operation (export_directory -> export_file) are part of the outer one
+        self.outermost = depth == 0
+        if self.outermost and self.metrics.profile:
+            self.profiler = self.metrics._start_profiler()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        self.metrics._local.depth -= 1
+        if not self.outermost:
+            return False
+        if self.profiler:
+            self.metrics._stop_profiler(self.name, self.profiler)
+        self.metrics.observe('operation.' + self.name, seconds)
+        if self.metrics.trace:
+            self.metrics.trace(self.name, seconds)
+        return False
+
+class Metrics:
+    enabled = True
+
+    def __init__(self, profile: bool = False, trace: Optional[Callable[[str, float], None]] = None):
+        self.profile = profile
+        self.trace = trace
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiling = False  # Only one cProfile profiler can be active at a time in the process
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.histograms = defaultdict(Histogram)
+            self.profiles = {}  # operation name -> pstats.Stats
+
+    def add(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            self.histograms[name].observe(seconds)
+
+    # Time a block of code, nbytes is added to the '<name>_bytes' counter
+    def timer(self, name: str, nbytes: int = 0) -> Timer:
+        return Timer(self, name, nbytes)
+
+    def operation(self, name: str) -> Operation:
+        return Operation(self, name)
+
+    def _start_profiler(self) -> Optional[cProfile.Profile]:
+        with self._lock:
+            if self._profiling:
+                self.counters['profile_skipped'] += 1
+                return None
+            self._profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _stop_profiler(self, name: str, profiler: cProfile.Profile):
+        profiler.disable()
+        with self._lock:
+            self._profiling = False
+            if name in self.profiles:
+                self.profiles[name].add(profiler)
+            else:
+                self.profiles[name] = pstats.Stats(profiler)
+
+    def profile_stats(self, name: str) -> Optional[pstats.Stats]:
+        return self.profiles.get(name)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'latency': {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+                'profiled_operations': sorted(self.profiles),
+            }
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class NullMetrics:
+    enabled = False
+    _timer = NullTimer()
+
+    def add(self, name: str, value: int = 1):
+        pass
+
+    def observe(self, name: str, seconds: float):
+        pass
+
+    def timer(self, name: str, nbytes: int = 0) -> NullTimer:
+        return self._timer
+
+    def operation(self, name: str) -> NullTimer:
+        return self._timer
+
+    def reset(self):
+        pass
+
+    def profile_stats(self, name: str) -> None:
+        return None
+
+    def snapshot(self) -> dict:
+        return {}
+
+NULL_METRICS = NullMetrics()
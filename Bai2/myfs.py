@@ -0,0 +1,270 @@
+import argparse
+import contextlib
+import os
+import shlex
+import sys
+import time
+from file_operations import *
+from dateutil.parser import parse
+
+# CLI không tương tác cho MyFS, dùng trong script tự động:
+#   MYFS_PW=pw python myfs.py --volume MyFS.dat add a.txt docs/a.txt --password-env MYFS_PW
+#   python myfs.py --volume MyFS.dat batch commands.txt   (hoặc '-' để đọc lệnh từ stdin)
+#   python myfs.py --volume MyFS.dat archive - --format tar | gzip > backup.tar.gz
+#   python myfs.py --volume MyFS.dat snapshot before-upgrade   (ls/export/archive --snapshot before-upgrade đọc lại nó)
+# Chế độ batch mở volume, kiểm tra metadata một lần rồi chạy từng dòng lệnh (cùng cú pháp với các lệnh con,
+# dòng trống và dòng bắt đầu bằng '#' bị bỏ qua) trên volume đó, kèm thời gian chạy của từng lệnh
+# CLI này không kiểm tra OTP: khi người gọi tự chọn X và tự tính OTP từ X thì OTP không chứng minh được gì. Chỉ
+# chương trình tương tác (cli.py) hỏi OTP; với myfs, quyền truy cập dựa vào quyền của tập tin volume và metadata
+# Mật khẩu truyền bằng --password hiện trong danh sách tiến trình (ps), dùng --password-env hoặc --password-fd
+# (tương tự cho --old-password, --new-password) để tránh điều đó
+
+# Read commands work on a snapshot of the volume with --snapshot, closed after the command
+@contextlib.contextmanager
+def source_volume(fs: FileSystem, args):
+    if not args.snapshot:
+        yield fs
+        return
+    snapshot = fs.open_snapshot(args.snapshot)
+    try:
+        yield snapshot
+    finally:
+        snapshot.close()
+
+def command_ls(fs: FileSystem, args):
+    with source_volume(fs, args) as source:
+        files = source.list_directory(args.path)
+    for file in files:
+        if file.flags & ENTRY_FLAG_DIRECTORY:
+            print(f"{file.filename}/")
+            continue
+        print(f"{file.filename}\t{file.original_size}\t{file.encrypted_size}\t"
+              f"{parse(file.modification_date).strftime('%Y-%m-%d %H:%M:%S')}")
+
+def command_add(fs: FileSystem, args):
+    if not os.path.exists(args.source):
+        raise Exception(f"Tập tin '{args.source}' không tồn tại.")
+    if os.path.isdir(args.source):
+        fs.add_directory(args.source, args.path, args.password, args.compression, args.dedup, args.block_hashes)
+    else:
+        fs.add_file(args.source, args.path, args.password, args.compression, args.dedup, args.block_hashes)
+
+def command_export(fs: FileSystem, args):
+    with source_volume(fs, args) as fs:
+        entry_info = fs.find_entry(args.path)
+        if entry_info and entry_info[2].flags & ENTRY_FLAG_DIRECTORY:
+            if not args.destination:
+                raise Exception("Cần đường dẫn để xuất thư mục.")
+            fs.export_directory(args.path, args.destination, args.password)
+        else:
+            fs.export_file(args.path, args.destination, args.password)
+
+def command_rm(fs: FileSystem, args):
+    fs.delete_file(args.path)
+
+def command_mkdir(fs: FileSystem, args):
+    fs.make_directory(args.path)
+
+def command_passwd(fs: FileSystem, args):
+    fs.reset_password(args.path, args.old_password, args.new_password)
+
+def command_archive(fs: FileSystem, args):
+    with source_volume(fs, args) as fs:
+        if args.output == '-':
+            count = fs.export_archive(args.paths or None, sys.stdout.buffer, args.format, args.password)
+            sys.stdout.buffer.flush()
+        else:
+            with open(args.output, 'wb') as out_stream:
+                count = fs.export_archive(args.paths or None, out_stream, args.format, args.password)
+    print(f"Đã xuất {count} tập tin vào '{args.output}'.", file=sys.stderr)
+
+def command_snapshot(fs: FileSystem, args):
+    if args.delete:
+        fs.delete_snapshot(args.delete)
+    elif args.name:
+        fs.snapshot(args.name)
+    else:
+        for name, creation_date in fs.list_snapshots():
+            print(f"{name}\t{parse(creation_date).strftime('%Y-%m-%d %H:%M:%S')}")
+
+PASSWORD_OPTIONS = ('--password', '--old-password', '--new-password')
+
+# A password option can also be read from an environment variable (--<option>-env NAME) or from a file descriptor
+# opened by the caller (--<option>-fd N, read up to EOF without the final newline), resolved by read_passwords()
+def add_password_argument(parser: argparse.ArgumentParser, option: str):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(option)
+    group.add_argument(option + '-env', metavar='NAME', help="Đọc mật khẩu từ biến môi trường NAME")
+    group.add_argument(option + '-fd', metavar='FD', type=int, help="Đọc mật khẩu từ file descriptor FD")
+
+def read_passwords(args):
+    for option in PASSWORD_OPTIONS:
+        dest = option[2:].replace('-', '_')
+        if not hasattr(args, dest):
+            continue
+        env_name, fd = getattr(args, dest + '_env'), getattr(args, dest + '_fd')
+        if env_name is not None:
+            if env_name not in os.environ:
+                raise Exception(f"Biến môi trường '{env_name}' không tồn tại.")
+            setattr(args, dest, os.environ[env_name])
+        elif fd is not None:
+            try:
+                with open(fd, 'r') as stream:
+                    setattr(args, dest, stream.read().removesuffix('\n'))
+            except OSError as e:
+                raise Exception(f"Không đọc được mật khẩu từ file descriptor {fd}: {e}")
+
+def add_commands(subparsers):
+    ls = subparsers.add_parser('ls', help="Liệt kê tập tin của một thư mục")
+    ls.add_argument('path', nargs='?', default=PATH_SEPARATOR)
+    ls.add_argument('--snapshot')
+    ls.set_defaults(handler=command_ls)
+
+    add = subparsers.add_parser('add', help="Thêm tập tin hoặc thư mục vào MyFS")
+    add.add_argument('source')
+    add.add_argument('path')
+    add_password_argument(add, '--password')
+    add.add_argument('--compression', choices=[name for name in COMPRESSION_METHODS if name])
+    add.add_argument('--dedup', action='store_true')
+    add.add_argument('--block-hashes', action='store_true')
+    add.set_defaults(handler=command_add)
+
+    export = subparsers.add_parser('export', help="Chép tập tin hoặc thư mục trong MyFS ra ngoài")
+    export.add_argument('path')
+    export.add_argument('destination', nargs='?')
+    add_password_argument(export, '--password')
+    export.add_argument('--snapshot')
+    export.set_defaults(handler=command_export)
+
+    rm = subparsers.add_parser('rm', help="Xóa tập tin hoặc thư mục rỗng")
+    rm.add_argument('path')
+    rm.set_defaults(handler=command_rm)
+
+    mkdir = subparsers.add_parser('mkdir', help="Tạo thư mục")
+    mkdir.add_argument('path')
+    mkdir.set_defaults(handler=command_mkdir)
+
+    archive = subparsers.add_parser('archive', help="Xuất nhiều tập tin thành một tập tin tar/zip ('-' là stdout)")
+    archive.add_argument('output')
+    archive.add_argument('paths', nargs='*', help="Tập tin hoặc thư mục, mặc định mọi tập tin và thư mục của volume (cả bảng entry chính và dự phòng)")
+    archive.add_argument('--format', choices=list(ARCHIVE_FORMATS), default='tar')
+    add_password_argument(archive, '--password')
+    archive.add_argument('--snapshot')
+    archive.set_defaults(handler=command_archive)
+
+    passwd = subparsers.add_parser('passwd', help="Đặt/đổi mật khẩu của tập tin")
+    passwd.add_argument('path')
+    add_password_argument(passwd, '--old-password')
+    add_password_argument(passwd, '--new-password')
+    passwd.set_defaults(handler=command_passwd)
+
+    snapshot = subparsers.add_parser('snapshot', help="Tạo snapshot của volume, không có tên thì liệt kê các snapshot")
+    snapshot.add_argument('name', nargs='?')
+    snapshot.add_argument('--delete', metavar='NAME', help="Xóa snapshot")
+    snapshot.set_defaults(handler=command_snapshot)
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='myfs', description="MyFS không tương tác")
+    parser.add_argument('--volume', default="MyFS.dat", help="Đường dẫn volume, tạo mới nếu chưa có")
+    parser.add_argument('--metadata', default="metadata.dat", help="Đường dẫn tập tin metadata của volume")
+    parser.add_argument('--timing', action='store_true', help="In thời gian chạy của lệnh")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_commands(subparsers)
+    batch = subparsers.add_parser('batch', help="Chạy các lệnh trong một tập tin ('-' là stdin) trên cùng volume")
+    batch.add_argument('commands', nargs='?', default='-')
+    batch.add_argument('--stop-on-error', action='store_true')
+    return parser
+
+def build_batch_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='myfs batch', add_help=False)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_commands(subparsers)
+    return parser
+
+def open_volume(args) -> FileSystem:
+    is_new = not os.path.exists(args.volume)
+    fs = FileSystem(args.volume, metadata_path=args.metadata, lazy=True)
+    # Check volume's metadata and the current running machine to see if they match
+    if not is_new and not fs.compare_metadata():
+        fs.close()
+        raise Exception("Metadata không khớp với máy hiện tại. Volume không thể mở")
+    return fs
+
+# Command line shown in the timing report, with passwords masked
+def command_label(tokens: List[str]) -> str:
+    shown = []
+    for i, token in enumerate(tokens):
+        if i and tokens[i - 1] in PASSWORD_OPTIONS:
+            shown.append('***')
+        elif token.startswith(tuple(option + '=' for option in PASSWORD_OPTIONS)):
+            shown.append(token.split('=', 1)[0] + '=***')
+        else:
+            shown.append(shlex.quote(token))
+    return ' '.join(shown)
+
+def report_timing(label: str, seconds: float, status: str = "ok"):
+    print(f"[{status}] {seconds * 1000:.1f} ms\t{label}", file=sys.stderr)
+
+# Run each command line of stream, return the number of failed commands
+def run_batch(fs: FileSystem, stream, stop_on_error: bool = False) -> int:
+    parser = build_batch_parser()
+    failed = 0
+    total_start = time.perf_counter()
+    count = 0
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        count += 1
+        start = time.perf_counter()
+        label = f"dòng {line_number}"
+        try:
+            tokens = shlex.split(line)
+            label = command_label(tokens)
+            command = parser.parse_args(tokens)
+            read_passwords(command)
+            command.handler(fs, command)
+            report_timing(label, time.perf_counter() - start)
+        except (Exception, SystemExit) as e:
+            # argparse exits on a malformed line, that only fails the line
+            failed += 1
+            report_timing(label, time.perf_counter() - start, "lỗi")
+            if not isinstance(e, SystemExit):
+                print(f"Lỗi (dòng {line_number}): {e}", file=sys.stderr)
+            if stop_on_error:
+                break
+    report_timing(f"{count} lệnh, {failed} lỗi", time.perf_counter() - total_start, "tổng")
+    return failed
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    batch_from_stdin = args.command == 'batch' and args.commands == '-'
+    start = time.perf_counter()
+    try:
+        read_passwords(args)
+        fs = open_volume(args)
+    except Exception as e:
+        print(f"Lỗi: {e}", file=sys.stderr)
+        return 1
+    if args.timing or args.command == 'batch':
+        report_timing("mở volume", time.perf_counter() - start)
+    try:
+        if args.command == 'batch':
+            if batch_from_stdin:
+                return 1 if run_batch(fs, sys.stdin, args.stop_on_error) else 0
+            with open(args.commands, 'r') as stream:
+                return 1 if run_batch(fs, stream, args.stop_on_error) else 0
+        start = time.perf_counter()
+        try:
+            args.handler(fs, args)
+        except Exception as e:
+            print(f"Lỗi: {e}", file=sys.stderr)
+            return 1
+        if args.timing:
+            report_timing(args.command, time.perf_counter() - start)
+        return 0
+    finally:
+        fs.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
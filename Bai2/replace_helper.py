@@ -4,23 +4,152 @@ import time
 import shutil
 import os
 import zipfile
-import subprocess
+import zlib
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Only the files that differ from the source copy are replaced:
+# - The zip carries a manifest member with the SHA-256 of every file (written by main.create_zip_with_py_files).
+#   Installed files are hashed against it, zips made before the manifest existed are compared by size and CRC-32
+#   from the zip's central directory
+# - Each tampered or missing file is extracted to a temporary file next to it, checked, then swapped in with
+#   os.replace, so a file is never left half written
+ZIP_MANIFEST_MEMBER = "source_manifest.sha256"
+HASH_READ_SIZE = 1024 * 1024  # Bytes read per call while hashing or extracting
+PARENT_EXIT_TIMEOUT = 30      # Seconds to wait for the main script to exit
+PARENT_POLL_INTERVAL = 0.05
+
+def hash_file(file_path):
+    sha256_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for byte_block in iter(lambda: f.read(HASH_READ_SIZE), b""):
+            sha256_hash.update(byte_block)
+    return sha256_hash.hexdigest()
+
+def crc32_file(file_path):
+    crc = 0
+    with open(file_path, "rb") as f:
+        for byte_block in iter(lambda: f.read(HASH_READ_SIZE), b""):
+            crc = zlib.crc32(byte_block, crc)
+    return crc
+
+# Lines of "<sha256>  <member name>", like sha256sum
+def format_manifest(hashes):
+    return "".join(f"{hash_value}  {name}\n" for name, hash_value in hashes.items())
+
+def parse_manifest(text):
+    hashes = {}
+    for line in text.splitlines():
+        if line.strip():
+            hash_value, name = line.split("  ", 1)
+            hashes[name] = hash_value
+    return hashes
+
+def wait_for_parent(pid, timeout = PARENT_EXIT_TIMEOUT):
+    """Return once the process pid has exited, or after timeout seconds."""
+    if sys.platform.startswith('win'):
+        import ctypes
+        SYNCHRONIZE = 0x00100000
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(SYNCHRONIZE, False, pid)
+        if handle:
+            kernel32.WaitForSingleObject(handle, int(timeout * 1000))
+            kernel32.CloseHandle(handle)
+        return
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return
+        except PermissionError:
+            pass  # The pid exists but belongs to another user
+        if is_zombie(pid):
+            return
+        time.sleep(PARENT_POLL_INTERVAL)
+
+# An exited process that its parent has not reaped yet still answers kill(pid, 0), Linux shows it in /proc
+def is_zombie(pid):
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            return f.read().rsplit(b")", 1)[1].split()[0] == b"Z"
+    except (OSError, IndexError):
+        return False
+
+def member_path(target_directory, name):
+    parts = name.split('/')
+    if os.path.isabs(name) or '..' in parts:
+        raise Exception(f"Invalid member path in source copy: {name}")
+    return os.path.join(target_directory, *parts)
+
+def is_intact(info, file_path, expected_hash):
+    try:
+        if os.path.getsize(file_path) != info.file_size:
+            return False
+        if expected_hash is not None:
+            return hash_file(file_path) == expected_hash
+        return crc32_file(file_path) == info.CRC
+    except OSError:
+        return False
+
+def changed_members(zip_ref, target_directory):
+    """Members of the source copy whose installed file is missing or differs from it."""
+    try:
+        manifest = parse_manifest(zip_ref.read(ZIP_MANIFEST_MEMBER).decode())
+    except KeyError:
+        manifest = {}
+    members = [info for info in zip_ref.infolist() if not info.is_dir() and info.filename != ZIP_MANIFEST_MEMBER]
+    if not members:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(members), os.cpu_count() or 1)) as pool:
+        intact = pool.map(lambda info: is_intact(info, member_path(target_directory, info.filename), manifest.get(info.filename)), members)
+        return [(info, manifest.get(info.filename)) for info, ok in zip(members, list(intact)) if not ok]
+
+def replace_member(zip_ref, info, expected_hash, target_directory):
+    file_path = member_path(target_directory, info.filename)
+    directory = os.path.dirname(file_path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=".replace-", dir=directory)
+    try:
+        sha256_hash = hashlib.sha256()
+        # Reading the member to the end checks its CRC-32
+        with os.fdopen(fd, "wb") as temp_file, zip_ref.open(info) as member:
+            for byte_block in iter(lambda: member.read(HASH_READ_SIZE), b""):
+                sha256_hash.update(byte_block)
+                temp_file.write(byte_block)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        if expected_hash is not None and sha256_hash.hexdigest() != expected_hash:
+            raise Exception(f"Source copy member '{info.filename}' does not match its manifest hash")
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, temp_path)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 def replace_files(source_zip, target_directory):
     with zipfile.ZipFile(source_zip, 'r') as zip_ref:
-        zip_ref.extractall(target_directory)
-    print("Files have been successfully replaced.")
+        changed = changed_members(zip_ref, target_directory)
+        for info, expected_hash in changed:
+            replace_member(zip_ref, info, expected_hash, target_directory)
+    print(f"Files have been successfully replaced ({len(changed)} changed).")
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python replace_helper.py <source_zip> <target_directory>")
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python replace_helper.py <source_zip> <target_directory> [<parent_pid>]")
         sys.exit(1)
-    
+
     source_zip = sys.argv[1]
     target_directory = sys.argv[2]
 
-    # Wait briefly to ensure the main script has fully exited
-    time.sleep(2)
+    # Wait until the main script has fully exited
+    if len(sys.argv) == 4:
+        wait_for_parent(int(sys.argv[3]))
+    else:
+        time.sleep(2)
 
     try:
         replace_files(source_zip, target_directory)
@@ -38,4 +167,4 @@ def main():
             sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,25 +1,36 @@
+import functools
 import os
 import platform
 import subprocess
 import struct
 from encryption import *
 
+# Thông tin máy (platform, arch, release, machine, processor) không đổi trong một tiến trình nên chỉ dò một lần:
+# platform.architecture() chạy lệnh `file` trên trình thông dịch mỗi lần gọi, platform.processor() có thể chạy `uname -p`
+@functools.lru_cache(maxsize=None)
+def platform_fingerprint() -> tuple:
+    return (platform.system(), platform.architecture()[0], platform.release(), platform.machine(), platform.processor())
+
+# SHA-256 of packed metadata, opening the same volume again in a process doesn't hash it again
+@functools.lru_cache(maxsize=64)
+def metadata_digest(packed: bytes) -> bytes:
+    return hash_sha256_bytes(packed)
+
 class PlatformMetadata:
-    def __init__(self, metadata_path=None, myFS_password_hash: bytes = b'\x00'*32):
-        self.platform = platform.system()
-        self.arch = platform.architecture()[0]
-        self.release = platform.release()
-        self.machine = platform.machine()
-        self.processor = platform.processor()
+    def __init__(self, metadata_path=None, myFS_password_hash: bytes = b'\x00'*32, fingerprint: tuple | None = None):
+        self.platform, self.arch, self.release, self.machine, self.processor = fingerprint or platform_fingerprint()
         self.myFS_password_hash = myFS_password_hash # Giá trị băm mật khẩu truy cập MyFS
         self.metadata_path = metadata_path
-        
+
+    def fingerprint(self) -> tuple:
+        return (self.platform, self.arch, self.release, self.machine, self.processor)
+
     def __eq__(self, other):
-        return (self.platform == other.platform 
-                and self.arch == other.arch 
-                and self.release == other.release 
-                and self.machine == other.machine 
-                and self.processor == other.processor)
+        return self.fingerprint() == other.fingerprint()
+
+    # So sánh với máy đang chạy mà không tạo PlatformMetadata mới
+    def is_current_platform(self) -> bool:
+        return self.fingerprint() == platform_fingerprint()
     
     #Lưu thông tin metadata vào chuỗi bytes
     def pack(self) -> bytes:
@@ -49,14 +60,7 @@ class PlatformMetadata:
         machine = data[48:64].rstrip(b'\x00').decode('utf-8')
         processor = data[64:128].rstrip(b'\x00').decode('utf-8')
         myFS_password_hash = data[128:160].rstrip(b'\x00')
-        metadata = PlatformMetadata()
-        metadata.platform = platform
-        metadata.arch = arch
-        metadata.release = release
-        metadata.machine = machine
-        metadata.processor = processor
-        metadata.myFS_password_hash = myFS_password_hash
-        return metadata
+        return PlatformMetadata(myFS_password_hash=myFS_password_hash, fingerprint=(platform, arch, release, machine, processor))
 
     def write_metadata(self):
         with open(self.metadata_path, 'wb') as f:
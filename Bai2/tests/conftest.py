@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from file_operations import *
+
+TEST_KDF_ITERATIONS = 1000  # Keeps PBKDF2 fast, the iteration count is stored per entry
+
+
+@pytest.fixture
+def fs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    volume = FileSystem(str(tmp_path / 'MyFS.dat'), str(tmp_path / 'metadata.dat'), kdf_iterations=TEST_KDF_ITERATIONS)
+    yield volume
+    volume.close()
+
+
+@pytest.fixture
+def source(tmp_path):
+    # Write content to a file outside the volume, return its path
+    def write(name: str, content: bytes) -> str:
+        path = tmp_path / name
+        path.write_bytes(content)
+        return str(path)
+    return write
+
+
+# Data blocks marked as used in the volume file
+def used_blocks(fs: FileSystem) -> List[int]:
+    used = []
+    with open(fs.file_path, 'rb') as f:
+        for block_index in range(fs.data_block_count()):
+            f.seek(DATA_TABLE_OFFSET + block_index * DATA_BLOCK_SIZE)
+            if f.read(1) == b'\x01':
+                used.append(block_index)
+    return used
+
+
+@pytest.fixture
+def blocks_in_use():
+    return used_blocks
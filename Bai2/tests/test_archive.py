@@ -0,0 +1,27 @@
+import io
+import tarfile
+import zipfile
+
+from file_operations import *
+
+
+def test_archive_of_whole_volume_includes_backup_table(fs, source):
+    count = ENTRY_TABLE_SIZE + 10  # The last entries go to the backup table
+    for i in range(count):
+        fs.add_file(source(f'src{i}', f'content {i}'.encode()), f'f{i}')
+    fs.make_directory('d')
+    fs.add_file(source('nested', b'nested'), 'd/n')
+    assert fs.find_entry('d/n')[0] == 'backup'
+
+    out = io.BytesIO()
+    assert fs.export_archive(None, out, 'tar') == count + 1
+    out.seek(0)
+    with tarfile.open(fileobj=out) as archive:
+        names = set(archive.getnames())
+        assert archive.extractfile(f'f{count - 1}').read() == f'content {count - 1}'.encode()
+    assert names == {f'f{i}' for i in range(count)} | {'d', 'd/n'}
+
+    out = io.BytesIO()
+    fs.export_archive(None, out, 'zip')
+    with zipfile.ZipFile(out) as archive:
+        assert archive.read('d/n') == b'nested'
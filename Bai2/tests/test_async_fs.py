@@ -0,0 +1,115 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from async_fs import *
+
+TIMEOUT = 10
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, TIMEOUT))
+
+
+def test_concurrent_exports(fs, source, tmp_path):
+    afs = AsyncFileSystem(fs)
+    contents = {f'f{i}': os.urandom(5000 + i) for i in range(8)}
+    for name, content in contents.items():
+        fs.add_file(source(name, content), name, 'pw' if name == 'f1' else None)
+
+    async def export_all():
+        # Every file twice: readers of one path run side by side
+        await asyncio.gather(*(afs.export_file(name, str(tmp_path / f'{name}-{n}.out'), 'pw' if name == 'f1' else None)
+                               for name in contents for n in range(2)))
+
+    run(export_all())
+    for name, content in contents.items():
+        for n in range(2):
+            assert (tmp_path / f'{name}-{n}.out').read_bytes() == content
+
+
+def test_add_waits_for_read_of_same_path(fs, source, monkeypatch):
+    afs = AsyncFileSystem(fs)
+    content = os.urandom(3000)
+    started, release = threading.Event(), threading.Event()
+    read_file = fs.read_file
+
+    def slow_read(*args):
+        started.set()
+        release.wait(TIMEOUT)
+        return read_file(*args)
+
+    monkeypatch.setattr(fs, 'read_file', slow_read)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        reader = asyncio.create_task(afs.read_file('f'))
+        await loop.run_in_executor(None, started.wait, TIMEOUT)
+        writer = asyncio.create_task(afs.add_file(source('f', content), 'f'))
+        await asyncio.sleep(0.1)
+        assert not writer.done()
+        assert fs.find_entry('f') is None
+        release.set()
+        # The read ran before the add, the file did not exist yet
+        with pytest.raises(Exception, match="không tồn tại"):
+            await reader
+        await writer
+
+    run(scenario())
+    monkeypatch.undo()
+    assert run(afs.read_file('f')) == content
+
+
+def test_exceptions_propagate_and_release_the_path(fs, source):
+    afs = AsyncFileSystem(fs)
+    fs.add_file(source('f', b'content'), 'f', 'pw')
+
+    async def scenario():
+        with pytest.raises(Exception, match="Mật khẩu không đúng"):
+            await afs.read_file('f', 'wrong')
+        with pytest.raises(Exception, match="đã tồn tại"):
+            await afs.add_file(source('g', b'other'), 'f')
+        with pytest.raises(ValueError):
+            await afs.add_file(source('g', b'other'), 'g', compression='zlib', dedup=True)
+        # The path locks were released by the failed calls
+        await afs.delete_file('f')
+        await afs.add_file(source('g', b'other'), 'f')
+        return await afs.read_file('f')
+
+    assert run(scenario()) == b'other'
+
+
+def test_read_write_lock_orders_tasks():
+    events = []
+
+    async def scenario():
+        lock = AsyncReadWriteLock()
+
+        async def reader(name, delay):
+            async with lock.read():
+                events.append(f'{name} start')
+                await asyncio.sleep(delay)
+                events.append(f'{name} end')
+
+        async def writer():
+            async with lock.write():
+                events.append('writer')
+
+        async def failing_reader():
+            async with lock.read():
+                raise OSError("read failed")
+
+        first = asyncio.create_task(reader('r1', 0.05))
+        await asyncio.sleep(0)
+        write = asyncio.create_task(writer())
+        await asyncio.sleep(0)
+        second = asyncio.create_task(reader('r2', 0))  # Waits for the writer that came first
+        await asyncio.gather(first, write, second)
+        with pytest.raises(OSError):
+            await failing_reader()
+        await writer()
+
+    run(scenario())
+    assert events == ['r1 start', 'r1 end', 'writer', 'r2 start', 'r2 end', 'writer']
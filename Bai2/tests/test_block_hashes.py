@@ -0,0 +1,88 @@
+import hashlib
+import os
+
+import pytest
+
+from file_operations import *
+from fsck import check_volume
+
+CONTENT = os.urandom(3 * DATA_BLOCK_CONTENT_SIZE + 100)
+
+
+def unkeyed_hashes(content: bytes) -> bytes:
+    return b''.join(hashlib.sha256(content[i:i + DATA_BLOCK_CONTENT_SIZE]).digest()
+                    for i in range(0, len(content), DATA_BLOCK_CONTENT_SIZE))
+
+
+def test_hashes_of_encrypted_content_are_keyed(fs, source):
+    fs.add_file(source('a', CONTENT), 'plain', block_hashes=True)
+    fs.add_file(source('b', CONTENT), 'secret', 'pw', block_hashes=True)
+    with fs.open('streamed', 'wb', 'pw', block_hashes=True) as f:
+        f.write(CONTENT)
+
+    assert fs.load_hash_list(fs.find_entry('plain')[2]) == unkeyed_hashes(CONTENT)
+    for name in ('secret', 'streamed'):
+        hash_list = fs.load_hash_list(fs.find_entry(name)[2])
+        assert len(hash_list) == len(unkeyed_hashes(CONTENT))
+        assert not set(hash_list[i:i + HASH_SIZE] for i in range(0, len(hash_list), HASH_SIZE)) & \
+            set(unkeyed_hashes(CONTENT)[i:i + HASH_SIZE] for i in range(0, len(hash_list), HASH_SIZE))
+        assert fs.read_file(name, 'pw') == CONTENT
+        with fs.open(name, 'rb', 'pw') as f:
+            f.seek(DATA_BLOCK_CONTENT_SIZE + 5)
+            assert f.read(10) == CONTENT[DATA_BLOCK_CONTENT_SIZE + 5:DATA_BLOCK_CONTENT_SIZE + 15]
+    assert check_volume(fs, {'secret': 'pw', 'streamed': 'pw'}).is_clean()
+
+
+@pytest.mark.parametrize('options', [{}, {'dedup': True}, {'compression': 'zlib'}])
+def test_reset_password_rehashes_content(fs, source, blocks_in_use, options):
+    fs.add_file(source('a', CONTENT), 'file', 'pw', block_hashes=True, **options)
+    used = len(blocks_in_use(fs))
+
+    fs.reset_password('file', 'pw', '')
+    entry = fs.find_entry('file')[2]
+    assert fs.load_hash_list(entry) == hash_blocks(CONTENT, entry.integrity_block_size())
+    assert fs.read_file('file') == CONTENT
+    fs.reset_password('file', '', 'new')
+    assert fs.read_file('file', 'new') == CONTENT
+    assert check_volume(fs, {'file': 'new'}).is_clean()
+    assert len(blocks_in_use(fs)) == used
+
+
+def test_failed_reset_password_keeps_hash_chain(fs, source, blocks_in_use, monkeypatch):
+    fs.add_file(source('a', CONTENT), 'file', 'pw', block_hashes=True)
+    entry = fs.find_entry('file')[2]
+    hash_block, root = entry.hash_block, entry.hash_root
+    used = blocks_in_use(fs)
+
+    # The hash chain is written, the content chain fails: the entry keeps its hash chain and nothing leaks
+    write_data_chain = fs.write_data_chain
+    calls = []
+
+    def failing_write(data):
+        calls.append(len(data))
+        if len(calls) == 2:
+            raise OSError("disk full")
+        return write_data_chain(data)
+
+    monkeypatch.setattr(fs, 'write_data_chain', failing_write)
+    with pytest.raises(OSError):
+        fs.reset_password('file', 'pw', '')
+    monkeypatch.undo()
+    entry = fs.find_entry('file')[2]
+    assert (entry.hash_block, entry.hash_root) == (hash_block, root)
+    assert blocks_in_use(fs) == used
+
+    # A later write saves the entry tables, the file must still be read back with its old password
+    fs.add_file(source('b', b'other'), 'other')
+    assert fs.read_file('file', 'pw') == CONTENT
+    assert check_volume(fs, {'file': 'pw'}).is_clean()
+
+
+def test_damaged_block_of_encrypted_content_is_located(fs, source):
+    fs.add_file(source('a', CONTENT), 'secret', 'pw', block_hashes=True)
+    block_index = fs.data_chain_blocks(fs.find_entry('secret')[2].first_block)[1]
+    with open(fs.file_path, 'rb+') as f:
+        f.seek(DATA_TABLE_OFFSET + block_index * DATA_BLOCK_SIZE + 100)
+        f.write(b'\xff' * 16)
+    with pytest.raises(Exception, match=f"data block {block_index}"):
+        fs.read_file('secret', 'pw')
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from file_operations import *
+from fsck import check_volume
+
+
+def test_compact_with_snapshots_and_dedup(fs, source, blocks_in_use):
+    contents = {f'f{i}': os.urandom((i + 1) * DATA_BLOCK_CONTENT_SIZE - 7) for i in range(6)}
+    shared = os.urandom(2 * DEDUP_CHUNK_SIZE)
+    for name, content in contents.items():
+        fs.add_file(source(name, content), name, 'pw' if name == 'f1' else None, block_hashes=name == 'f2')
+    fs.add_file(source('d1', shared), 'd1', dedup=True)
+    fs.add_file(source('d2', shared + b'tail'), 'd2', 'pw', dedup=True)
+    fs.snapshot('s')
+    for name in ('f0', 'f3', 'd1'):
+        fs.delete_file(name)
+    fs.reset_password('f1', 'pw', 'new')
+    fs.add_file(source('late', b'late' * 3000), 'late')
+    chunk_blocks = set(fs.load_chunk_index().blocks)
+    used = blocks_in_use(fs)
+    size = os.path.getsize(fs.file_path)
+
+    assert fs.compact() > 0
+    assert fs.compact() == 0  # Nothing left to move
+    assert os.path.getsize(fs.file_path) <= size
+    assert len(blocks_in_use(fs)) == len(used)
+    assert set(fs.load_chunk_index().blocks) == chunk_blocks  # Chunks are pinned
+    assert check_volume(fs, {'f1': 'new', 'd2': 'pw'}).is_clean()
+
+    assert fs.read_file('f1', 'new') == contents['f1']
+    for name in ('f2', 'f4', 'f5'):
+        assert fs.read_file(name) == contents[name]
+    assert fs.read_file('d2', 'pw') == shared + b'tail'
+    assert fs.read_file('late') == b'late' * 3000
+    snapshot = fs.open_snapshot('s')
+    try:
+        for name in ('f0', 'f3'):
+            assert snapshot.read_file(name) == contents[name]
+        assert snapshot.read_file('f1', 'pw') == contents['f1']
+        assert snapshot.read_file('d1') == shared
+    finally:
+        snapshot.close()
+
+    # Deleting the snapshot frees its chains, a second compaction then fills the holes
+    fs.delete_snapshot('s')
+    fs.compact()
+    assert check_volume(fs, {'f1': 'new', 'd2': 'pw'}).is_clean()
+    assert fs.read_file('f5') == contents['f5']
+
+
+def test_chain_with_cycle_does_not_loop(fs, source, blocks_in_use):
+    fs.add_file(source('a', os.urandom(3 * DATA_BLOCK_CONTENT_SIZE)), 'a')
+    fs.add_file(source('b', b'b' * 5000), 'b')
+    chain = fs.data_chain_blocks(fs.find_entry('a')[2].first_block)
+    fs.link_data_block(chain[-1], chain[0])
+
+    with pytest.raises(Exception, match="vòng lặp"):
+        fs.data_chain_blocks(fs.find_entry('a')[2].first_block)
+    with pytest.raises(Exception, match="vòng lặp"):
+        fs.compact()
+    fs.delete_file('a')
+    assert not set(chain) & set(blocks_in_use(fs))
+    assert fs.read_file('b') == b'b' * 5000
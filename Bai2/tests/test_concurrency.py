@@ -0,0 +1,56 @@
+import os
+import threading
+
+from file_operations import *
+
+
+def run_threads(target, count: int = 8):
+    errors = []
+
+    def run(i):
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_key_cache_is_shared_by_threads():
+    cache = KeyCache(ttl=0.0)  # Every derive() purges the keys of the other threads
+    salt = new_kdf_salt()
+
+    def derive(i):
+        for n in range(200):
+            password_hash = hash_sha256(f'{i}-{n % 5}')
+            assert cache.derive(password_hash, salt, 1) == derive_aes_key(password_hash, salt, 1)
+            if n % 7 == 0:
+                cache.purge()
+            if n % 50 == 0:
+                cache.clear()
+
+    run_threads(derive)
+
+
+def test_readers_share_path_caches(fs, source):
+    fs.make_directory('d')
+    fs.make_directory('d/e')
+    contents = {}
+    for i in range(20):
+        contents[f'd/e/f{i}'] = os.urandom(100 + i)
+        fs.add_file(source(f'src{i}', contents[f'd/e/f{i}']), f'd/e/f{i}', 'pw' if i % 2 else None)
+
+    def read(i):
+        for n in range(20):
+            if i == 0:
+                fs.load_entry_tables()  # Drops both caches while the other threads fill them
+            path = f'd/e/f{(i + n) % 20}'
+            assert fs.read_file(path, 'pw' if (i + n) % 2 else None) == contents[path]
+            assert len(fs.list_directory('d/e')) == 20
+
+    run_threads(read)
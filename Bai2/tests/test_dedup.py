@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from file_operations import *
+from fsck import check_volume
+
+CHUNKS = [os.urandom(DEDUP_CHUNK_SIZE) for _ in range(3)]
+
+
+def refcounts(fs: FileSystem) -> list:
+    return sorted(refcount for _, refcount in fs.load_chunk_index().chunks.values())
+
+
+def test_shared_chunks_are_counted_and_freed_with_the_last_file(fs, source, blocks_in_use):
+    fs.add_file(source('a', CHUNKS[0] + CHUNKS[1]), 'a', dedup=True)
+    fs.add_file(source('b', CHUNKS[1] + CHUNKS[2] + CHUNKS[1]), 'b', 'pw', dedup=True)
+    assert refcounts(fs) == [1, 1, 3]
+    assert fs.read_file('b', 'pw') == CHUNKS[1] + CHUNKS[2] + CHUNKS[1]
+
+    fs.delete_file('b')
+    assert refcounts(fs) == [1, 1]
+    assert fs.read_file('a') == CHUNKS[0] + CHUNKS[1]
+    assert check_volume(fs).is_clean()
+
+    fs.delete_file('a')
+    assert refcounts(fs) == []
+    index_entry = fs.find_system_entry(CHUNK_INDEX_FILENAME)
+    index_blocks = len(fs.data_chain_blocks(index_entry[2].first_block)) if index_entry else 0
+    assert len(blocks_in_use(fs)) == index_blocks
+    assert check_volume(fs).is_clean()
+
+
+def test_overwrite_releases_the_old_references(fs, source):
+    fs.add_file(source('a', CHUNKS[0] + CHUNKS[1]), 'a', dedup=True)
+    fs.add_file(source('b', CHUNKS[0]), 'b', dedup=True)
+    with fs.open('a', 'wb', dedup=True) as f:
+        f.write(CHUNKS[2])
+    assert refcounts(fs) == [1, 1]
+    assert fs.read_file('a') == CHUNKS[2]
+    assert fs.read_file('b') == CHUNKS[0]
+    assert check_volume(fs).is_clean()
+
+
+def test_failed_reset_password_under_snapshot_keeps_references(fs, source, blocks_in_use, monkeypatch):
+    fs.add_file(source('a', CHUNKS[0] + CHUNKS[1]), 'a', 'pw', dedup=True)
+    fs.snapshot('before')
+    counts = refcounts(fs)
+    used = blocks_in_use(fs)
+
+    # The new records took their own references, saving the chunk index fails: both are undone
+    def failing_save():
+        raise OSError("disk full")
+
+    monkeypatch.setattr(fs, 'save_chunk_index', failing_save)
+    with pytest.raises(OSError):
+        fs.reset_password('a', 'pw', '')
+    monkeypatch.undo()
+    assert refcounts(fs) == counts
+    assert blocks_in_use(fs) == used
+    assert fs.read_file('a', 'pw') == CHUNKS[0] + CHUNKS[1]
+
+    fs.reset_password('a', 'pw', '')
+    assert refcounts(fs) == [count + 1 for count in counts]
+    assert fs.read_file('a') == CHUNKS[0] + CHUNKS[1]
+    assert check_volume(fs).is_clean()
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from file_operations import *
+
+
+def test_write_then_read_back(fs):
+    content = os.urandom(3 * DATA_BLOCK_CONTENT_SIZE + 100)
+    with fs.open('a', 'wb', password='pw') as h:
+        h.write(content[:5000])
+        h.write(content[5000:])
+    with fs.open('a', 'rb', password='pw') as h:
+        assert h.read() == content
+        h.seek(4000)
+        assert h.read(300) == content[4000:4300]
+
+
+# The padded tail of an encrypted file can be longer than one data block
+def test_padded_tail_spans_two_blocks(fs):
+    content = os.urandom(2 * DATA_BLOCK_CONTENT_SIZE - 5)
+    with fs.open('a', 'wb', password='pw') as h:
+        h.write(content)
+    with fs.open('b', 'wb') as h:
+        h.write(b'next file')
+    assert fs.read_file('a', 'pw') == content
+    assert fs.read_file('b') == b'next file'
+
+
+@pytest.mark.parametrize('dedup', [False, True])
+def test_exception_in_with_block_keeps_old_content(fs, blocks_in_use, dedup):
+    with fs.open('a', 'wb', dedup=dedup) as h:
+        h.write(b'old content')
+    used = blocks_in_use(fs)
+    chunks = {chunk_id: list(value) for chunk_id, value in fs.load_chunk_index().chunks.items()}
+
+    with pytest.raises(RuntimeError):
+        with fs.open('a', 'wb', dedup=dedup) as h:
+            h.write(os.urandom(5 * DATA_BLOCK_CONTENT_SIZE))
+            raise RuntimeError("interrupted")
+
+    assert h.closed
+    assert fs.read_file('a') == b'old content'
+    assert blocks_in_use(fs) == used
+    assert {chunk_id: list(value) for chunk_id, value in fs.load_chunk_index().chunks.items()} == chunks
+
+
+def test_unclosed_write_handle_is_discarded(fs, blocks_in_use):
+    h = fs.open('a', 'wb')
+    h.write(os.urandom(2 * DATA_BLOCK_CONTENT_SIZE))
+    del h
+    assert fs.find_entry('a') is None
+    assert blocks_in_use(fs) == []
+    # The write lock of the handle was released
+    fs.make_directory('d')
+
+
+def test_reads_go_through_chain_readahead(fs, source, monkeypatch):
+    content = os.urandom(100 * DATA_BLOCK_CONTENT_SIZE + 10)
+    fs.add_file(source('a', content), 'a', 'pw')
+    runs = []
+
+    def counting_read_block_run(f, start, count):
+        runs.append(count)
+        return read_block_run(f, start, count)
+
+    monkeypatch.setattr('file_operations.read_block_run', counting_read_block_run)
+    with fs.open('a', 'rb', password='pw') as h:
+        assert h.read() == content
+        # The 101 blocks were read with one read per window of contiguous blocks, not one per block
+        assert sum(runs) >= 101 and len(runs) < 10
+        for position in (90 * DATA_BLOCK_CONTENT_SIZE, 5, 50 * DATA_BLOCK_CONTENT_SIZE - 3, len(content) - 20):
+            h.seek(position)
+            assert h.read(5000) == content[position:position + 5000]
@@ -0,0 +1,85 @@
+import os
+
+import pytest
+
+from file_operations import *
+import fsck
+from fsck import check_volume
+
+
+def test_clean_volume(fs, source):
+    fs.add_file(source('a', os.urandom(10000)), 'a', 'pw', block_hashes=True)
+    fs.add_file(source('b', os.urandom(10000)), 'b', dedup=True)
+    fs.make_directory('d')
+    fs.add_file(source('c', b'c'), 'd/c')
+    report = check_volume(fs, {'a': 'pw'})
+    assert report.is_clean(), report.summary()
+    assert (report.file_count, report.directory_count) == (3, 1)
+
+
+def test_passwords_are_given_by_full_path(fs, source, monkeypatch, capsys):
+    fs.make_directory('d')
+    fs.make_directory('e')
+    fs.add_file(source('x', b'in d'), 'd/f', 'pw-d')
+    fs.add_file(source('y', b'in e'), 'e/f', 'pw-e')
+    report = check_volume(fs, {'d/f': 'pw-d', 'e/f': 'pw-e'})
+    assert report.is_clean() and report.unverified == []
+    assert check_volume(fs, {'f': 'pw-d'}).unverified == ['d/f', 'e/f']
+
+    # Same from the command line, the passwords read from the environment and from a file descriptor
+    monkeypatch.setenv('FSCK_TEST_PASSWORD', 'pw-d')
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'pw-e\n')
+    os.close(write_fd)
+    volume = [fs.file_path, '--metadata', fs.metadata_path]
+    assert fsck.main([*volume, '--password-env', 'd/f=FSCK_TEST_PASSWORD', '--password-fd', f'/e/f={read_fd}']) == 0
+    output = capsys.readouterr().out
+    assert "2 tập tin, 2 thư mục" in output and "Không kiểm tra được" not in output
+    assert fsck.main([*volume, '--password-env', 'd/f=FSCK_TEST_MISSING']) == 1
+    assert "FSCK_TEST_MISSING" in capsys.readouterr().out
+
+
+def test_cut_chain_is_reported_as_truncated(fs, source):
+    content = os.urandom(3 * DATA_BLOCK_CONTENT_SIZE)
+    fs.add_file(source('a', content), 'a')
+    fs.add_file(source('b', content), 'b')
+    a_blocks = fs.data_chain_blocks(fs.find_entry('a')[2].first_block)
+    fs.link_data_block(a_blocks[0], fs.data_block_count() + 10)  # Out of the volume
+
+    report = check_volume(fs, repair=True)
+    assert report.truncated == ['a'] and report.bad_pointers
+    assert 'a' not in report.checksum_errors  # Left out of the MD5 pass, its content is known to be lost
+    assert not report.is_clean()
+
+    # The cut chain is now too short for the entry size, which fsck reports without changing it
+    report = check_volume(fs)
+    assert report.size_mismatches == [('a', 1, 3)]
+    assert not report.bad_pointers and not report.orphaned_blocks
+    assert fs.read_file('b') == content
+
+
+def test_root_names_are_unique(fs, source):
+    fs.add_file(source('a', b'a'), 'a')
+    fs.make_directory('d')
+    fs.add_file(source('b', b'b'), 'd/a')
+    with pytest.raises(Exception, match="đã tồn tại"):
+        fs.add_file(source('b', b'b'), 'a')
+    with pytest.raises(Exception, match="đã tồn tại"):
+        fs.make_directory('d')
+
+
+def test_unlinked_entry_moved_to_root_is_renamed_on_clash(fs, source):
+    fs.add_file(source('a', b'root'), 'a')
+    fs.make_directory('d')
+    fs.add_file(source('b', b'nested'), 'd/a')
+    directory = fs.find_entry('d')[:2]
+    del fs.directory_children(directory)['a']  # The index of 'd' loses its record
+    fs.save_directory(directory)
+    fs.save_entry_tables()
+
+    report = check_volume(fs, repair=True)
+    assert report.unlinked_entries == ['a']
+    assert report.renamed == [('a', 'a~1')]
+    assert fs.read_file('a') == b'root'
+    assert fs.read_file('a~1') == b'nested'
+    assert check_volume(fs).is_clean()
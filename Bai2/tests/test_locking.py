@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import locking
+from file_operations import *
+
+BAI2 = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_other_writers_are_seen_through_the_generation(fs, source, tmp_path):
+    other = FileSystem(fs.file_path, fs.metadata_path, lazy=True)
+    try:
+        assert other.list_files() == []
+        generation = fs.volume_lock.generation()
+        fs.add_file(source('a', b'a'), 'a')
+        assert fs.volume_lock.generation() == generation + 1
+        assert [entry.filename for entry in other.list_files()] == ['a']
+    finally:
+        other.close()
+
+    # Another process has its own lock object, only the generation in the lock file tells it changed
+    script = (f"import sys; sys.path.insert(0, {BAI2!r}); from file_operations import *; "
+              f"fs = FileSystem({fs.file_path!r}, {fs.metadata_path!r}, kdf_iterations=1000, lazy=True); "
+              f"fs.add_file({source('b', b'b')!r}, 'b'); fs.close()")
+    subprocess.run([sys.executable, '-c', script], check=True, cwd=str(tmp_path), stdout=subprocess.DEVNULL)
+    assert fs.read_file('b') == b'b'
+
+
+def test_lock_file_is_closed_with_the_last_user(fs):
+    other = FileSystem(fs.file_path, fs.metadata_path, lazy=True)
+    lock = other.volume_lock
+    assert lock is fs.volume_lock and lock.users == 2
+    other.close()
+    other.close()  # Closing twice gives the lock back once
+    assert lock.users == 1
+    fs.close()
+    assert os.path.realpath(fs.file_path) not in locking._volume_locks
+    with pytest.raises(OSError):
+        os.fstat(lock._fd)
+
+
+def test_write_handle_can_be_closed_on_another_thread(fs, source):
+    handle = fs.open('a', 'wb')
+    handle.write(b'content')
+    closer = threading.Thread(target=handle.close)
+    closer.start()
+    closer.join()
+
+    # The write lock is free again for every thread, the opening one included
+    writer = threading.Thread(target=fs.add_file, args=(source('b', b'b'), 'b'))
+    writer.start()
+    writer.join(timeout=10)
+    assert not writer.is_alive()
+    fs.add_file(source('c', b'c'), 'c')
+    assert [fs.read_file(name) for name in ('a', 'b', 'c')] == [b'content', b'b', b'c']
+
+
+def test_access_password_change_takes_the_write_lock(fs):
+    generation = fs.volume_lock.generation()
+    fs.change_access_password(None, 'secret')
+    assert fs.volume_lock.generation() == generation + 1
+
+
+def test_handle_dropped_on_another_thread_is_discarded(fs, source, blocks_in_use):
+    handles = []
+    opener = threading.Thread(target=lambda: handles.append(fs.open('a', 'wb')))
+    opener.start()
+    opener.join()
+    handles[0].write(os.urandom(3 * DATA_BLOCK_CONTENT_SIZE))
+    handles.clear()  # Collected here, on the main thread
+
+    fs.add_file(source('b', b'b'), 'b')
+    assert fs.find_entry('a') is None
+    assert len(blocks_in_use(fs)) == 1
@@ -0,0 +1,37 @@
+import os
+
+import myfs
+
+
+def run(tmp_path, *argv) -> int:
+    return myfs.main(['--volume', str(tmp_path / 'MyFS.dat'), '--metadata', str(tmp_path / 'metadata.dat'), *argv])
+
+
+def test_passwords_from_environment_and_file_descriptor(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'a.txt').write_bytes(b'secret content')
+    monkeypatch.setenv('MYFS_TEST_PASSWORD', 'pw')
+    # No OTP is asked without a terminal
+    assert run(tmp_path, 'add', 'a.txt', 'a', '--password-env', 'MYFS_TEST_PASSWORD') == 0
+
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b'pw\n')
+    os.close(write_fd)
+    assert run(tmp_path, 'export', 'a', str(tmp_path / 'out.txt'), '--password-fd', str(read_fd)) == 0
+    assert (tmp_path / 'out.txt').read_bytes() == b'secret content'
+
+    assert run(tmp_path, 'export', 'a', str(tmp_path / 'out2.txt'), '--password-env', 'MYFS_TEST_MISSING') == 1
+    assert not (tmp_path / 'out2.txt').exists()
+
+
+def test_batch_reads_passwords_per_line(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'a.txt').write_bytes(b'content')
+    monkeypatch.setenv('OLD', 'pw')
+    monkeypatch.setenv('NEW', 'changed')
+    (tmp_path / 'commands.txt').write_text(
+        "add a.txt a --password-env OLD\n"
+        "passwd a --old-password-env OLD --new-password-env NEW\n"
+        f"export a {tmp_path / 'out.txt'} --password changed\n")
+    assert run(tmp_path, 'batch', str(tmp_path / 'commands.txt')) == 0
+    assert (tmp_path / 'out.txt').read_bytes() == b'content'
@@ -0,0 +1,77 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from file_operations import *
+from fsck import check_volume
+
+
+@pytest.fixture
+def files(fs, source):
+    contents = {
+        'plain': os.urandom(3 * DATA_BLOCK_CONTENT_SIZE),
+        'secret': os.urandom(10000),
+        'dedup': os.urandom(2 * DEDUP_CHUNK_SIZE + 5),
+        'hashed': os.urandom(9000),
+    }
+    fs.add_file(source('plain', contents['plain']), 'plain')
+    fs.add_file(source('secret', contents['secret']), 'secret', 'pw')
+    fs.add_file(source('dedup', contents['dedup']), 'dedup', 'pw', dedup=True)
+    fs.add_file(source('hashed', contents['hashed']), 'hashed', block_hashes=True)
+    return contents
+
+
+def test_snapshot_keeps_content_after_changes(fs, source, files):
+    fs.snapshot('before')
+    fs.delete_file('plain')
+    with fs.open('hashed', 'wb') as f:
+        f.write(b'overwritten')
+    fs.reset_password('secret', 'pw', 'new')
+    fs.reset_password('dedup', 'pw', '')
+    fs.add_file(source('late', b'late'), 'late')
+
+    snapshot = fs.open_snapshot('before')
+    try:
+        assert snapshot.read_file('plain') == files['plain']
+        assert snapshot.read_file('hashed') == files['hashed']
+        assert snapshot.read_file('secret', 'pw') == files['secret']
+        assert snapshot.read_file('dedup', 'pw') == files['dedup']
+        assert snapshot.find_entry('late') is None
+        with pytest.raises(Exception, match="chỉ đọc"):
+            snapshot.delete_file('secret')
+
+        out = io.BytesIO()
+        assert snapshot.export_archive(None, out, 'tar', 'pw') == 4
+        out.seek(0)
+        with tarfile.open(fileobj=out) as archive:
+            assert {name: archive.extractfile(name).read() for name in archive.getnames()} == files
+    finally:
+        snapshot.close()
+
+    assert fs.read_file('secret', 'new') == files['secret']
+    assert fs.read_file('dedup') == files['dedup']
+    assert fs.read_file('hashed') == b'overwritten'
+    assert check_volume(fs, {'secret': 'new'}).is_clean()
+
+
+def test_delete_snapshot_frees_what_only_it_kept(fs, source, files, blocks_in_use):
+    fs.snapshot('before')
+    fs.delete_file('plain')
+    fs.delete_file('dedup')
+    fs.reset_password('secret', 'pw', 'new')
+    assert check_volume(fs, {'secret': 'new'}).is_clean()
+
+    fs.delete_snapshot('before')
+    assert fs.list_snapshots() == []
+    report = check_volume(fs, {'secret': 'new'})
+    assert report.is_clean(), report.summary()
+    assert fs.load_chunk_index().chunks == {}
+
+    # Only the live files and the two system entries (chunk index and empty snapshot list) still use blocks
+    live = sum(len(fs.data_chain_blocks(fs.find_entry(name)[2].first_block)) for name in ('secret', 'hashed'))
+    live += len(fs.data_chain_blocks(fs.find_entry('hashed')[2].hash_block))
+    system = sum(len(fs.data_chain_blocks(fs.find_system_entry(name)[2].first_block))
+                 for name in (CHUNK_INDEX_FILENAME, SNAPSHOT_INDEX_FILENAME) if fs.find_system_entry(name))
+    assert len(blocks_in_use(fs)) == live + system
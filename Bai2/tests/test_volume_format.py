@@ -0,0 +1,150 @@
+import os
+import struct
+
+import pytest
+
+from file_operations import *
+from fsck import check_volume
+
+LEGACY_ENTRY = struct.Struct('>B8s32s20s20s32s16sQQ256s')
+
+
+# Volume of format version 0: 401-byte entries, content of reset files in blocks of 4086 bytes
+def write_legacy_volume(path: str, files: List[Tuple[str, bytes, Optional[str], int]]):
+    entries = []
+    data = bytearray()
+    block_count = 0
+    for name, content, password, per_block in files:
+        password_hash = hash_sha256(password) if password else b'\x00' * 32
+        stored = encrypt_data(derive_aes_key(password_hash), content) if password else content
+        pieces = [stored[i:i + per_block] for i in range(0, len(stored), per_block)]
+        first_block = block_count
+        for i, piece in enumerate(pieces):
+            next_block = struct.pack('>Q', block_count + 1) if i + 1 < len(pieces) else ALL_ONES_ADDRESS
+            data += DataBlock(status=0x01, next_block=next_block, content=piece.ljust(DATA_BLOCK_CONTENT_SIZE, b'\x00')).pack()
+            block_count += 1
+        date = current_iso8601().encode('ascii')
+        entries.append(LEGACY_ENTRY.pack(0x01, struct.pack('>Q', first_block), pad_filename(name), date, date,
+                                         password_hash, hash_md5(content), len(stored), len(content), b''))
+    empty = LEGACY_ENTRY.pack(0x00, ALL_ONES_ADDRESS, b'', b'', b'', b'\x00' * 32, b'\x00' * 16, 0, 0, b'')
+    tables = b''.join(entries) + empty * (2 * ENTRY_TABLE_SIZE - len(entries))
+    with open(path, 'wb') as f:
+        f.write(b'IVOLFILE' + struct.pack('>QQ', LEGACY_DATA_TABLE_OFFSET, 0) + os.urandom(32) + b'\x00' * 32)
+        f.write(tables)
+        f.write(data)
+
+
+def test_legacy_volume_is_migrated(tmp_path):
+    path = str(tmp_path / 'old.dat')
+    plain = os.urandom(10000)
+    added = os.urandom(9000)
+    reset = os.urandom(8200)  # 3 blocks of 4086 bytes, 3 of 4087 too: told apart by the first read with the password
+    reset_longer = os.urandom(16 * DATA_BLOCK_CONTENT_SIZE - 1)  # Padded to 17 blocks of 4086 bytes, 16 of 4087
+    write_legacy_volume(path, [
+        ('plain', plain, None, DATA_BLOCK_CONTENT_SIZE),
+        ('added', added, 'pw', DATA_BLOCK_CONTENT_SIZE),
+        ('reset', reset, 'pw', LEGACY_BLOCK_CONTENT_SIZE),
+        ('reset2', reset_longer, 'pw', LEGACY_BLOCK_CONTENT_SIZE),
+    ])
+
+    fs = FileSystem(path, str(tmp_path / 'metadata.dat'), lazy=True)
+    assert fs.volume_info.format_version == VOLUME_FORMAT_VERSION
+    assert not os.path.exists(path + '.migrate')
+    assert fs.find_entry('reset')[2].flags & ENTRY_FLAG_LEGACY_LAYOUT
+    assert not fs.find_entry('reset2')[2].flags & ENTRY_FLAG_LEGACY_LAYOUT
+    assert fs.read_file('plain') == plain
+    assert fs.read_file('added', 'pw') == added
+    assert fs.read_file('reset', 'pw') == reset
+    assert not fs.find_entry('reset')[2].flags & ENTRY_FLAG_LEGACY_LAYOUT
+    assert fs.read_file('reset2', 'pw') == reset_longer
+    assert check_volume(fs, {name: 'pw' for name in ('added', 'reset', 'reset2')}).is_clean()
+
+    # Legacy entries keep the fixed salt until their password changes
+    fs.reset_password('added', 'pw', 'new')
+    assert fs.find_entry('added')[2].kdf_iterations == fs.kdf_iterations
+    assert fs.read_file('added', 'new') == added
+
+
+def test_full_blocks_ending_with_zero_bytes_are_not_repacked(tmp_path, blocks_in_use):
+    # Encrypted content of 2 blocks whose first block ends with a zero byte, like the old reset_password layout
+    key = derive_aes_key(hash_sha256('pw'))
+    while True:
+        content = os.urandom(DATA_BLOCK_CONTENT_SIZE + 100)
+        if encrypt_data(key, content)[LEGACY_BLOCK_CONTENT_SIZE] == 0:
+            break
+    path = str(tmp_path / 'old.dat')
+    write_legacy_volume(path, [('added', content, 'pw', DATA_BLOCK_CONTENT_SIZE)])
+
+    fs = FileSystem(path, str(tmp_path / 'metadata.dat'), lazy=True)
+    assert fs.find_entry('added')[2].flags & ENTRY_FLAG_LEGACY_LAYOUT
+    used = blocks_in_use(fs)
+    with fs.open('added', 'rb', password='pw') as f:
+        assert f.read() == content
+    entry = fs.find_entry('added')[2]
+    assert not entry.flags & ENTRY_FLAG_LEGACY_LAYOUT
+    assert blocks_in_use(fs) == used  # Already full blocks, nothing was rewritten
+    assert fs.read_file('added', 'pw') == content
+
+
+def test_newer_format_is_refused(fs):
+    fs.volume_info.format_version = VOLUME_FORMAT_VERSION + 1
+    fs.save_volume_info()
+    with pytest.raises(Exception, match="định dạng"):
+        FileSystem(fs.file_path, fs.metadata_path)
+
+
+def test_entry_layout_has_reserved_bytes():
+    assert ENTRY_SIZE == 512
+    assert Entry().pack()[ENTRY_LAYOUT.size - 17:] == b'\x00' * 17
+
+
+def test_stored_fields_do_not_give_the_key(fs, source):
+    content = os.urandom(3000)
+    fs.add_file(source('secret', content), 'secret', 'pw')
+    entry = fs.find_entry('secret')[2]
+    data_key = unwrap_key(derive_password_key('pw', entry.kdf_salt, entry.kdf_iterations), entry.wrapped_key)
+
+    # Neither the password hash nor the stored verifier unwraps the data key
+    assert entry.password_hash != hash_sha256('pw')
+    for stored in (hash_sha256('pw'), entry.password_hash):
+        key = derive_aes_key(stored, entry.kdf_salt, entry.kdf_iterations)
+        assert unwrap_key(key, entry.wrapped_key) != data_key
+    assert fs.password_key(entry, 'wrong') is None
+    with pytest.raises(Exception, match="Mật khẩu không đúng"):
+        fs.read_file('secret', 'wrong')
+    assert fs.read_file('secret', 'pw') == content
+
+
+def test_legacy_rekey_keeps_old_chain_until_entry_is_saved(tmp_path, monkeypatch, blocks_in_use):
+    path = str(tmp_path / 'old.dat')
+    content = os.urandom(5 * DATA_BLOCK_CONTENT_SIZE - 15)  # 5 full blocks once padded, 6 in the old reset layout
+    write_legacy_volume(path, [('legacy', content, 'pw', DATA_BLOCK_CONTENT_SIZE)])
+    fs = FileSystem(path, str(tmp_path / 'metadata.dat'), lazy=True)
+    old_first_block = fs.find_entry('legacy')[2].first_block
+    used = blocks_in_use(fs)
+
+    # Interrupted while writing the new chain: the entry keeps its key and chain, the new blocks are freed
+    write_data_block = fs.write_data_block
+    calls = []
+
+    def failing_write(block_index, block):
+        calls.append(block_index)
+        if len(calls) == 3:
+            raise OSError("disk full")
+        write_data_block(block_index, block)
+
+    monkeypatch.setattr(fs, 'write_data_block', failing_write)
+    with pytest.raises(OSError):
+        fs.reset_password('legacy', 'pw', 'new')
+    monkeypatch.undo()
+    assert fs.find_entry('legacy')[2].first_block == old_first_block
+    assert fs.read_file('legacy', 'pw') == content
+    assert blocks_in_use(fs) == used
+
+    fs.reset_password('legacy', 'pw', 'new')
+    assert fs.find_entry('legacy')[2].first_block != old_first_block
+    blocks = fs.data_chain_blocks(fs.find_entry('legacy')[2].first_block)
+    assert blocks == list(range(blocks[0], blocks[0] + len(blocks)))  # One run of free blocks
+    assert fs.read_file('legacy', 'new') == content
+    assert len(blocks_in_use(fs)) == len(used)
+    assert check_volume(fs, {'legacy': 'new'}).is_clean()